@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Benchmarks for the mwaqa library, run against a local stand-in server (see server.py) with synthetic data.
+
+Each benchmark is run --repeat times after one warm-up run, and its wall-clock times, throughput (rows per second)
+and peak Python memory are written as JSON, e.g.
+
+    python benchmarks/bench.py --rows 100000 --latency 0.01 -o results.json
+    python benchmarks/bench.py --rows 100000 --latency 0.01 --compare results.json
+
+With --compare, the median times are compared with an earlier results file, and the exit status is 1 if any
+benchmark is slower by more than --tolerance.
+"""
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from timeit import default_timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import server
+import mwaqa
+import mwaqa.util as u
+from mwaqa import metadata
+from mwaqa.export import CSVWriter
+from mwaqa.obsids import prune_rows, prune_table
+from mwaqa.schema import QACOLUMNNAMES
+from mwaqa.tables import table_from_rows
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+# The columns fetched by the select benchmarks: those printed by default by mwaqa_query.py, and some wider ones.
+COLUMNS = ["obsid", "projectid", "lowest_channel", "eor_field", "gridpoint_number", "iono_qa", "iono_magnitude",
+           "iono_pca", "sourcelist", "uvfits_path"]
+# Modules which are slow to import, and shouldn't be loaded just to run a query and print the results.
+HEAVYMODULES = ("numpy", "astropy")
+# The slow modules loaded by each startup benchmark, filled in as they're set up.
+STARTUP = {}
+
+
+def benchmarks(nrows, find_rows):
+    """
+    Return a list of (name, setup) pairs. Each setup function prepares any inputs, and returns a function which
+    runs the benchmark once and returns the number of rows it handled.
+    """
+    def select():
+        return lambda: len(u.select(column_list=COLUMNS, pagesize=nrows)["rows"])
+
+    def iselect():
+        return lambda: sum(1 for _ in u.iselect(column_list=COLUMNS, pagesize=nrows))
+
+    def select_sharded():
+        hi = server.FIRSTOBSID + server.SPACING * nrows
+        return lambda: len(u.select_sharded(column_list=COLUMNS, min_obsid=server.FIRSTOBSID, max_obsid=hi,
+                                            pagesize=nrows)["rows"])
+
+    def make_query():
+        def run():
+            q = metadata.Query(pagesize=find_rows)
+            q.make_query(warn=False)
+            return len(q.table)
+        return run
+
+    def metadata_table():
+        q = metadata.Query(pagesize=find_rows)
+        q.params2url()
+        results = q._fetch(q.url)
+        return lambda: len(q._table(results))
+
+    def qa_table():
+        rows = u.select(column_list=QACOLUMNNAMES, pagesize=nrows)["rows"]
+        return lambda: len(table_from_rows(rows, QACOLUMNNAMES))
+
+    def prune():
+        rows = u.select(column_list=COLUMNS, pagesize=nrows)["rows"]
+        obsids = np.array([row[0] for row in rows[::2]])
+        return lambda: len(prune_rows(rows, obsids))
+
+    def prune_qa_table():
+        table = table_from_rows(u.select(column_list=COLUMNS, pagesize=nrows)["rows"], COLUMNS)
+        obsids = np.array(table["obsid"][::2])
+        return lambda: len(prune_table(table, obsids))
+
+    def csv_rows():
+        rows = u.select(column_list=COLUMNS, pagesize=nrows)["rows"]
+
+        def run():
+            with CSVWriter(io.StringIO(), columns=COLUMNS) as writer:
+                writer.write_rows(rows)
+            return len(rows)
+        return run
+
+    def csv_table():
+        table = table_from_rows(u.select(column_list=COLUMNS, pagesize=nrows)["rows"], COLUMNS)
+
+        def run():
+            with CSVWriter(io.StringIO()) as writer:
+                writer.write(table)
+            return len(table)
+        return run
+
+    def insert_many():
+        rows = [dict(obsid=server.FIRSTOBSID + i, iono_qa=1) for i in range(nrows)]
+        return lambda: u.insert_many(rows, batched=True)["inserted"]
+
+    def insert_rows():
+        # One request per row is much slower, so insert fewer.
+        rows = [dict(obsid=server.FIRSTOBSID + i, iono_qa=1) for i in range(min(nrows, 200))]
+        return lambda: u.insert_many(rows)["inserted"]
+
+    def startup(name, code):
+        # Time a new Python process, as startup time is mostly spent importing modules.
+        command = [sys.executable, "-c", code]
+
+        def setup():
+            # List the slow modules loaded on stderr, as --help prints to stdout.
+            check = "\nimport sys\nsys.stderr.write(' '.join(m for m in %r if m in sys.modules))" % (HEAVYMODULES,)
+            with open(os.devnull, "w") as devnull:
+                process = subprocess.Popen([sys.executable, "-c", code + check], cwd=ROOT, stdout=devnull,
+                                           stderr=subprocess.PIPE)
+                STARTUP[name] = process.communicate()[1].decode().split()
+
+            def run():
+                with open(os.devnull, "w") as devnull:
+                    subprocess.check_call(command, cwd=ROOT, stdout=devnull)
+                return 0
+            return run
+        return setup
+
+    return [("select", select),
+            ("iselect", iselect),
+            ("select_sharded", select_sharded),
+            ("make_query", make_query),
+            ("metadata_table", metadata_table),
+            ("qa_table", qa_table),
+            ("prune_rows", prune),
+            ("prune_table", prune_qa_table),
+            ("csv_rows", csv_rows),
+            ("csv_table", csv_table),
+            ("insert_many", insert_many),
+            ("insert_rows", insert_rows),
+            ("import_util", startup("import_util", "import mwaqa.util")),
+            ("import_metadata", startup("import_metadata", "import mwaqa.metadata")),
+            ("query_help", startup("query_help", "import sys, runpy\nsys.argv = ['mwaqa_query.py', '--help']\n"
+                                                 "try:\n    runpy.run_path('scripts/mwaqa_query.py', run_name='__main__')\n"
+                                                 "except SystemExit:\n    pass\n"))]
+
+
+def measure(run, repeat):
+    """
+    Run a benchmark once to warm up, then repeat times, and return its times, row count and peak memory.
+    """
+    nrows = run()
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        run()
+        times.append(default_timer() - start)
+
+    # Memory tracing slows things down, so it gets a run of its own.
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    median = float(np.median(times))
+    return {"rows": nrows,
+            "repeat": repeat,
+            "times": times,
+            "min": min(times),
+            "median": median,
+            "mean": sum(times) / len(times),
+            "rows_per_second": nrows / median if median > 0 else None,
+            "peak_memory_bytes": peak}
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"time": time.time(),
+            "commit": commit,
+            "mwaqa": mwaqa.__version__,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform()}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change in each benchmark's median time since the baseline results, and return the names of those
+    which are slower by more than tolerance (a fraction).
+    """
+    old = dict((b["name"], b) for b in baseline["benchmarks"])
+    regressions = []
+    for b in results["benchmarks"]:
+        if b["name"] not in old:
+            continue
+        change = b["median"] / old[b["name"]]["median"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(b["name"])
+            flag = "  REGRESSION"
+        print("%-16s %9.2f ms -> %9.2f ms  %+6.1f%%%s"
+              % (b["name"], old[b["name"]]["median"] * 1000, b["median"] * 1000, change * 100, flag),
+              file=sys.stderr)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000,
+                        help="The number of synthetic QA rows served, and fetched by each select. Default: %(default)s")
+    parser.add_argument("--find_rows", type=int, default=2000,
+                        help="The number of results fetched by each metadata query. Default: %(default)s")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="The delay the server adds to every request, in seconds. Default: %(default)s")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="The number of timed runs of each benchmark. Default: %(default)s")
+    parser.add_argument("-b", "--benchmark", action="append",
+                        help="Only run the named benchmark (may be given more than once).")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Write the results as JSON to this file. By default, they are printed.")
+    parser.add_argument("--compare", type=str,
+                        help="An earlier results file to compare the median times with.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="The fractional slow-down counted as a regression by --compare. Default: %(default)s")
+    args = parser.parse_args()
+
+    stand_in = server.start(nrows=args.rows, latency=args.latency)
+    # Writes are only sent to the MRO server; the stand-in accepts the prefix.
+    u.BASEURL = stand_in.baseurl + "mro/"
+    metadata.FINDURL = stand_in.findurl
+    # The stand-in accepts any key, so there's no need for a config file.
+    u.KEYS = {None: None, u.DEFAULTID: "benchmark"}
+
+    results = {"environment": environment(),
+               "parameters": {"rows": args.rows,
+                              "find_rows": args.find_rows,
+                              "latency": args.latency,
+                              "repeat": args.repeat},
+               "benchmarks": [],
+               "startup_modules": STARTUP}
+    for name, setup in benchmarks(args.rows, args.find_rows):
+        if args.benchmark and name not in args.benchmark:
+            continue
+        result = measure(setup(), args.repeat)
+        result["name"] = name
+        results["benchmarks"].append(result)
+        print("%-16s %8d rows  median %9.2f ms  %12.0f rows/s  peak %8.1f MB"
+              % (name, result["rows"], result["median"] * 1000, result["rows_per_second"] or 0,
+                 (result["peak_memory_bytes"] or 0) / 1e6),
+              file=sys.stderr)
+
+    if args.output:
+        with io.open(args.output, "w") as f:
+            f.write(str(json.dumps(results, indent=2, sort_keys=True)))
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.compare:
+        with io.open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            exit(1)
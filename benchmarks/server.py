@@ -0,0 +1,267 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+A local stand-in for the QA and metadata web services, serving synthetic data, for benchmarks.
+
+It implements quality/select, insert, update and delete, and metadata/find and obs, with the same request and
+response formats as the real services, over a configurable number of synthetic observations and with a
+configurable latency per request. Run it on its own with:
+
+    python benchmarks/server.py --rows 100000 --latency 0.02 --port 8000
+"""
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import threading
+
+import numpy as np
+
+# Python3
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+# Python2
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from mwaqa.constraints import evaluate
+from mwaqa.schema import QACOLUMNNAMES
+
+
+# The first synthetic obsid, and the spacing between observations in seconds.
+FIRSTOBSID = 1060000000
+SPACING = 120
+# The size of each chunk of a chunked response, in bytes.
+CHUNKSIZE = 1000
+# The coarse channels of every synthetic observation.
+CHANNELS = list(range(109, 133))
+
+
+def make_data(nrows, seed=0):
+    """
+    Return a dictionary of NumPy arrays holding nrows synthetic QA rows, with one array per QA column. About one in
+    ten of the QA values is null (None).
+    """
+    rng = np.random.RandomState(seed)
+    obsid = FIRSTOBSID + SPACING * np.arange(nrows, dtype=np.int64)
+
+    def nullable(values):
+        values = values.astype(object)
+        values[rng.rand(nrows) < 0.1] = None
+        return values
+
+    data = {"obsid": obsid,
+            "projectid": np.array(["G0009", "D0000", "G0010"], dtype=object)[obsid % 3],
+            "lowest_channel": np.array([57, 121, 133], dtype=np.int64)[obsid % 3],
+            "gridpoint_number": rng.randint(-1, 20, nrows),
+            "duration_seconds": np.full(nrows, 112, dtype=np.int64),
+            "eor_field": rng.randint(0, 3, nrows),
+            "calibration_qa": nullable(rng.randint(0, 3, nrows)),
+            "rts_cal_qa": nullable(rng.randint(0, 3, nrows)),
+            "noise_qa": nullable(rng.randint(0, 3, nrows)),
+            "iono_magnitude": nullable(np.round(rng.gamma(2.0, 2.0, nrows), 3)),
+            "iono_pca": nullable(np.round(rng.rand(nrows), 3)),
+            "iono_qa": nullable(rng.randint(0, 4, nrows)),
+            "window_power": nullable(np.round(rng.rand(nrows) * 1e10, 1)),
+            "iono_abs_tec": nullable(np.round(rng.rand(nrows) * 50, 3)),
+            "uvfits_path": np.array(["/astro/mwaeor/data/%d/%d.uvfits" % (o, o) for o in obsid], dtype=object),
+            "rts_cal_source": np.array(["3C444"] * nrows, dtype=object),
+            "rts_peel_source": np.array(["PKS0000"] * nrows, dtype=object),
+            "sourcelist": np.array(["srclist_pumav3_EoR0aegean_EoR1pietro+ForA_phase1+2.txt"] * nrows, dtype=object)}
+    return data
+
+
+def _python(value):
+    """
+    Convert a NumPy scalar into a plain Python value for JSON.
+    """
+    return value.item() if hasattr(value, "item") else value
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, nrows=10000, latency=0.0, seed=0, chunked=False):
+        HTTPServer.__init__(self, address, Handler)
+        self.latency = latency
+        # Send responses with chunked transfer encoding, rather than a Content-Length.
+        self.chunked = chunked
+        self.connections = 0
+        self.data = make_data(nrows, seed=seed)
+        self.nrows = nrows
+        self.requests = 0
+
+    @property
+    def baseurl(self):
+        return "http://%s:%d/" % self.server_address[:2]
+
+    @property
+    def findurl(self):
+        return self.baseurl + "metadata/find/?search=search"
+
+    def select(self, params):
+        constraints = json.loads(params.get("constraints", "null"))
+        columns = json.loads(params.get("column_list", "null")) or list(QACOLUMNNAMES)
+        limit = int(params.get("limit", 100))
+        try:
+            mask = evaluate(constraints, self.data)
+        except (ValueError, IndexError, TypeError, KeyError) as error:
+            return {"errors": {0: str(error)}, "success": False, "query": None}
+        index = np.flatnonzero(mask)
+        if params.get("desc") in ("1", "true", "True"):
+            index = index[::-1]
+        index = index[:limit]
+        column_values = [self.data[name][index].tolist() for name in columns]
+        return {"errors": {},
+                "success": True,
+                "query": "SELECT ... LIMIT %d" % limit,
+                "rows": [list(row) for row in zip(*column_values)]}
+
+    def find(self, params, extended):
+        obsid = self.data["obsid"]
+        lo = int(params.get("mintime") or 0)
+        hi = int(params.get("maxtime") or (obsid[-1] if len(obsid) else 0))
+        pagesize = int(params.get("pagesize") or 100)
+        index = np.flatnonzero((obsid >= lo) & (obsid <= hi))[:pagesize]
+        results = []
+        for i in index:
+            o = int(obsid[i])
+            if extended:
+                results.append({"mwas.starttime": o,
+                                "mwas.stoptime": o + 112,
+                                "mwas.creator": "DJacobs",
+                                "mwas.projectid": _python(self.data["projectid"][i]),
+                                "mwas.obsname": "high_season1_%d" % o,
+                                "sm.ra_pointing": 0.0,
+                                "sm.dec_pointing": -27.0,
+                                "mwas.ra_phase_center": 0.0,
+                                "mwas.dec_phase_center": -27.0,
+                                "sm.azimuth_pointing": 0.0,
+                                "sm.elevation_pointing": 90.0,
+                                "sm.gridpoint_number": _python(self.data["gridpoint_number"][i]),
+                                "local_sidereal_time_deg": (o % 86164) / 86164.0 * 360,
+                                "mwas.freq_res": 40,
+                                "mwas.int_time": 0.5,
+                                "mwas.mode": "HW_LFILES",
+                                "numfiles": 25,
+                                "rfs.frequencies": CHANNELS,
+                                "mwas.dataquality": 1,
+                                "mwas.dataqualitycomment": None})
+            else:
+                results.append([o, "high_season1_%d" % o, "DJacobs", _python(self.data["projectid"][i]), 0.0, -27.0])
+        return results
+
+    def respond(self, path, params):
+        # Writes are only sent to URLs on the MRO server (see util.insert), so accept an "mro/" prefix.
+        path = path.strip("/")
+        if path.startswith("mro/"):
+            path = path[len("mro/"):]
+        if path == "quality/select":
+            return self.select(params)
+        if path in ("quality/insert", "quality/update", "quality/delete"):
+            rows = json.loads(params["rows"]) if "rows" in params else [None]
+            return {"errors": {}, "success": True, "query": None, "rowcount": len(rows)}
+        if path == "metadata/find":
+            return self.find(params, extended="dict" in params)
+        if path == "metadata/obs":
+            return {"starttime": int(params.get("obs_id", 0)), "obsname": "high_season1"}
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self._handle(urlsplit(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self._handle(self.rfile.read(length).decode("utf-8"))
+
+    def _handle(self, query):
+        params = dict((k, v[0]) for k, v in parse_qs(query, keep_blank_values=True).items())
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        result = self.server.respond(urlsplit(self.path).path, params)
+        if result is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            body = gzip.compress(body) if hasattr(gzip, "compress") else _gzip(body)
+            self.send_header("Content-Encoding", "gzip")
+        if not self.server.chunked:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(0, len(body), CHUNKSIZE):
+            chunk = body[i:i + CHUNKSIZE]
+            self.wfile.write(("%x\r\n" % len(chunk)).encode("ascii") + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def _gzip(body):
+    import io
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+def start(nrows=10000, latency=0.0, port=0, seed=0, chunked=False):
+    """
+    Start a Server on a background thread, and return it. Its baseurl and findurl properties give the URLs to
+    patch into util.BASEURL and metadata.FINDURL.
+    """
+    server = Server(("127.0.0.1", port), nrows=nrows, latency=latency, seed=seed, chunked=chunked)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000,
+                        help="The number of synthetic observations. Default: %(default)s")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="The delay added to every request, in seconds. Default: %(default)s")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="The port to listen on. Default: %(default)s")
+    args = parser.parse_args()
+
+    server = Server(("127.0.0.1", args.port), nrows=args.rows, latency=args.latency)
+    print("Serving %d synthetic observations at %s" % (args.rows, server.baseurl))
+    server.serve_forever()
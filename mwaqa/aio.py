@@ -0,0 +1,418 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+asyncio counterparts of the functions in mwaqa.util and mwaqa.metadata.Query.
+
+This module needs Python 3.7 or later: it isn't importable on Python 2, and is the one part of the package outside
+its Python 2 and 3 support.
+
+Requests are made by the Client's own HTTP/1.1 connections, so they share the response cache (mwaqa.cache) with
+the rest of the package, but not its other layers: they aren't retried or subject to circuit breaking and deadlines
+(mwaqa.resilience), identical requests aren't coalesced (mwaqa.flight), they aren't sent through the daemon
+(mwaqa.daemon) or a proxy, and they aren't instrumented. Each request is bounded by the Client's timeout instead.
+"""
+
+import io
+import ssl
+import json
+import zlib
+import asyncio
+import logging
+from urllib.parse import urlencode, urlsplit, urljoin
+from urllib.error import HTTPError, URLError
+
+import mwaqa.util as u
+from mwaqa import cache, metadata
+from mwaqa.constraints import validate as validate_constraints
+
+
+logger = logging.getLogger("quality")
+
+# The default maximum number of requests a Client has in flight at once.
+MAXCONCURRENCY = 16
+# The default timeout (in seconds) for each request, including any redirects.
+TIMEOUT = 60
+# The maximum number of idle connections a Client keeps open to each host.
+MAXIDLE = 8
+MAXREDIRECTS = 5
+
+
+def _decode(data, encoding):
+    if encoding == "gzip":
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompress(data)
+    return data
+
+
+async def _read_head(reader, first=b""):
+    head = first + await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("iso-8859-1").split("\r\n")
+    version, status, reason = (lines[0].split(" ", 2) + [""])[:3]
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return version, int(status), reason, headers
+
+
+async def _read_body(reader, headers, method, status):
+    """
+    Read a response body, returning it and whether the connection can be re-used afterwards.
+    """
+    if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+        return b"", True
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                # Skip any trailers.
+                while (await reader.readline()) not in (b"\r\n", b""):
+                    pass
+                return b"".join(chunks), True
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"])), True
+    return await reader.read(), False
+
+
+class Client(object):
+    """
+    An asyncio client for the QA and metadata web services.
+
+    Connections to each host are kept alive and re-used, at most max_concurrency requests are in flight at once
+    (further requests wait their turn), and each request is abandoned with an asyncio.TimeoutError after timeout
+    seconds. Cancelling a task which is waiting on a request closes its connection.
+    """
+    def __init__(self, baseurl=None, findurl=None, max_concurrency=MAXCONCURRENCY, timeout=TIMEOUT, gzip=True):
+        """
+        :param baseurl: The base URL of the web services. Defaults to util.BASEURL at the time of each request.
+        :param findurl: The metadata/find URL used by Query.fetch. Defaults to metadata.FINDURL.
+        :param max_concurrency: The maximum number of requests in flight at once.
+        :param timeout: The timeout in seconds for each request, or None to wait forever.
+        :param gzip: Boolean - if True, ask for gzip-compressed responses.
+        """
+        self.baseurl = baseurl
+        self.findurl = findurl
+        self.timeout = timeout
+        self.gzip = gzip
+        self.max_concurrency = max_concurrency
+        # The semaphore and the connections belong to the event loop that created them; see _bind().
+        self._semaphore = None
+        self._idle = {}
+        self._loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Close every idle connection.
+        """
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _, writer in conns:
+                writer.close()
+
+    def _bind(self):
+        """
+        Create the semaphore and the idle connection pool in the running event loop, afresh if the client was last
+        used in another loop (e.g. by an earlier asyncio.run()).
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._idle, self._loop = {}, loop
+
+    async def _checkout(self, key):
+        conns = self._idle.get(key)
+        if conns:
+            return conns.pop(), True
+
+        scheme, netloc = key
+        parts = urlsplit("%s://%s" % (scheme, netloc))
+        if scheme == "https":
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 443,
+                                                           ssl=ssl.create_default_context())
+        else:
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        return (reader, writer), False
+
+    def _checkin(self, key, conn):
+        conns = self._idle.setdefault(key, [])
+        if len(conns) < MAXIDLE:
+            conns.append(conn)
+        else:
+            conn[1].close()
+
+    async def _request_once(self, url, method, body, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % parts.netloc]
+        lines += ["%s: %s" % (name, value) for name, value in headers.items()]
+        if body is not None:
+            lines.append("Content-Length: %d" % len(body))
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1") + (body or b"")
+
+        try:
+            (reader, writer), reused = await self._checkout(key)
+        except OSError as error:
+            raise URLError(error)
+        first = b""
+        try:
+            writer.write(request)
+            await writer.drain()
+            first = await reader.read(1)
+            if not first:
+                raise ConnectionResetError("The server closed the connection without a response.")
+            version, status, reason, response_headers = await _read_head(reader, first)
+            data, keep_alive = await _read_body(reader, response_headers, method, status)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as error:
+            writer.close()
+            # The server may have closed an idle keep-alive connection before the request reached it; if so (and none
+            # of the response arrived), try once more on a fresh one. Otherwise the server may have acted on the
+            # request, and a write mustn't be made twice.
+            if reused and not first and isinstance(error, (ConnectionResetError, BrokenPipeError)):
+                return await self._request_once(url, method, body, headers)
+            raise URLError(error)
+        except BaseException:
+            # e.g. cancellation or a timeout part-way through a response; the connection can't be re-used.
+            writer.close()
+            raise
+
+        if (keep_alive and version == "HTTP/1.1" and
+                response_headers.get("connection", "").lower() != "close"):
+            self._checkin(key, (reader, writer))
+        else:
+            writer.close()
+        return status, reason, response_headers, data
+
+    async def _request(self, url, method, body, headers):
+        all_headers = {"User-Agent": "mwaqa", "Connection": "keep-alive"}
+        if self.gzip:
+            all_headers["Accept-Encoding"] = "gzip"
+        if headers:
+            all_headers.update(headers)
+
+        for _ in range(MAXREDIRECTS + 1):
+            status, reason, response_headers, data = await self._request_once(url, method, body, all_headers)
+            if status in (301, 302, 303, 307, 308) and "location" in response_headers:
+                url = urljoin(url, response_headers["location"])
+                if status == 303:
+                    method, body = "GET", None
+                continue
+            break
+        else:
+            raise URLError("Too many redirects")
+
+        data = _decode(data, response_headers.get("content-encoding", "").lower())
+        if status >= 400:
+            raise HTTPError(url, status, reason, response_headers, io.BytesIO(data))
+        return data
+
+    async def request(self, url, method="GET", body=None, headers=None):
+        """
+        Make a request and return the (decompressed) body of the response as bytes, following redirects.
+
+        An HTTPError is raised for an error status, a URLError for a network problem, and an asyncio.TimeoutError if
+        the request takes longer than the client's timeout.
+        """
+        self._bind()
+        async with self._semaphore:
+            return await asyncio.wait_for(self._request(url, method, body, headers), self.timeout)
+
+    async def getmeta(self, servicetype="metadata", service="obs", params=None):
+        """
+        Awaitable version of util.getmeta; see that function for details.
+
+        As with util.getmeta, HTTP and network errors are printed and None is returned. Timeouts and cancellation
+        are raised.
+        """
+        data = urlencode(params) if params else ""
+        url = (self.baseurl or u.BASEURL) + servicetype + '/' + service + '?' + data
+        write = (servicetype + '/' + service) in cache.WRITESERVICES
+
+        if cache.ACTIVE is not None and not write:
+            result = cache.ACTIVE.get(url)
+            if result is not None:
+                return result
+
+        returnstring = ""
+        try:
+            returnstring = await self.request(url)
+            result = json.loads(returnstring)
+        except ValueError:   # Result isn't in JSON format
+            result = returnstring
+        except HTTPError as error:
+            print("HTTP error from server: code=%d, response:\n %s" % (error.code, error.read()))
+            return
+        except URLError as error:
+            print("URL or network error: %s" % error.reason)
+            return
+        finally:
+            if cache.ACTIVE is not None and write:
+                cache.ACTIVE.invalidate_for_write(url)
+
+        if cache.ACTIVE is not None and not write and isinstance(result, (dict, list)):
+            cache.ACTIVE.put(url, result)
+        return result
+
+    @staticmethod
+    def _secure_key(user_name, secure_key, call):
+        if u.KEYS is None:
+            u.load_config_options()
+        if secure_key is None:
+            secure_key = u.KEYS.get(user_name, "")
+        if "mro" not in u.BASEURL or not secure_key:
+            logger.critical("%s calls won't work without a valid user_name and secure_key, check the config file."
+                            % call)
+            return
+        return secure_key
+
+    @staticmethod
+    def _valid(constraints, call):
+        try:
+            validate_constraints(constraints)
+        except ValueError as error:
+            logger.critical("%s calls won't work with invalid constraints: %s" % (call, error))
+            return False
+        return True
+
+    async def select(self, constraints=None, column_list=None, pagesize=100, desc=False, user_name=u.DEFAULTID,
+                     secure_key=None):
+        """
+        Awaitable version of util.select; see that function for details.
+        """
+        if not self._valid(constraints, "SELECT"):
+            return
+        params = {"constraints": json.dumps(constraints),
+                  "column_list": json.dumps(column_list),
+                  "limit": pagesize,
+                  "user_name": user_name,
+                  "secure_key": secure_key}
+        if desc:
+            params["desc"] = 1
+        return await self.getmeta(servicetype="quality", service="select", params=params)
+
+    async def insert(self, row=None, user_name=u.DEFAULTID, secure_key=None):
+        """
+        Awaitable version of util.insert; see that function for details.
+        """
+        secure_key = self._secure_key(user_name, secure_key, "INSERT")
+        if secure_key is None:
+            return
+        return await self.getmeta(servicetype="quality", service="insert", params={"row": json.dumps(row),
+                                                                                   "user_name": user_name,
+                                                                                   "secure_key": secure_key})
+
+    async def update(self, constraints=None, data=None, user_name=u.DEFAULTID, secure_key=None):
+        """
+        Awaitable version of util.update; see that function for details.
+        """
+        secure_key = self._secure_key(user_name, secure_key, "UPDATE")
+        if secure_key is None or not self._valid(constraints, "UPDATE"):
+            return
+        return await self.getmeta(servicetype="quality", service="update", params={"constraints": json.dumps(constraints),
+                                                                                   "data": json.dumps(data),
+                                                                                   "user_name": user_name,
+                                                                                   "secure_key": secure_key})
+
+    async def delete(self, constraints=None, user_name=u.DEFAULTID, secure_key=None):
+        """
+        Awaitable version of util.delete; see that function for details.
+        """
+        secure_key = self._secure_key(user_name, secure_key, "DELETE")
+        if secure_key is None or not self._valid(constraints, "DELETE"):
+            return
+        return await self.getmeta(servicetype="quality", service="delete", params={"constraints": json.dumps(constraints),
+                                                                                   "user_name": user_name,
+                                                                                   "secure_key": secure_key})
+
+    async def find(self, url):
+        """
+        Fetch a metadata/find URL and return the decoded results, raising errors as metadata.Query.make_query does.
+        """
+        if cache.ACTIVE is not None:
+            results = cache.ACTIVE.get(url)
+            if results is not None:
+                return results
+
+        try:
+            results = json.loads((await self.request(url)).decode("utf-8"))
+        except HTTPError as error:
+            raise RuntimeError("HTTP error from server: code=%d" % error.code)
+        except URLError as error:
+            raise ValueError("URL or network error: %s" % error.reason)
+
+        if cache.ACTIVE is not None:
+            cache.ACTIVE.put(url, results)
+        return results
+
+
+class Query(metadata.Query):
+    """
+    A metadata.Query with an awaitable fetch() in place of make_query().
+    """
+    async def fetch(self, client=None, warn=True):
+        """
+        Make the query with the given Client (or the default client), and build self.table from the results.
+        """
+        client = client or default_client()
+        if client.findurl is not None:
+            self.url = self._url(self.params).replace(metadata.FINDURL, client.findurl, 1)
+        elif not hasattr(self, "url"):
+            self.params2url()
+
+        results = await client.find(self.url)
+        if warn and len(results) >= self.params["pagesize"]:
+            logger.warning("Query results may be truncated due to the pagesize parameter.")
+        self._build_table(results)
+        return self.table
+
+
+_default = None
+
+
+def default_client():
+    """
+    Return the Client used by the module-level functions, creating it on first use.
+    """
+    global _default
+    if _default is None:
+        _default = Client()
+    return _default
+
+
+async def getmeta(servicetype="metadata", service="obs", params=None):
+    return await default_client().getmeta(servicetype=servicetype, service=service, params=params)
+
+
+async def select(constraints=None, column_list=None, pagesize=100, desc=False, user_name=u.DEFAULTID,
+                 secure_key=None):
+    return await default_client().select(constraints=constraints, column_list=column_list, pagesize=pagesize,
+                                         desc=desc, user_name=user_name, secure_key=secure_key)
+
+
+async def insert(row=None, user_name=u.DEFAULTID, secure_key=None):
+    return await default_client().insert(row=row, user_name=user_name, secure_key=secure_key)
+
+
+async def update(constraints=None, data=None, user_name=u.DEFAULTID, secure_key=None):
+    return await default_client().update(constraints=constraints, data=data, user_name=user_name,
+                                         secure_key=secure_key)
+
+
+async def delete(constraints=None, user_name=u.DEFAULTID, secure_key=None):
+    return await default_client().delete(constraints=constraints, user_name=user_name, secure_key=secure_key)
@@ -0,0 +1,303 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Python3
+try:
+    from urllib.parse import urlsplit, parse_qsl, urlencode
+# Python2
+except ImportError:
+    from urlparse import urlsplit, parse_qsl
+    from urllib import urlencode
+
+
+logger = logging.getLogger("quality")
+
+# Where the cache database lives, if no path is given to enable().
+DEFAULTPATH = os.path.join(os.path.expanduser("~"), ".cache", "mwaqa", "responses.sqlite")
+# The default size budget of the cache, in bytes of compressed results.
+DEFAULTMAXBYTES = 256 * 1024 * 1024
+# How long (in seconds) results from each "servicetype/service" stay valid.
+DEFAULTTTLS = {"quality/select": 3600,
+               "metadata/find": 86400,
+               "metadata/obs": 7 * 86400}
+# The TTL of any service not listed in DEFAULTTTLS.
+DEFAULTTTL = 3600
+# Services that modify the database, and the cached services whose results they invalidate. Every cached result of
+# those services is dropped, not only those including the obsids written: which obsids a cached query covers can't
+# be told from its URL in general (e.g. constraints on other columns).
+WRITESERVICES = {"quality/insert": ("quality/select",),
+                 "quality/update": ("quality/select",),
+                 "quality/delete": ("quality/select",)}
+# The cache used by util.getmeta and metadata.Query, if enabled.
+ACTIVE = None
+
+
+def canonical_url(url):
+    """
+    Return the given URL with its query parameters sorted, so that equivalent requests map to the same cache entry.
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return "%s://%s%s?%s" % (parts.scheme, parts.netloc, parts.path.rstrip("/"), query)
+
+
+def cacheable(result):
+    """
+    Return True if a decoded service result should be cached. Failures (e.g. {"success": false, "errors": ...}) are
+    not, so that a transient server error isn't returned again until it expires.
+    """
+    if isinstance(result, dict):
+        return result.get("success", True) is not False and not result.get("errors")
+    return isinstance(result, list)
+
+
+def service_name(url):
+    """
+    Return the "servicetype/service" name for a service URL, e.g. "quality/select".
+    """
+    path = urlsplit(url).path.strip("/").split("/")
+    return "/".join(path[-2:])
+
+
+class ResponseCache(object):
+    """
+    A persistent cache of decoded service results, stored in an SQLite database.
+
+    Results are keyed by a hash of the canonicalised request URL, and stored as zlib-compressed JSON. Each entry
+    expires after the TTL of its service, and the least-recently-used entries are evicted whenever the total size of
+    the stored results exceeds max_bytes. Failed results are not stored (see cacheable()), and a write drops every
+    entry of the services it affects (see WRITESERVICES).
+    """
+    def __init__(self, path=DEFAULTPATH, max_bytes=DEFAULTMAXBYTES, ttls=None, default_ttl=DEFAULTTTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULTTTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+
+        if path != ":memory:" and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT PRIMARY KEY, "
+                         "service TEXT, "
+                         "created REAL, "
+                         "accessed REAL, "
+                         "size INTEGER, "
+                         "value BLOB)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_service ON responses (service)")
+        self._db.commit()
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha1(canonical_url(url).encode("utf-8")).hexdigest()
+
+    def ttl(self, service):
+        return self.ttls.get(service, self.default_ttl)
+
+    def get(self, url):
+        """
+        Return the cached result for url, or None if there is no valid entry.
+        """
+        service = service_name(url)
+        key = self._key(url)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT created, value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[0] > self.ttl(service):
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(bytes(row[1])).decode("utf-8"))
+
+    def put(self, url, result):
+        """
+        Store the result for url, evicting least-recently-used entries if the cache is over its size budget. Failed
+        results are ignored.
+        """
+        if not cacheable(result):
+            return
+        value = zlib.compress(json.dumps(result, separators=(",", ":")).encode("utf-8"))
+        if len(value) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                             (self._key(url), service_name(url), now, now, len(value), sqlite3.Binary(value)))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def invalidate(self, service=None):
+        """
+        Remove all entries for the given "servicetype/service" name, or every entry if service is None.
+        """
+        with self._lock:
+            if service is None:
+                self._db.execute("DELETE FROM responses")
+            else:
+                self._db.execute("DELETE FROM responses WHERE service = ?", (service,))
+            self._db.commit()
+
+    def invalidate_for_write(self, url):
+        """
+        Remove the entries made stale by a call to the write service at url (e.g. quality/update).
+        """
+        for service in WRITESERVICES.get(service_name(url), ()):
+            logger.debug("invalidating cached %s results" % service)
+            self.invalidate(service)
+
+    def size(self):
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class MemoryCache(object):
+    """
+    A cache of decoded service results held in memory, e.g. by a long-running process such as the mwaqa daemon,
+    with the same interface and TTLs as ResponseCache. Results are returned without copying them, so should not be
+    modified, and the least-recently-used entries are evicted whenever the total size of the results (as JSON)
+    exceeds max_bytes. As in ResponseCache, failed results are not stored, and writes drop whole services.
+    """
+    def __init__(self, max_bytes=DEFAULTMAXBYTES, ttls=None, default_ttl=DEFAULTTTL):
+        self.path = None
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULTTTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (service, created, size, result) for each canonical URL, least recently used first.
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def ttl(self, service):
+        return self.ttls.get(service, self.default_ttl)
+
+    def get(self, url):
+        """
+        Return the cached result for url, or None if there is no valid entry.
+        """
+        key = canonical_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[1] > self.ttl(entry[0]):
+                self.misses += 1
+                return None
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[3]
+
+    def put(self, url, result):
+        """
+        Store the result for url, evicting least-recently-used entries if the cache is over its size budget. Failed
+        results are ignored.
+        """
+        if not cacheable(result):
+            return
+        size = len(json.dumps(result, separators=(",", ":")))
+        if size > self.max_bytes:
+            return
+        key = canonical_url(url)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (service_name(url), time.time(), size, result)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def invalidate(self, service=None):
+        """
+        Remove all entries for the given "servicetype/service" name, or every entry if service is None.
+        """
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if service is None or entry[0] == service]:
+                self._remove(key)
+
+    def invalidate_for_write(self, url):
+        """
+        Remove the entries made stale by a call to the write service at url (e.g. quality/update).
+        """
+        for service in WRITESERVICES.get(service_name(url), ()):
+            self.invalidate(service)
+
+    def size(self):
+        with self._lock:
+            return self._size
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def close(self):
+        self.invalidate()
+
+
+def enable(path=DEFAULTPATH, max_bytes=DEFAULTMAXBYTES, ttls=None, default_ttl=DEFAULTTTL):
+    """
+    Cache the results of util.getmeta and metadata.Query calls in a ResponseCache, and return it.
+
+    :param path: The SQLite file to store the cache in.
+    :param max_bytes: The size budget of the cache, in bytes of compressed results.
+    :param ttls: A dictionary mapping "servicetype/service" names (e.g. "quality/select") to TTLs in seconds,
+                 overriding DEFAULTTTLS.
+    :param default_ttl: The TTL of services not listed in ttls or DEFAULTTTLS.
+    :return: The active ResponseCache.
+    """
+    global ACTIVE
+    disable()
+    ACTIVE = ResponseCache(path=path, max_bytes=max_bytes, ttls=ttls, default_ttl=default_ttl)
+    return ACTIVE
+
+
+def disable():
+    """
+    Stop caching service results.
+    """
+    global ACTIVE
+    if ACTIVE is not None:
+        ACTIVE.close()
+    ACTIVE = None
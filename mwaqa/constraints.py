@@ -0,0 +1,302 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import re
+import operator
+from numbers import Number
+
+from mwaqa.schema import QACOLUMNTYPES
+
+
+COMPARISONS = {"=": operator.eq,
+               "!=": operator.ne,
+               "<": operator.lt,
+               "<=": operator.le,
+               ">": operator.gt,
+               ">=": operator.ge}
+LOGICAL = ("and", "or")
+UNARY = ("not",)
+OPERATORS = tuple(COMPARISONS) + LOGICAL + UNARY + ("like",)
+
+SQLOPERATORS = {"=": "=",
+                "!=": "!=",
+                "<": "<",
+                "<=": "<=",
+                ">": ">",
+                ">=": ">=",
+                "like": "LIKE"}
+
+try:
+    _STRINGTYPES = (str, basestring)
+except NameError:
+    _STRINGTYPES = (str,)
+
+
+def _is_constraint(c):
+    return isinstance(c, (tuple, list)) and len(c) > 0 and c[0] in OPERATORS
+
+
+def validate(constraints, columns=None):
+    """
+    Check that constraints is a well-formed constraint tree, raising a ValueError describing the first problem
+    found. None (no constraints) is valid.
+
+    :param constraints: A nested list of constraints, in the format described for util.select.
+    :param columns: If given, a collection of the valid column names. The first argument of each comparison must
+                    then be one of these columns.
+    """
+    if constraints is None:
+        return
+    if not isinstance(constraints, (tuple, list)) or len(constraints) == 0:
+        raise ValueError("Expected a constraint list, got %r" % (constraints,))
+
+    op = constraints[0]
+    if op not in OPERATORS:
+        raise ValueError("Unknown constraint operator %r in %r" % (op, constraints))
+
+    nargs = 1 if op in UNARY else 2
+    if len(constraints) != nargs + 1:
+        raise ValueError("Operator %r takes %d argument(s), got %r" % (op, nargs, constraints))
+
+    if op in UNARY or op in LOGICAL:
+        for arg in constraints[1:]:
+            if not _is_constraint(arg):
+                raise ValueError("Operator %r takes constraints as arguments, got %r" % (op, arg))
+            validate(arg, columns)
+        return
+
+    for arg in constraints[1:]:
+        if arg is not None and not isinstance(arg, _STRINGTYPES + (Number,)):
+            raise ValueError("Operator %r takes column names or values as arguments, got %r" % (op, arg))
+    if columns is not None and constraints[1] not in columns:
+        raise ValueError("Unknown column %r in %r" % (constraints[1], constraints))
+    if op == "like" and not isinstance(constraints[2], _STRINGTYPES):
+        raise ValueError("Operator 'like' takes a string pattern, got %r" % (constraints[2],))
+
+
+def like_to_regex(pattern):
+    """
+    Translate an SQL LIKE pattern (where % matches any string, _ matches any character, and \\ escapes the next
+    character) into a compiled regular expression.
+    """
+    out = []
+    chars = iter(pattern)
+    for ch in chars:
+        if ch == "\\":
+            out.append(re.escape(next(chars, "\\")))
+        elif ch == "%":
+            out.append(".*")
+        elif ch == "_":
+            out.append(".")
+        else:
+            out.append(re.escape(ch))
+    return re.compile("".join(out) + r"\Z", re.DOTALL)
+
+
+def _length(data):
+    if hasattr(data, "colnames"):
+        return len(data)
+    for name in data:
+        return len(data[name])
+    return 0
+
+
+def _has_column(data, name):
+    if not isinstance(name, _STRINGTYPES):
+        return False
+    if hasattr(data, "colnames"):
+        return name in data.colnames
+    return name in data
+
+
+def _operand(data, arg, n):
+    """
+    Return the values of arg (a column of data, or a literal value) and a boolean mask of where they are null.
+    """
+    # NumPy is imported where it's needed, so that validate() and to_sql() are quick to import.
+    import numpy as np
+
+    if _has_column(data, arg):
+        column = data[arg]
+        null = np.ma.getmaskarray(column).copy()
+        values = np.asarray(np.ma.getdata(column))
+        if values.dtype.kind == "O":
+            null |= np.array([v is None for v in values], dtype=bool)
+        elif values.dtype.kind == "f":
+            null |= np.isnan(values)
+        return values, null
+    return arg, np.full(n, arg is None, dtype=bool)
+
+
+def _evaluate(constraints, data, n):
+    """
+    Return (true, null) masks for constraints over data; rows in neither mask are false.
+    """
+    import numpy as np
+
+    op = constraints[0]
+    if op == "not":
+        true, null = _evaluate(constraints[1], data, n)
+        return ~true & ~null, null
+    if op in LOGICAL:
+        left_true, left_null = _evaluate(constraints[1], data, n)
+        right_true, right_null = _evaluate(constraints[2], data, n)
+        left_false = ~left_true & ~left_null
+        right_false = ~right_true & ~right_null
+        if op == "and":
+            true = left_true & right_true
+            false = left_false | right_false
+        else:
+            true = left_true | right_true
+            false = left_false & right_false
+        return true, ~true & ~false
+
+    left, left_null = _operand(data, constraints[1], n)
+    right, right_null = _operand(data, constraints[2], n)
+    null = left_null | right_null
+    valid = ~null
+    true = np.zeros(n, dtype=bool)
+    if not valid.any():
+        return true, null
+
+    left = left[valid] if isinstance(left, np.ndarray) else left
+    right = right[valid] if isinstance(right, np.ndarray) else right
+    if op == "like":
+        if isinstance(left, np.ndarray) and not isinstance(right, np.ndarray):
+            if right == "%":
+                true[valid] = True
+            else:
+                regex = like_to_regex(right)
+                true[valid] = np.fromiter((regex.match(str(v)) is not None for v in left), dtype=bool,
+                                          count=len(left))
+        else:
+            lefts = np.broadcast_to(np.asarray(left, dtype=object), (int(valid.sum()),))
+            rights = np.broadcast_to(np.asarray(right, dtype=object), (int(valid.sum()),))
+            true[valid] = [like_to_regex(str(r)).match(str(l)) is not None for l, r in zip(lefts, rights)]
+    else:
+        true[valid] = COMPARISONS[op](left, right)
+    return true, null
+
+
+def evaluate(constraints, data):
+    """
+    Evaluate constraints against columnar data, returning a boolean mask of the rows satisfying them.
+
+    As in SQL, a comparison involving a null (None, NaN or masked) value is neither true nor false, so 'not' of
+    such a comparison is not true either.
+
+    :param constraints: A nested list of constraints, in the format described for util.select, or None (which
+                        selects every row). String arguments naming a column of data refer to that column.
+    :param data: An astropy Table, or a dictionary mapping column names to equal-length arrays.
+    :return: A boolean NumPy array, True for each row satisfying the constraints.
+    """
+    import numpy as np
+
+    n = _length(data)
+    if constraints is None:
+        return np.ones(n, dtype=bool)
+    validate(constraints)
+    return _evaluate(constraints, data, n)[0]
+
+
+def compile_constraints(constraints, columns=None):
+    """
+    Validate constraints once, and return a function which evaluates them against columnar data (as evaluate()
+    does).
+
+    :param constraints: A nested list of constraints, in the format described for util.select, or None.
+    :param columns: If given, a collection of the valid column names (see validate()).
+    :return: A function taking an astropy Table (or a dictionary of arrays) and returning a boolean mask.
+    """
+    validate(constraints, columns)
+    if constraints is None:
+        import numpy as np
+        return lambda data: np.ones(_length(data), dtype=bool)
+    return lambda data: _evaluate(constraints, data, _length(data))[0]
+
+
+def filter_table(table, constraints):
+    """
+    Return the rows of an astropy Table which satisfy constraints.
+    """
+    return table[evaluate(constraints, table)]
+
+
+def to_sql(constraints, columns=QACOLUMNTYPES):
+    """
+    Translate constraints into an SQL WHERE expression and a list of parameters to bind to it.
+
+    Arguments which are in columns are treated as column names, anything else is treated as a value.
+    """
+    if constraints is None:
+        return "1", []
+
+    op = constraints[0]
+    if op == "not":
+        sql, params = to_sql(constraints[1], columns)
+        return "(NOT %s)" % sql, params
+    if op in LOGICAL:
+        left, left_params = to_sql(constraints[1], columns)
+        right, right_params = to_sql(constraints[2], columns)
+        return "(%s %s %s)" % (left, op.upper(), right), left_params + right_params
+    if op not in SQLOPERATORS:
+        raise ValueError("Unknown constraint operator %r in %r" % (op, constraints))
+
+    terms, params = [], []
+    for arg in constraints[1:3]:
+        if isinstance(arg, _STRINGTYPES) and arg in columns:
+            terms.append('"%s"' % arg)
+        else:
+            terms.append("?")
+            params.append(arg)
+    return "(%s %s %s)" % (terms[0], SQLOPERATORS[op], terms[1]), params
+
+
+def _bound(constraint):
+    # Return ("lo", value) or ("hi", value) for an inclusive bound on obsid, or None.
+    if (isinstance(constraint, (tuple, list)) and len(constraint) == 3 and constraint[1] == "obsid"
+            and isinstance(constraint[2], Number) and not isinstance(constraint[2], bool)):
+        if constraint[0] == ">=":
+            return "lo", constraint[2]
+        if constraint[0] == "<=":
+            return "hi", constraint[2]
+    return None
+
+
+def obsid_range(constraints):
+    """
+    Split constraints which select an inclusive obsid range from further constraints, as util.select_sharded
+    builds them, i.e. one of
+
+        ("=", "obsid", x)
+        (">=", "obsid", lo) or ("<=", "obsid", hi)
+        ("and", (">=", "obsid", lo), ("<=", "obsid", hi))
+        ("and", <any of the above>, further)
+
+    :return: A tuple (lo, hi, further), where lo or hi is None if the range is open at that end and further is None
+             if there are no further constraints, or None if constraints are not of this form.
+    """
+    if not _is_constraint(constraints):
+        return None
+    op = constraints[0]
+    if op == "=" and len(constraints) == 3 and _bound((">=",) + tuple(constraints[1:])) is not None:
+        return constraints[2], constraints[2], None
+    bound = _bound(constraints)
+    if bound is not None:
+        return (bound[1], None, None) if bound[0] == "lo" else (None, bound[1], None)
+    if op != "and" or len(constraints) != 3:
+        return None
+
+    bounds = [_bound(c) for c in constraints[1:3]]
+    if all(bounds) and set(kind for kind, _ in bounds) == {"lo", "hi"}:
+        values = dict(bounds)
+        return values["lo"], values["hi"], None
+    inner = obsid_range(constraints[1])
+    if inner is not None and inner[2] is None:
+        return inner[0], inner[1], constraints[2]
+    return None
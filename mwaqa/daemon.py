@@ -0,0 +1,302 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+A long-running local process which makes QA and metadata requests on behalf of other processes, over a Unix
+socket, so that they share its open connections, the config file it has read, and an in-memory cache of recent
+results. Start it with scripts/mwaqa_daemon.py; the query scripts use it when given --daemon, and other programs
+after calling connect().
+
+Using the daemon is opt-in because it answers from its cache, so a result may be as old as the cache's lifetime for
+that service, whereas a query script run without --cache always fetches current results. A daemon left running
+should not silently change what a plain query returns.
+
+Requests and responses are single lines of JSON. A request names an operation ("ping", "getmeta", "find" or
+"stats") and its arguments, e.g.
+
+    {"op": "find", "url": "http://mro.mwa128t.org/metadata/find/?search=search&pagesize=10"}
+
+and the response holds either its "result", or an "error" message and the "type" of the exception raised.
+
+The "getmeta" and "find" operations are given the client's full HTTP(S) URL, and fetch exactly that, so a client is
+answered by the same server whether or not it uses the daemon. Writes are never made through the daemon.
+"""
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+from mwaqa import resilience
+
+# Python3
+try:
+    from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+# Python2
+except ImportError:
+    from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+# Python3
+try:
+    from urllib.parse import urlsplit
+# Python2
+except ImportError:
+    from urlparse import urlsplit
+
+
+logger = logging.getLogger("quality")
+
+# Where the daemon listens, unless the MWAQA_SOCKET environment variable says otherwise.
+DEFAULTPATH = os.environ.get("MWAQA_SOCKET",
+                             os.path.join(os.path.expanduser("~"), ".cache", "mwaqa", "daemon.sock"))
+# The longest wait (in seconds) to connect to the daemon, before giving up on it.
+CONNECTTIMEOUT = 0.5
+# The default size budget of the daemon's cache, in bytes of JSON.
+DEFAULTMAXBYTES = 512 * 1024 * 1024
+# Exceptions raised by the daemon which are raised again, with the same type, by the client.
+ERRORS = {"RuntimeError": RuntimeError,
+          "ValueError": ValueError,
+          "DeadlineExceeded": resilience.DeadlineExceeded,
+          "CircuitOpenError": resilience.CircuitOpenError}
+
+# The Client used by util.getmeta, util.iselect and metadata.Query, or None to make requests directly. See connect().
+ACTIVE = None
+
+
+class DaemonUnavailable(Exception):
+    """
+    Raised when the daemon can't be reached, or closes the connection; the request should be made directly instead.
+    """
+
+
+class Client(object):
+    """
+    A connection to the daemon from each thread that uses it.
+    """
+    def __init__(self, path=DEFAULTPATH, connect_timeout=CONNECTTIMEOUT):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.connect_timeout)
+            try:
+                sock.connect(self.path)
+            except socket.error:
+                sock.close()
+                raise
+            connection = self._local.connection = (sock, sock.makefile("rb"))
+        return connection
+
+    def _drop(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def request(self, op, **kwargs):
+        """
+        Send a request to the daemon, and return its result. Errors raised by the daemon are raised again here.
+
+        :param op: The operation: "ping", "getmeta", "find" or "stats".
+        :param kwargs: The arguments of the operation.
+        :return: The result.
+        """
+        message = json.dumps(dict(kwargs, op=op)).encode("utf-8") + b"\n"
+        deadline = resilience.current_deadline()
+        try:
+            sock, reader = self._connection()
+            sock.settimeout(None if deadline is None else max(deadline - time.time(), 0.001))
+            sock.sendall(message)
+            line = reader.readline()
+        except socket.timeout:
+            self._drop()
+            raise resilience.DeadlineExceeded("Deadline passed while waiting for the mwaqa daemon")
+        except (socket.error, IOError, OSError) as error:
+            self._drop()
+            raise DaemonUnavailable("%s: %s" % (self.path, error))
+        if not line:
+            self._drop()
+            raise DaemonUnavailable("%s: the daemon closed the connection" % self.path)
+
+        response = json.loads(line.decode("utf-8"))
+        if "error" in response:
+            raise ERRORS.get(response.get("type"), RuntimeError)(response["error"])
+        return response.get("result")
+
+    def ping(self):
+        return self.request("ping")
+
+    def stats(self):
+        return self.request("stats")
+
+    def close(self):
+        self._drop()
+
+
+def connect(path=DEFAULTPATH):
+    """
+    Send requests through the daemon listening at path from now on, if it is running. Return the Client, or None
+    if there is no daemon (in which case requests are made directly, as usual).
+    """
+    global ACTIVE
+    if not os.path.exists(path):
+        return None
+    client = Client(path)
+    try:
+        client.ping()
+    except (DaemonUnavailable, resilience.DeadlineExceeded) as error:
+        logger.debug("not using the mwaqa daemon: %s" % error)
+        return None
+    logger.debug("using the mwaqa daemon at %s" % path)
+    disconnect()
+    ACTIVE = client
+    return ACTIVE
+
+
+def disconnect():
+    """
+    Make requests directly, rather than through the daemon.
+    """
+    global ACTIVE
+    if ACTIVE is not None:
+        ACTIVE.close()
+    ACTIVE = None
+
+
+def forward(op, **kwargs):
+    """
+    Send a request to the active daemon, and return its result. If there is no daemon, or it has gone away, a
+    DaemonUnavailable is raised, and the caller should make the request itself.
+    """
+    client = ACTIVE
+    if client is None:
+        raise DaemonUnavailable("not connected to the mwaqa daemon")
+    try:
+        return client.request(op, **kwargs)
+    except DaemonUnavailable as error:
+        logger.warning("lost the mwaqa daemon (%s); making requests directly" % error)
+        disconnect()
+        raise
+
+
+def _checked_url(url):
+    """
+    Return url, or raise a ValueError if it isn't an HTTP or HTTPS URL.
+    """
+    if urlsplit(url).scheme not in ("http", "https"):
+        raise ValueError("The mwaqa daemon only fetches HTTP URLs, not %r." % (url,))
+    return url
+
+
+class Server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        UnixStreamServer.__init__(self, path, Handler)
+        self.started = time.time()
+        self.requests = 0
+
+    def dispatch(self, request):
+        import mwaqa.util as u
+        from mwaqa import cache, flight, metadata, transport
+
+        self.requests += 1
+        op = request.get("op")
+        if op == "ping":
+            return {"pid": os.getpid(), "uptime": time.time() - self.started}
+        if op == "getmeta":
+            # The client's URL is fetched exactly as given, so that it is answered by the server the client would
+            # have used itself, whatever the daemon's own BASEURL. Writes are made by the clients themselves, so
+            # that their results (and errors) go straight to them.
+            url = _checked_url(request["url"])
+            if cache.service_name(url) in cache.WRITESERVICES:
+                raise ValueError("The mwaqa daemon doesn't make %s requests." % cache.service_name(url))
+            return u._getmeta_url(url)
+        if op == "find":
+            return metadata.Query._fetch(_checked_url(request["url"]))
+        if op == "stats":
+            return {"requests": self.requests,
+                    "uptime": time.time() - self.started,
+                    "cache": {"hits": cache.ACTIVE.hits,
+                              "misses": cache.ACTIVE.misses,
+                              "entries": len(cache.ACTIVE),
+                              "bytes": cache.ACTIVE.size()} if cache.ACTIVE is not None else None,
+                    "flight": flight.ACTIVE.stats() if flight.ACTIVE is not None else None,
+                    "transport": transport.stats(),
+                    "resilience": resilience.stats()}
+        raise ValueError("Unknown mwaqa daemon operation %r" % (op,))
+
+
+class Handler(StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, b""):
+            try:
+                response = {"result": self.server.dispatch(json.loads(line.decode("utf-8")))}
+            except Exception as error:
+                logger.debug("mwaqa daemon request failed: %s: %s" % (type(error).__name__, error))
+                response = {"error": str(error), "type": type(error).__name__}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+def _running(path):
+    try:
+        Client(path).ping()
+        return True
+    except (DaemonUnavailable, resilience.DeadlineExceeded):
+        return False
+
+
+def serve(path=DEFAULTPATH, max_bytes=DEFAULTMAXBYTES, ttls=None):
+    """
+    Run the daemon, listening on a Unix socket at path, until it is interrupted.
+
+    The config file (see util.load_config_options) is read once, at startup, and results are cached in memory
+    (see cache.MemoryCache) for the TTLs of their services.
+
+    :param path: The Unix socket to listen on. Only the current user can connect to it.
+    :param max_bytes: The size budget of the cache, in bytes of JSON.
+    :param ttls: A dictionary mapping "servicetype/service" names to cache TTLs in seconds, overriding the defaults.
+    """
+    import mwaqa.util as u
+    from mwaqa import cache
+
+    # The daemon makes its own requests directly.
+    disconnect()
+
+    if os.path.exists(path):
+        if _running(path):
+            raise RuntimeError("The mwaqa daemon is already running at %s" % path)
+        os.unlink(path)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+
+    if any(os.path.exists(p) for p in u.CPPATH):
+        u.load_config_options()
+    cache.ACTIVE = cache.MemoryCache(max_bytes=max_bytes, ttls=ttls)
+
+    # Don't let anyone else connect, as requests can carry a secure_key.
+    umask = os.umask(0o177)
+    try:
+        server = Server(path)
+    finally:
+        os.umask(umask)
+    logger.info("mwaqa daemon listening at %s" % path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
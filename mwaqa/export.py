@@ -0,0 +1,532 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import io
+import os
+import sys
+import csv
+import logging
+
+
+logger = logging.getLogger("quality")
+
+# The value written for null (masked) integers in FITS and HDF5 files.
+INTNULL = -2 ** 63
+# Output formats, by file extension.
+EXTENSIONS = {".fits": "fits",
+              ".fit": "fits",
+              ".h5": "hdf5",
+              ".hdf5": "hdf5",
+              ".parquet": "parquet",
+              ".feather": "feather",
+              ".arrow": "feather",
+              ".csv": "csv",
+              ".tsv": "tsv"}
+# Results with at most this many rows are printed by the query scripts with print_rows(), which doesn't need astropy;
+# larger results are printed as an astropy table.
+PRINTROWS = 100
+# Binary columnar formats, and delimited text formats.
+FORMATS = ("fits", "hdf5", "parquet", "feather")
+TEXTFORMATS = ("csv", "tsv")
+# The number of rows copied at once when an HDF5 dataset is rewritten with wider strings.
+WIDENROWS = 100000
+
+
+def guess_format(path):
+    """
+    Return the output format implied by a file name's extension, or None if it isn't recognised.
+    """
+    return EXTENSIONS.get(os.path.splitext(str(path))[1].lower())
+
+
+def _fixed_dtype(table, string_width=None, byteorder=">"):
+    """
+    Return a fixed-width NumPy record dtype which can hold the rows of an astropy Table. Strings are stored as
+    string_width bytes, or as many bytes as the longest (UTF-8 encoded) string in the table if string_width is None.
+    """
+    # NumPy is imported where it's needed, so that writing CSV doesn't have to load it.
+    import numpy as np
+
+    fields = []
+    for name in table.colnames:
+        column = table[name]
+        kind = column.dtype.kind
+        shape = column.shape[1:]
+        if kind in "iu":
+            dtype = byteorder + "i8"
+        elif kind == "f":
+            dtype = byteorder + "f8"
+        elif kind == "b":
+            dtype = "?"
+        else:
+            width = string_width
+            if width is None:
+                width = max([len(str(v).encode("utf-8")) for v in np.ma.getdata(column).ravel()] or [1])
+            dtype = "S%d" % max(width, 1)
+        fields.append((name, dtype, shape) if shape else (name, dtype))
+    return np.dtype(fields)
+
+
+def _recast(records, dtype):
+    """
+    Copy records into a new array of dtype, which has the same fields with (possibly) wider strings.
+    """
+    import numpy as np
+
+    out = np.zeros(len(records), dtype=dtype)
+    for name in dtype.names:
+        if dtype[name].base.kind == "b":
+            # Copy the bytes, which FITSWriter has replaced with FITS logicals.
+            out[name].view(np.uint8)[...] = records[name].view(np.uint8)
+        else:
+            out[name] = records[name]
+    return out
+
+
+class _FixedWidthWriter(object):
+    """
+    Shared handling for formats with fixed-width records: converting each chunk to the record dtype chosen from the
+    first chunk, with nulls replaced by fill values.
+
+    If string_width is None, a chunk with longer strings than any before widens its columns, and the rows already
+    written are rewritten with the new dtype (by the subclass's _widen()). Otherwise, longer strings are truncated to
+    string_width bytes, with a warning.
+    """
+    def __init__(self, string_width=None, byteorder=">"):
+        self.string_width = string_width
+        self.byteorder = byteorder
+        self.dtype = None
+        self.nrows = 0
+        self._truncated = False
+
+    def _records(self, table):
+        import numpy as np
+
+        if self.dtype is None:
+            self.dtype = _fixed_dtype(table, self.string_width, self.byteorder)
+        if list(table.colnames) != list(self.dtype.names):
+            raise ValueError("Chunk columns %s don't match the first chunk's columns %s"
+                             % (table.colnames, list(self.dtype.names)))
+
+        strings = {}
+        fields = []
+        for name in table.colnames:
+            dtype = self.dtype[name]
+            if dtype.base.kind == "S":
+                column = table[name]
+                encoded = np.array([str(v).encode("utf-8") for v in np.ma.getdata(column).ravel()], dtype=object)
+                encoded[np.ma.getmaskarray(column).ravel()] = b""
+                strings[name] = encoded
+                width = max([len(v) for v in encoded] or [0])
+                if width > dtype.base.itemsize:
+                    if self.string_width is None:
+                        dtype = np.dtype(("S%d" % width, dtype.shape)) if dtype.shape else np.dtype("S%d" % width)
+                    elif not self._truncated:
+                        logger.warning("Strings in column %r are longer than %d bytes, and will be truncated."
+                                       % (name, dtype.base.itemsize))
+                        self._truncated = True
+            fields.append((name, dtype))
+        dtype = np.dtype(fields)
+        if dtype != self.dtype:
+            logger.debug("widening string columns to %s after %d rows" % (dtype, self.nrows))
+            if self.nrows:
+                self._widen(dtype)
+            self.dtype = dtype
+
+        records = np.zeros(len(table), dtype=self.dtype)
+        for name in table.colnames:
+            column = table[name]
+            mask = np.ma.getmaskarray(column)
+            values = np.ma.getdata(column)
+            kind = self.dtype[name].base.kind
+            if kind == "S":
+                width = self.dtype[name].base.itemsize
+                records[name] = strings[name].astype("S%d" % width).reshape(values.shape)
+            else:
+                records[name] = values
+                if mask.any():
+                    records[name][mask] = np.nan if kind == "f" else (INTNULL if kind == "i" else False)
+        return records
+
+    def _widen(self, dtype):
+        """
+        Rewrite the rows written so far with dtype.
+        """
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FITSWriter(_FixedWidthWriter):
+    """
+    Write chunks of a table to a FITS binary table, appending each chunk's rows to the file as it arrives. The row
+    count in the header is filled in when the writer is closed.
+
+    Null integers are written as INTNULL (declared with TNULL), and null floats as NaN. Booleans are written as FITS
+    logicals ("L"), and null booleans as the FITS null logical (a zero byte).
+    """
+    def __init__(self, path, string_width=None):
+        super(FITSWriter, self).__init__(string_width=string_width, byteorder=">")
+        self.path = path
+        self._file = io.open(path, "w+b")
+        self._header = None
+        self._header_offset = None
+        self._data_offset = None
+
+    def _start(self, records):
+        from astropy.io import fits
+
+        self._file.write(fits.PrimaryHDU().header.tostring().encode("ascii"))
+        self._header_offset = self._file.tell()
+        self._write_header(records)
+
+    def _write_header(self, records):
+        from astropy.io import fits
+
+        header = fits.BinTableHDU(data=records[:0]).header
+        for i, name in enumerate(records.dtype.names):
+            if records.dtype[name].base.kind == "i":
+                header["TNULL%d" % (i + 1)] = INTNULL
+        self._header = header
+        self._file.write(header.tostring().encode("ascii"))
+        self._data_offset = self._file.tell()
+
+    def _widen(self, dtype):
+        import numpy as np
+
+        self._file.seek(self._data_offset)
+        old = np.frombuffer(self._file.read(self.nrows * self.dtype.itemsize), dtype=self.dtype)
+        new = _recast(old, dtype)
+        self._file.seek(self._header_offset)
+        self._file.truncate()
+        self._write_header(new)
+        self._file.write(new.tobytes())
+
+    def write(self, table):
+        """
+        Append the rows of an astropy Table. Every chunk must have the same columns as the first.
+        """
+        import numpy as np
+
+        records = self._records(table)
+        if self._header is None:
+            self._start(records)
+        # NumPy booleans are bytes of 0 or 1, but FITS logicals are "T" or "F" (or 0 for null).
+        for name in records.dtype.names:
+            if records.dtype[name].base.kind == "b":
+                logical = np.where(records[name], ord("T"), ord("F")).astype(np.uint8)
+                logical[np.ma.getmaskarray(table[name])] = 0
+                records[name].view(np.uint8)[...] = logical
+        self._file.write(records.tobytes())
+        self.nrows += len(records)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._header is not None:
+            # Pad the data to a whole number of FITS blocks, then fill in the final row count.
+            self._file.write(b"\0" * (-self._file.tell() % 2880))
+            self._header["NAXIS2"] = self.nrows
+            self._file.seek(self._header_offset)
+            self._file.write(self._header.tostring().encode("ascii"))
+        self._file.close()
+
+
+class HDF5Writer(_FixedWidthWriter):
+    """
+    Write chunks of a table to a resizable, compressed dataset in an HDF5 file (this needs h5py), extending it as
+    each chunk arrives.
+
+    Null integers are written as INTNULL and null floats as NaN.
+    """
+    def __init__(self, path, dataset="data", string_width=None):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("Writing HDF5 files needs the h5py package.")
+        super(HDF5Writer, self).__init__(string_width=string_width, byteorder="<")
+        self.path = path
+        self._file = h5py.File(path, "w")
+        self._name = dataset
+        self._dataset = None
+
+    def write(self, table):
+        """
+        Append the rows of an astropy Table. Every chunk must have the same columns as the first.
+        """
+        records = self._records(table)
+        if self._dataset is None:
+            self._dataset = self._create(self._name, records.dtype)
+        self._dataset.resize((self.nrows + len(records),))
+        self._dataset[self.nrows:] = records
+        self.nrows += len(records)
+
+    def _create(self, name, dtype, nrows=0):
+        dataset = self._file.create_dataset(name, shape=(nrows,), maxshape=(None,), dtype=dtype, chunks=True,
+                                            compression="gzip")
+        dataset.attrs["int_null"] = INTNULL
+        return dataset
+
+    def _widen(self, dtype):
+        # The dtype of a dataset can't be changed, so copy the rows into a new one, a block at a time.
+        widened = self._create(self._name + ".widening", dtype, self.nrows)
+        for start in range(0, self.nrows, WIDENROWS):
+            widened[start:start + WIDENROWS] = _recast(self._dataset[start:start + WIDENROWS], dtype)
+        del self._file[self._name]
+        self._file.move(widened.name, self._name)
+        self._dataset = self._file[self._name]
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+def _arrow_table(table):
+    import numpy as np
+    import pyarrow as pa
+
+    arrays = []
+    for name in table.colnames:
+        column = table[name]
+        mask = np.ma.getmaskarray(column)
+        values = np.ma.getdata(column)
+        if values.dtype.kind in "OUS":
+            flat = [None if m else str(v) for v, m in zip(values.ravel(), mask.ravel())]
+            array = pa.array(flat, type=pa.string())
+        else:
+            array = pa.array(values.ravel(), mask=mask.ravel() if mask.any() else None)
+        if values.ndim > 1:
+            array = pa.FixedSizeListArray.from_arrays(array, int(np.prod(values.shape[1:])))
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=list(table.colnames))
+
+
+class ArrowWriter(object):
+    """
+    Write chunks of a table to a Parquet file (one row group per chunk) or a Feather (Arrow IPC) file (one record
+    batch per chunk), as each chunk arrives. This needs pyarrow. Nulls are stored as Arrow nulls.
+    """
+    def __init__(self, path, format="parquet", compression="zstd"):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("Writing %s files needs the pyarrow package." % format)
+        if format not in ("parquet", "feather"):
+            raise ValueError("Unknown Arrow format: %r" % (format,))
+        self.path = path
+        self.format = format
+        self.compression = compression
+        self.nrows = 0
+        self._schema = None
+        self._writer = None
+
+    def write(self, table):
+        """
+        Append the rows of an astropy Table. Every chunk must have the same columns as the first.
+        """
+        arrow = _arrow_table(table)
+        if self._writer is None:
+            self._schema = arrow.schema
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+                self._writer = pq.ParquetWriter(self.path, self._schema, compression=self.compression)
+            else:
+                import pyarrow as pa
+                options = pa.ipc.IpcWriteOptions(compression=self.compression)
+                self._writer = pa.ipc.new_file(self.path, self._schema, options=options)
+        else:
+            arrow = arrow.cast(self._schema)
+        self._writer.write_table(arrow)
+        self.nrows += len(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _text(value):
+    """
+    Format one value for a delimited text file: nulls are empty, and lists (e.g. coarse channels) look like
+    "[109, 110]".
+    """
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(_text(v) for v in value)
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _table_rows(table):
+    """
+    Yield the rows of an astropy Table as lists of Python values, with None for masked values.
+    """
+    import numpy as np
+
+    columns = []
+    for name in table.colnames:
+        column = table[name]
+        mask = np.ma.getmaskarray(column)
+        values = np.ma.getdata(column)
+        if values.ndim > 1:
+            columns.append([[v for v, m in zip(row, row_mask) if not m]
+                            for row, row_mask in zip(values.tolist(), mask.tolist())])
+        else:
+            columns.append([None if m else v for v, m in zip(values.tolist(), mask.tolist())])
+    return zip(*columns)
+
+
+class CSVWriter(object):
+    """
+    Write delimited text (CSV or TSV) to a file or stream as batches of rows arrive, without building a table
+    first. The header line is written before the first batch, and the output is flushed after each one, so that
+    (e.g.) a pipe into another program sees rows straight away.
+    """
+    def __init__(self, path, columns=None, delimiter=","):
+        """
+        :param path: The file to write, or an open text stream such as sys.stdout.
+        :param columns: The column names for the header. If None, the names of the first Table written are used.
+        :param delimiter: The field delimiter, e.g. "," or "\t".
+        """
+        if hasattr(path, "write"):
+            self._file = path
+            self._owned = False
+        else:
+            if sys.version_info[0] < 3:
+                self._file = open(path, "wb")
+            else:
+                self._file = io.open(path, "w", newline="")
+            self._owned = True
+        self.path = path
+        self.columns = list(columns) if columns is not None else None
+        self.nrows = 0
+        self._writer = csv.writer(self._file, delimiter=delimiter, lineterminator="\n")
+        self._started = False
+
+    def _encode(self, values):
+        if sys.version_info[0] < 3:
+            return [_text(v).encode("utf-8") for v in values]
+        return [_text(v) for v in values]
+
+    def _start(self):
+        if not self._started:
+            if self.columns is not None:
+                self._writer.writerow(self._encode(self.columns))
+            self._started = True
+
+    def write_rows(self, rows):
+        """
+        Append a batch of rows, where each row is a list of values (e.g. from util.iselect) in column order.
+        """
+        self._start()
+        for row in rows:
+            self._writer.writerow(self._encode(row))
+            self.nrows += 1
+        self._file.flush()
+
+    def write(self, table):
+        """
+        Append the rows of an astropy Table.
+        """
+        if self.columns is None:
+            self.columns = list(table.colnames)
+        self.write_rows(_table_rows(table))
+
+    def close(self):
+        self._start()
+        if self._owned:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_writer(path, format=None, **kwargs):
+    """
+    Open a writer which appends chunks of a table (as astropy Tables, with the same columns) to a binary columnar
+    or delimited text file. Use it as a context manager, or call close() when finished:
+
+        with open_writer("qa.parquet") as writer:
+            for rows in util.iselect(..., batch_size=10000):
+                writer.write(table_from_rows(rows, columns))
+
+    :param path: The file to write.
+    :param format: One of FORMATS ("fits", "hdf5", "parquet" or "feather") or TEXTFORMATS ("csv" or "tsv"), or
+                   None to guess from the extension.
+    :param kwargs: Passed to the writer, e.g. string_width for FITS and HDF5, or delimiter for CSV.
+    :return: The writer.
+    """
+    if format is None:
+        format = guess_format(path)
+    if format == "fits":
+        return FITSWriter(path, **kwargs)
+    if format == "hdf5":
+        return HDF5Writer(path, **kwargs)
+    if format in ("parquet", "feather"):
+        return ArrowWriter(path, format=format, **kwargs)
+    if format == "csv":
+        return CSVWriter(path, **kwargs)
+    if format == "tsv":
+        kwargs.setdefault("delimiter", "\t")
+        return CSVWriter(path, **kwargs)
+    raise ValueError("Unknown output format %r for %s; expected one of %s" % (format, path, FORMATS + TEXTFORMATS))
+
+
+def write_table(table, path, format=None, **kwargs):
+    """
+    Write a whole astropy Table to a binary columnar file; see open_writer().
+    """
+    with open_writer(path, format=format, **kwargs) as writer:
+        writer.write(table)
+
+
+def _shown(value):
+    """
+    Format one value for print_rows(): like _text(), but nulls are shown as "--", as astropy does.
+    """
+    if value is None:
+        return "--"
+    if isinstance(value, float):
+        return "%g" % value
+    return _text(value)
+
+
+def print_rows(rows, columns, file=None):
+    """
+    Print rows (lists of values in column order) as a plain text table with aligned columns, like astropy's
+    Table.pprint(), but without importing astropy or NumPy, which is much quicker for the small tables printed by
+    the query scripts.
+
+    :param rows: The rows to print, e.g. from util.select.
+    :param columns: The column names, for the header.
+    :param file: The stream to print to. Default: sys.stdout.
+    """
+    file = sys.stdout if file is None else file
+    lines = [[_shown(v) for v in row] for row in rows]
+    widths = [max([len(name)] + [len(line[i]) for line in lines]) for i, name in enumerate(columns)]
+    print(" ".join(name.rjust(width) for name, width in zip(columns, widths)), file=file)
+    print(" ".join("-" * width for width in widths), file=file)
+    for line in lines:
+        print(" ".join(value.rjust(width) for value, width in zip(line, widths)), file=file)
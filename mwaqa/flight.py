@@ -0,0 +1,145 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Coalesce identical requests made at the same time by several threads ("single flight"), so that only the first
+one goes to the network, and the others wait for and share its result.
+"""
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import time
+import logging
+import threading
+
+from mwaqa import instrument, resilience
+
+
+logger = logging.getLogger("quality")
+
+
+class Flight(object):
+    """
+    A call in progress, whose result (or error) is shared with every caller waiting for it.
+    """
+    def __init__(self, key, info=None):
+        self.key = key
+        self.info = info
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self):
+        """
+        Wait for the call to finish, and return its result or raise its error. If the waiting thread has a deadline
+        (see resilience.deadline), wait no longer than that, and then raise a DeadlineExceeded.
+        """
+        deadline = resilience.current_deadline()
+        if deadline is None:
+            self._done.wait()
+        elif not self._done.wait(max(deadline - time.time(), 0)):
+            raise resilience.DeadlineExceeded("Deadline passed while waiting for a shared request")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Group(object):
+    """
+    A set of calls in flight, keyed by (e.g.) their canonical URL.
+
+    The result of a shared call is the same object for every caller, so it should not be modified.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "shared": 0, "subsets": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """
+        Return a dictionary of counters: the calls made, the calls which shared a call already in flight, and the
+        calls answered from a larger one (see find).
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def do(self, key, func, info=None):
+        """
+        Return func(), unless a call with the same key is already in flight, in which case wait for it and return
+        its result (or raise its error) instead.
+
+        :param key: A hashable key identifying the call, e.g. its canonical URL.
+        :param func: A function of no arguments which makes the call.
+        :param info: A description of the call for find(), e.g. the obsid range it selects.
+        :return: The result of func(), or of the call already in flight.
+        """
+        with self._lock:
+            self._stats["calls"] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight(key, info)
+            else:
+                self._stats["shared"] += 1
+
+        if not leader:
+            instrument.note("coalesced", True)
+            return flight.wait()
+
+        try:
+            flight.result = func()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight._done.set()
+        return flight.result
+
+    def find(self, match):
+        """
+        Return a call in flight whose info satisfies match(info), or None. The caller can wait() for it, and answer
+        its own request from the result (e.g. when its own request selects a subset of the same rows).
+        """
+        with self._lock:
+            for flight in self._flights.values():
+                if flight.info is not None and match(flight.info):
+                    self._stats["subsets"] += 1
+                    return flight
+        return None
+
+
+# The group used by util.getmeta, util.select and metadata.Query, or None to make every request separately.
+ACTIVE = Group()
+
+
+def enable():
+    global ACTIVE
+    if ACTIVE is None:
+        ACTIVE = Group()
+    return ACTIVE
+
+
+def disable():
+    """
+    Make every request separately, even when an identical one is already in flight.
+    """
+    global ACTIVE
+    ACTIVE = None
+
+
+def do(key, func, info=None):
+    """
+    Call func() through the active group (see Group.do), or directly if coalescing is disabled.
+    """
+    if ACTIVE is None:
+        return func()
+    return ACTIVE.do(key, func, info=info)
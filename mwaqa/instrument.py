@@ -0,0 +1,298 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import io
+import re
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+from timeit import default_timer
+from contextlib import contextmanager
+
+
+logger = logging.getLogger("quality")
+
+# The timings (in seconds) kept in each record: the time to the first byte of the response, the whole request
+# (including any retries), decoding the JSON, building an astropy Table, and the whole call.
+TIMINGS = ("ttfb", "fetch", "decode", "table", "total")
+# Query parameters whose values are hidden in recorded URLs.
+SECRETPARAMS = ("secure_key",)
+_SECRETS = re.compile(r"((?:%s)=)[^&]*" % "|".join(SECRETPARAMS))
+
+# The sinks which receive a record of every instrumented call; nothing is recorded while this is empty.
+SINKS = []
+_local = threading.local()
+
+
+def add_sink(sink):
+    """
+    Send a record of every instrumented call to sink, which is a callable taking one dictionary, e.g. a LogSink,
+    JSONLinesSink or HistogramSink. Return the sink.
+    """
+    SINKS.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    if sink in SINKS:
+        SINKS.remove(sink)
+
+
+def redact(url):
+    """
+    Return url with the values of any SECRETPARAMS (e.g. secure_key) replaced by "***".
+    """
+    return _SECRETS.sub(r"\1***", url) if url else url
+
+
+def current():
+    """
+    Return the record of the call being made by this thread, or None if nothing is being recorded.
+    """
+    return getattr(_local, "record", None)
+
+
+def note(name, value):
+    """
+    Set a field of the current record, if there is one.
+    """
+    record = current()
+    if record is not None:
+        record[name] = value
+
+
+def add(name, value):
+    """
+    Add value to a numeric field (e.g. "bytes") of the current record, if there is one.
+    """
+    record = current()
+    if record is not None:
+        record[name] = record.get(name, 0) + value
+
+
+@contextmanager
+def timer(name):
+    """
+    Add the time taken by the block to the named timing of the current record, if there is one.
+    """
+    if current() is None:
+        yield
+        return
+    start = default_timer()
+    try:
+        yield
+    finally:
+        add(name, default_timer() - start)
+
+
+@contextmanager
+def span(call, service=None, url=None):
+    """
+    Record a call (e.g. "getmeta"), and send the record to every sink when the block exits. Fields are added to
+    the record with note(), add() and timer() by the code that runs inside the block, on the same thread.
+
+    A span inside another span on the same thread adds to the outer span's record, rather than making its own.
+    """
+    if not SINKS or current() is not None:
+        yield current()
+        return
+
+    record = {"call": call, "service": service, "url": url, "time": time.time()}
+    _local.record = record
+    start = default_timer()
+    try:
+        yield record
+    except BaseException as error:
+        record.setdefault("error", "%s: %s" % (type(error).__name__, error))
+        raise
+    finally:
+        _local.record = None
+        record["total"] = default_timer() - start
+        record["url"] = redact(record.get("url"))
+        emit(record)
+
+
+def traced(call):
+    """
+    A decorator which records every call of the function in a span.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not SINKS:
+                return func(*args, **kwargs)
+            with span(call):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_generator(call):
+    """
+    A decorator which records every call of a generator function in a span, which is active only while the
+    generator itself is running (not while its consumer handles each item), and is sent to the sinks once the
+    generator finishes or is closed. The time spent inside the generator is added to the "fetch" timing, as it
+    reads from the network and decodes as it goes.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not SINKS:
+                for item in func(*args, **kwargs):
+                    yield item
+                return
+
+            record = {"call": call, "service": None, "url": None, "time": time.time()}
+            start = default_timer()
+            generator = func(*args, **kwargs)
+            try:
+                while True:
+                    previous, _local.record = current(), record
+                    resumed = default_timer()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        add("fetch", default_timer() - resumed)
+                        _local.record = previous
+                    yield item
+            except BaseException as error:
+                if not isinstance(error, GeneratorExit):
+                    record.setdefault("error", "%s: %s" % (type(error).__name__, error))
+                raise
+            finally:
+                generator.close()
+                record["total"] = default_timer() - start
+                record["url"] = redact(record.get("url"))
+                emit(record)
+        return wrapper
+    return decorator
+
+
+def emit(record):
+    for sink in list(SINKS):
+        try:
+            sink(record)
+        except Exception as error:
+            logger.warning("instrumentation sink %r failed: %s" % (sink, error))
+
+
+class LogSink(object):
+    """
+    Log a one-line summary of each record.
+    """
+    def __init__(self, level=logging.DEBUG, logger=logger):
+        self.level = level
+        self.logger = logger
+
+    def __call__(self, record):
+        timings = " ".join("%s=%.1fms" % (name, record[name] * 1000) for name in TIMINGS if name in record)
+        self.logger.log(self.level, "%s %s: cache=%s rows=%s bytes=%s %s%s"
+                        % (record["call"], record.get("service") or "-", record.get("cache", "-"),
+                           record.get("rows", "-"), record.get("bytes", "-"), timings,
+                           " error=%s" % record["error"] if "error" in record else ""))
+
+
+class JSONLinesSink(object):
+    """
+    Append each record to a file (or stream) as one line of JSON.
+    """
+    def __init__(self, path):
+        if hasattr(path, "write"):
+            self._file = path
+            self._owned = False
+        else:
+            self._file = io.open(path, "a", encoding="utf-8")
+            self._owned = True
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self._file.write(str(line) + u"\n")
+            self._file.flush()
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class HistogramSink(object):
+    """
+    Keep the timings, row counts, byte counts and cache hits and misses of every record in memory, grouped by
+    call and service, for summary() and report().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.groups = {}
+
+    def __call__(self, record):
+        key = (record["call"], record.get("service") or "")
+        with self._lock:
+            group = self.groups.setdefault(key, {"calls": 0, "errors": 0, "hits": 0, "misses": 0, "rows": 0,
+                                                 "bytes": 0, "timings": dict((name, []) for name in TIMINGS)})
+            group["calls"] += 1
+            group["errors"] += "error" in record
+            group["hits"] += record.get("cache") == "hit"
+            group["misses"] += record.get("cache") == "miss"
+            group["rows"] += record.get("rows") or 0
+            group["bytes"] += record.get("bytes") or 0
+            for name in TIMINGS:
+                if name in record:
+                    group["timings"][name].append(record[name])
+
+    def summary(self):
+        """
+        Return a dictionary, keyed by (call, service), of the number of calls, errors, cache hits and misses, rows
+        and bytes, and for each timing the count, sum, mean, median, 95th percentile and maximum in seconds.
+        """
+        summary = {}
+        with self._lock:
+            for key, group in self.groups.items():
+                entry = dict((k, v) for k, v in group.items() if k != "timings")
+                for name, values in group["timings"].items():
+                    if values:
+                        entry[name] = {"count": len(values),
+                                       "sum": sum(values),
+                                       "mean": sum(values) / len(values),
+                                       "p50": _percentile(values, 0.5),
+                                       "p95": _percentile(values, 0.95),
+                                       "max": max(values)}
+                summary[key] = entry
+        return summary
+
+    def report(self, file=None):
+        """
+        Print a breakdown of where the time went, by call and service.
+        """
+        file = sys.stderr if file is None else file
+        summary = self.summary()
+        print("# mwaqa profile", file=file)
+        if not summary:
+            print("#   no service calls were made", file=file)
+        for (call, service), entry in sorted(summary.items()):
+            print("# %s%s: %d calls (%d errors), cache %d hits / %d misses, %d rows, %.1f kB received"
+                  % (call, " " + service if service else "", entry["calls"], entry["errors"], entry["hits"],
+                     entry["misses"], entry["rows"], entry["bytes"] / 1024),
+                  file=file)
+            for name in TIMINGS:
+                if name in entry:
+                    t = entry[name]
+                    print("#   %-6s  sum %9.1f ms  mean %8.1f ms  p50 %8.1f ms  p95 %8.1f ms  max %8.1f ms"
+                          % (name, t["sum"] * 1000, t["mean"] * 1000, t["p50"] * 1000, t["p95"] * 1000,
+                             t["max"] * 1000),
+                          file=file)
@@ -0,0 +1,350 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import mwaqa.util as u
+from mwaqa import resilience
+from mwaqa.obsids import MINOBSID, gps_now
+from mwaqa.schema import QACOLUMNNAMES
+
+
+logger = logging.getLogger("quality")
+
+# Where the checkpoint database lives, if no path is given.
+DEFAULTPATH = os.path.join(os.path.expanduser("~"), ".cache", "mwaqa", "jobs.sqlite")
+# The number of shards a job's range is initially split into. Each completed shard is checkpointed, so this is
+# also roughly how finely an interrupted job can resume.
+NSHARDS = 64
+
+
+class Job(object):
+    """
+    A bulk query, split into shards (sub-ranges of obsids, or of GPS times) which are fetched concurrently and
+    checkpointed in an SQLite database as each one completes.
+
+    A job is identified by its query and range, so creating the same job again (e.g. by re-running a script after a
+    crash) picks up its checkpoints, and run() fetches only the shards which are still missing. A shard which fills
+    a whole page is split in half and fetched again, and only the halves are checkpointed.
+
+    Subclasses define how a shard is fetched and how its rows become a table.
+    """
+    kind = None
+
+    def __init__(self, spec, min_value=None, max_value=None, nshards=NSHARDS, path=DEFAULTPATH):
+        """
+        :param spec: A JSON-serialisable description of the query (without its range).
+        :param min_value: The start of the (inclusive) range.
+        :param max_value: The end of the (inclusive) range, or None for the latest possible obsid when the job is
+                          first created; later runs of the same job keep the range it was created with.
+        :param nshards: The number of shards to initially split the range into.
+        :param path: The checkpoint database.
+        """
+        self.spec = spec
+        self.nshards = max(int(nshards), 1)
+        self.path = path
+        self.id = hashlib.sha1(json.dumps([self.kind, spec, min_value, max_value],
+                                          sort_keys=True).encode("utf-8")).hexdigest()
+
+        if path != ":memory:" and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, spec TEXT, "
+                         "min_value INTEGER, max_value INTEGER, created REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS shards (job TEXT, lo INTEGER, hi INTEGER, nrows INTEGER, "
+                         "data BLOB, finished REAL, PRIMARY KEY (job, lo))")
+
+        row = self._db.execute("SELECT min_value, max_value FROM jobs WHERE id = ?", (self.id,)).fetchone()
+        if row is None:
+            if min_value is None:
+                min_value = MINOBSID
+            if max_value is None:
+                max_value = gps_now()
+            if int(max_value) < int(min_value):
+                raise ValueError("The end of the range (%d) is before its start (%d)." % (max_value, min_value))
+            self._db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?)",
+                             (self.id, self.kind, json.dumps(spec, sort_keys=True), int(min_value), int(max_value),
+                              time.time()))
+            self._db.commit()
+            row = (int(min_value), int(max_value))
+        else:
+            logger.debug("resuming job %s" % self.id)
+        self.min_value, self.max_value = row
+
+    def _fetch_shard(self, lo, hi):
+        """
+        Fetch the rows in the inclusive range [lo, hi], and return them with a boolean which is True if they fill a
+        whole page (and so may be truncated).
+        """
+        raise NotImplementedError
+
+    def missing(self):
+        """
+        Return the parts of the job's range which haven't been fetched yet, as a list of inclusive (lo, hi)
+        shards.
+        """
+        with self._lock:
+            done = self._db.execute("SELECT lo, hi FROM shards WHERE job = ? ORDER BY lo", (self.id,)).fetchall()
+
+        gaps = []
+        start = self.min_value
+        for lo, hi in done:
+            if lo > start:
+                gaps.append((start, lo - 1))
+            start = max(start, hi + 1)
+        if start <= self.max_value:
+            gaps.append((start, self.max_value))
+
+        width = (self.max_value - self.min_value) // self.nshards + 1
+        shards = []
+        for lo, hi in gaps:
+            for start in range(lo, hi + 1, width):
+                shards.append((start, min(start + width - 1, hi)))
+        return shards
+
+    def complete(self):
+        """
+        Return True if every shard has been fetched.
+        """
+        return not self.missing()
+
+    def progress(self):
+        """
+        Return a dictionary with the number of shards and rows fetched so far, and the number of shards missing.
+        """
+        with self._lock:
+            shards, rows = self._db.execute("SELECT COUNT(*), COALESCE(SUM(nrows), 0) FROM shards WHERE job = ?",
+                                            (self.id,)).fetchone()
+        return {"shards": shards, "rows": rows, "missing": len(self.missing())}
+
+    def _store(self, lo, hi, rows):
+        data = zlib.compress(json.dumps(rows).encode("utf-8"))
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?, ?)",
+                             (self.id, lo, hi, len(rows), sqlite3.Binary(data), time.time()))
+            self._db.commit()
+
+    def run(self, max_workers=4):
+        """
+        Fetch every missing shard, with up to max_workers requests running at once, checkpointing each shard as it
+        completes. If a shard fails, the shards already in flight are still checkpointed before a RuntimeError is
+        raised; running the job again carries on from there.
+
+        :param max_workers: The maximum number of shards to fetch at once.
+        :return: The number of rows fetched by this run.
+        """
+        fetched = 0
+        error = None
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = {}
+
+            def submit(lo, hi):
+                pending[pool.submit(resilience.bind(self._fetch_shard), lo, hi)] = (lo, hi)
+
+            for lo, hi in self.missing():
+                submit(lo, hi)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    lo, hi = pending.pop(future)
+                    if future.cancelled():
+                        continue
+                    try:
+                        rows, full = future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = "shard %d-%d of job %s failed: %s" % (lo, hi, self.id, e)
+                            for f in pending:
+                                f.cancel()
+                        continue
+
+                    # A full page means the shard may be truncated; split it and fetch both halves instead.
+                    if full and hi > lo and error is None:
+                        mid = (lo + hi) // 2
+                        submit(lo, mid)
+                        submit(mid + 1, hi)
+                        continue
+                    if full and hi == lo:
+                        logger.warning("results for %d may be truncated due to the pagesize parameter." % lo)
+                    if not full or hi == lo:
+                        self._store(lo, hi, rows)
+                        fetched += len(rows)
+
+        if error is not None:
+            raise RuntimeError(error)
+        logger.debug("job %s fetched %d rows" % (self.id, fetched))
+        return fetched
+
+    def iter_batches(self):
+        """
+        Yield the rows of each checkpointed shard, as a list, in order of their ranges.
+        """
+        with self._lock:
+            los = [lo for lo, in self._db.execute("SELECT lo FROM shards WHERE job = ? ORDER BY lo", (self.id,))]
+        for lo in los:
+            with self._lock:
+                data, = self._db.execute("SELECT data FROM shards WHERE job = ? AND lo = ?", (self.id, lo)).fetchone()
+            yield json.loads(zlib.decompress(bytes(data)).decode("utf-8"))
+
+    def rows(self):
+        """
+        Return every checkpointed row, merged in order of the shards' ranges.
+        """
+        rows = []
+        for batch in self.iter_batches():
+            rows.extend(batch)
+        return rows
+
+    def _table(self, rows):
+        raise NotImplementedError
+
+    def _text_rows(self, rows):
+        return rows
+
+    def table(self):
+        """
+        Return every checkpointed row as an astropy Table.
+        """
+        return self._table(self.rows())
+
+    def export(self, output_filename, format=None, **kwargs):
+        """
+        Write every checkpointed row to a file (see mwaqa.export), one shard at a time.
+
+        :param output_filename: The file to write, or (for CSV and TSV) an open stream such as sys.stdout.
+        :param format: One of mwaqa.export.FORMATS or TEXTFORMATS, or None to guess from the file's extension.
+        :param kwargs: Passed to the writer (see mwaqa.export.open_writer).
+        :return: The number of rows written.
+        """
+        from mwaqa import export
+
+        if format in export.TEXTFORMATS:
+            kwargs.setdefault("columns", self.column_names)
+        nrows = 0
+        with export.open_writer(output_filename, format=format, **kwargs) as writer:
+            for rows in self.iter_batches():
+                if hasattr(writer, "write_rows"):
+                    writer.write_rows(self._text_rows(rows))
+                else:
+                    writer.write(self._table(rows))
+                nrows += len(rows)
+            if nrows == 0 and not hasattr(writer, "write_rows"):
+                writer.write(self._table([]))
+        return nrows
+
+    def discard(self):
+        """
+        Delete the job and its checkpoints.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM shards WHERE job = ?", (self.id,))
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (self.id,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SelectJob(Job):
+    """
+    A resumable util.select() of every row in an obsid range, e.g.
+
+        job = SelectJob(constraints=("=", "eor_field", 0), column_list=["obsid", "iono_qa"], min_obsid=1060000000)
+        job.run()
+        table = job.table()
+    """
+    kind = "quality/select"
+
+    def __init__(self, constraints=None, column_list=None, min_obsid=None, max_obsid=None, nshards=NSHARDS,
+                 pagesize=10000, path=DEFAULTPATH):
+        """
+        :param constraints: A nested list of constraints, in the format described for util.select, or None.
+        :param column_list: A list of column names to fetch, or None for every column.
+        :param min_obsid: The earliest obsid in the range, or None for the earliest possible obsid.
+        :param max_obsid: The latest obsid in the range, or None for the current GPS time.
+        :param nshards: The number of shards to initially split the range into.
+        :param pagesize: The maximum number of rows to request for each shard.
+        :param path: The checkpoint database.
+        """
+        self.constraints = constraints
+        self.column_list = list(column_list) if column_list is not None else list(QACOLUMNNAMES)
+        self.pagesize = pagesize
+        spec = {"constraints": constraints, "column_list": self.column_list, "pagesize": pagesize}
+        super(SelectJob, self).__init__(spec, min_obsid, max_obsid, nshards=nshards, path=path)
+
+    @property
+    def column_names(self):
+        return self.column_list
+
+    def _fetch_shard(self, lo, hi):
+        result = u.select(constraints=u._shard_constraints(self.constraints, lo, hi),
+                          column_list=self.column_list,
+                          pagesize=self.pagesize)
+        if result is None or not isinstance(result, dict) or not result.get("success", True):
+            errors = result.get("errors") if isinstance(result, dict) else result
+            raise RuntimeError("select failed: %s" % (errors,))
+        return result["rows"], len(result["rows"]) >= self.pagesize
+
+    def _table(self, rows):
+        from mwaqa.tables import table_from_rows
+        return table_from_rows(rows, self.column_list)
+
+
+class FindJob(Job):
+    """
+    A resumable metadata.Query over every observation between its mintime and maxtime parameters, e.g.
+
+        q = Query()
+        q.params.update(projectid="G0009", mintime=1060000000, maxtime=1100000000, pagesize=1000)
+        job = FindJob(q)
+        job.run()
+        q.table = job.table()
+    """
+    kind = "metadata/find"
+
+    def __init__(self, query, nshards=NSHARDS, path=DEFAULTPATH):
+        """
+        :param query: A metadata.Query, with both the mintime and maxtime parameters set.
+        :param nshards: The number of shards (time windows) to initially split the range into.
+        :param path: The checkpoint database.
+        """
+        try:
+            mintime = int(query.params["mintime"])
+            maxtime = int(query.params["maxtime"])
+        except (KeyError, ValueError):
+            raise ValueError("Find jobs need both mintime and maxtime to be specified.")
+        self.query = query
+        spec = {"params": dict((k, v) for k, v in query.params.items() if k not in ("mintime", "maxtime")),
+                "extended": query.extended}
+        super(FindJob, self).__init__(spec, mintime, maxtime, nshards=nshards, path=path)
+
+    @property
+    def column_names(self):
+        return self.query.column_names
+
+    def _fetch_shard(self, lo, hi):
+        params = dict(self.query.params, mintime=lo, maxtime=hi)
+        results = self.query._fetch(self.query._url(params))
+        return results, len(results) >= self.query.params["pagesize"]
+
+    def _table(self, rows):
+        return self.query._table(rows)
+
+    def _text_rows(self, rows):
+        return self.query._rows(rows)
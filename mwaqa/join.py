@@ -0,0 +1,255 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Join QA rows (from util.select) with observation metadata (from metadata.Query) on obsid, e.g.
+
+    from mwaqa import join
+    t = join.joined_table(min_obsid=1065880000, max_obsid=1065890000,
+                          qa_columns=["obsid", "iono_qa", "iono_magnitude"])
+    t["obsid", "iono_qa", "LST [deg]", "Freq. Chans"].pprint()
+
+Both services are queried at once, each constrained to the same obsids, and the results are joined locally.
+"""
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import mwaqa.util as u
+from mwaqa import instrument, metadata, resilience
+from mwaqa.obsids import gps_now
+from mwaqa.schema import QACOLUMNTYPES
+
+
+logger = logging.getLogger("quality")
+
+# The QA columns joined by default: those printed by mwaqa_query.py.
+QACOLUMNS = ("obsid", "projectid", "lowest_channel", "eor_field", "gridpoint_number", "iono_qa")
+# The kinds of join: keep only obsids found by both services, every QA row, or every row from either service.
+HOWS = ("inner", "left", "outer")
+# The join algorithms: "merge" needs both sides sorted by obsid, and "auto" uses it when they are.
+METHODS = ("auto", "hash", "merge")
+# The page size of each request to the QA and metadata services. Pages which fill up are split and requested again.
+QAPAGESIZE = 10000
+METADATAPAGESIZE = 1000
+
+
+def _is_sorted(rows, key):
+    return all(rows[i][key] <= rows[i + 1][key] for i in range(len(rows) - 1))
+
+
+def _hash_join(left, right, left_key, right_key, left_width, right_width, how):
+    # Index the right rows by key, and look up each left row in turn.
+    index = {}
+    for row in right:
+        index.setdefault(row[right_key], []).append(row)
+
+    joined = []
+    matched = set()
+    for row in left:
+        matches = index.get(row[left_key])
+        if matches:
+            matched.add(row[left_key])
+            for other in matches:
+                joined.append(list(row) + [v for i, v in enumerate(other) if i != right_key])
+        elif how != "inner":
+            joined.append(list(row) + [None] * (right_width - 1))
+
+    if how == "outer":
+        for row in right:
+            if row[right_key] not in matched:
+                joined.append(_right_only(row, left_key, right_key, left_width))
+    return joined
+
+
+def _merge_join(left, right, left_key, right_key, left_width, right_width, how):
+    # Walk both sorted lists together, a group of equal keys at a time.
+    joined = []
+    i = j = 0
+    while i < len(left) or j < len(right):
+        if j >= len(right) or (i < len(left) and left[i][left_key] < right[j][right_key]):
+            if how != "inner":
+                joined.append(list(left[i]) + [None] * (right_width - 1))
+            i += 1
+        elif i >= len(left) or right[j][right_key] < left[i][left_key]:
+            if how == "outer":
+                joined.append(_right_only(right[j], left_key, right_key, left_width))
+            j += 1
+        else:
+            key = left[i][left_key]
+            i_end, j_end = i, j
+            while i_end < len(left) and left[i_end][left_key] == key:
+                i_end += 1
+            while j_end < len(right) and right[j_end][right_key] == key:
+                j_end += 1
+            for row in left[i:i_end]:
+                for other in right[j:j_end]:
+                    joined.append(list(row) + [v for k, v in enumerate(other) if k != right_key])
+            i, j = i_end, j_end
+    return joined
+
+
+def _right_only(row, left_key, right_key, left_width):
+    padded = [None] * left_width
+    padded[left_key] = row[right_key]
+    return padded + [v for i, v in enumerate(row) if i != right_key]
+
+
+def join_rows(left, right, left_columns, right_columns, key="obsid", right_key=None, how="inner", method="auto"):
+    """
+    Join two lists of rows on equal values of a key column, and return the joined rows and their column names. Each
+    joined row holds the left row's values followed by the right row's (without its key column); values with no
+    matching row are None.
+
+    A hash join indexes the right rows by key, and keeps the order of the left rows, followed (for an outer join) by
+    the unmatched right rows. A merge join needs both lists sorted by key, and joins them in one pass without an
+    index, giving rows sorted by key.
+
+    :param left: A list of rows, where each row is a list of values, e.g. result['rows'] from util.select.
+    :param right: Another list of rows.
+    :param left_columns: The names of the left columns, in order.
+    :param right_columns: The names of the right columns, in order.
+    :param key: The name of the left key column.
+    :param right_key: The name of the right key column, if it differs from key (e.g. "Obsid" in metadata rows).
+    :param how: One of HOWS: "inner", "left" or "outer".
+    :param method: One of METHODS: "hash", "merge", or "auto" to merge if both lists are already sorted by key.
+    :return: A tuple of the joined rows and their column names.
+    """
+    if how not in HOWS:
+        raise ValueError("Unknown join %r; expected one of %s" % (how, HOWS))
+    if method not in METHODS:
+        raise ValueError("Unknown join method %r; expected one of %s" % (method, METHODS))
+    right_key = key if right_key is None else right_key
+    left_index = list(left_columns).index(key)
+    right_index = list(right_columns).index(right_key)
+    left = left if isinstance(left, list) else list(left)
+    right = right if isinstance(right, list) else list(right)
+
+    if method == "auto":
+        merge = _is_sorted(left, left_index) and _is_sorted(right, right_index)
+        method = "merge" if merge else "hash"
+    join = _merge_join if method == "merge" else _hash_join
+    rows = join(left, right, left_index, right_index, len(left_columns), len(right_columns), how)
+    columns = list(left_columns) + [name for name in right_columns if name != right_key]
+    return rows, columns
+
+
+def _qa_rows(obsids, min_obsid, max_obsid, column_list, constraints, max_workers, pagesize, user_name, secure_key):
+    if obsids is not None:
+        return u.select_obsids(obsids, column_list=column_list, constraints=constraints, max_workers=max_workers,
+                               pagesize=pagesize, user_name=user_name, secure_key=secure_key)["rows"]
+    return u.select_sharded(constraints=constraints, column_list=column_list, min_obsid=min_obsid,
+                            max_obsid=max_obsid, max_workers=max_workers, pagesize=pagesize, user_name=user_name,
+                            secure_key=secure_key)["rows"]
+
+
+def _metadata_rows(query, obsids, max_workers):
+    if obsids is not None:
+        from mwaqa import planner
+        from mwaqa.obsids import prune_rows
+
+        # Only a time range can be given to metadata/find, so request windows around each run of neighbouring
+        # obsids, and drop any other observations inside them.
+        results = query.paged_results(max_workers=max_workers, windows=planner.windows(obsids))
+        return prune_rows(query._rows(results), obsids)
+    return query._rows(query.paged_results(max_workers=max_workers))
+
+
+@instrument.traced("select_joined")
+def select_joined(obsids=None, min_obsid=None, max_obsid=None, qa_columns=QACOLUMNS, constraints=None, params=None,
+                  extended=True, how="inner", method="auto", max_workers=4, qa_pagesize=QAPAGESIZE,
+                  metadata_pagesize=METADATAPAGESIZE, user_name=u.DEFAULTID, secure_key=None):
+    """
+    Fetch QA rows and observation metadata for the same obsids at the same time, and join them on obsid.
+
+    The obsids (either a list, or the inclusive range [min_obsid, max_obsid]) are pushed down to both services, so
+    neither fetches observations outside them: the QA service is queried with select_obsids() or
+    select_sharded(), and the metadata service with a paged query over the same time range (or windows around the
+    listed obsids). Both sides are fetched completely, whatever their page sizes.
+
+    The joined rows hold the QA columns, followed by the metadata columns other than "Obsid".
+
+    :param obsids: A list of obsids to fetch, or None to fetch a range.
+    :param min_obsid: The earliest obsid in the range.
+    :param max_obsid: The latest obsid in the range. Default: now.
+    :param qa_columns: The QA columns to fetch. "obsid" is added if it is missing.
+    :param constraints: Further constraints on the QA rows, in the format described for util.select.
+    :param params: Further metadata/find parameters (as for metadata.Query.params), e.g. {"projectid": "G0009"}.
+    :param extended: Boolean - if True, fetch every metadata column, otherwise only the brief ones.
+    :param how: One of HOWS. "inner" keeps only obsids with both QA rows and metadata, "left" keeps every QA row,
+                and "outer" keeps every row from either service.
+    :param method: One of METHODS; see join_rows().
+    :param max_workers: The maximum number of requests to run at once to each service.
+    :param qa_pagesize: The page size of each QA request.
+    :param metadata_pagesize: The page size of each metadata request.
+    :param user_name: A project ID code (or a pseudo-ID), which the server ignores for SELECT queries.
+    :param secure_key: A password, which the server ignores for SELECT queries.
+    :return: A dictionary with the joined 'rows' (lists of values), and their 'columns'.
+    """
+    if obsids is None and min_obsid is None:
+        raise ValueError("select_joined needs a list of obsids, or min_obsid.")
+    if obsids is not None and (min_obsid is not None or max_obsid is not None):
+        raise ValueError("Cannot combine obsids with min_obsid or max_obsid.")
+    if obsids is not None:
+        obsids = [int(o) for o in obsids]
+        if not obsids:
+            raise ValueError("select_joined needs at least one obsid.")
+    else:
+        min_obsid = int(min_obsid)
+        max_obsid = gps_now() if max_obsid is None else int(max_obsid)
+
+    qa_columns = list(qa_columns)
+    if "obsid" not in qa_columns:
+        qa_columns.insert(0, "obsid")
+
+    query = metadata.Query(extended_results=extended, pagesize=metadata_pagesize)
+    query.params.update(params or {})
+    if obsids is None:
+        query.params.update(mintime=min_obsid, maxtime=max_obsid)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        qa = pool.submit(resilience.bind(_qa_rows), obsids, min_obsid, max_obsid, qa_columns, constraints,
+                         max_workers, qa_pagesize, user_name, secure_key)
+        meta = pool.submit(resilience.bind(_metadata_rows), query, obsids, max_workers)
+        qa_rows, metadata_rows = qa.result(), meta.result()
+
+    rows, columns = join_rows(qa_rows, metadata_rows, qa_columns, query.column_names, key="obsid",
+                              right_key="Obsid", how=how, method=method)
+    instrument.note("rows", len(rows))
+    logger.debug("select_joined: %d QA rows and %d metadata rows gave %d joined rows"
+                 % (len(qa_rows), len(metadata_rows), len(rows)))
+    return {"columns": columns, "rows": rows}
+
+
+def joined_table(*args, **kwargs):
+    """
+    Call select_joined() with the same arguments, and return the joined rows as an astropy Table, with typed
+    columns: the QA columns typed as in the QA schema, the metadata columns as in metadata.Query's tables, and
+    nulls masked.
+    """
+    from astropy.table import Table
+    from mwaqa.tables import typed_column
+
+    result = select_joined(*args, **kwargs)
+    kinds = dict(QACOLUMNTYPES)
+    kinds.update((name, kind) for _, name, kind in metadata.EXTENDEDCOLUMNS)
+    kinds.update(metadata.BRIEFCOLUMNS)
+
+    columns = []
+    for name, values in zip(result["columns"], _columns(result["rows"], len(result["columns"]))):
+        if kinds.get(name) is list:
+            columns.append(metadata.channels_column(name, values))
+        else:
+            columns.append(typed_column(name, values, kinds.get(name)))
+    return Table(columns)
+
+
+def _columns(rows, ncolumns):
+    if not rows:
+        return [[] for _ in range(ncolumns)]
+    return [list(values) for values in zip(*rows)]
@@ -8,21 +8,94 @@ from future.builtins import range, str
 
 import sys
 import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-import numpy as np
-from astropy.table import Table
-from astropy.io import ascii as ap_ascii
+from mwaqa import cache, daemon, flight, instrument, resilience, stream, transport
 
 # Python3
 try:
     from urllib.parse import urlencode
-    from urllib.request import urlopen
     from urllib.error import HTTPError, URLError
 
 # Python2
 except ImportError:
     from urllib import urlencode
-    from urllib2 import urlopen, HTTPError, URLError
+    from urllib2 import HTTPError, URLError
+
+
+FINDURL = "http://mro.mwa128t.org/metadata/find/?search=search"
+# The number of coarse channels in an observation; the coarse-channel column is
+# at least this wide, so that every chunk of an export has the same shape.
+COARSECHANNELS = 24
+
+# The columns of an extended query's table, in order: the key in each
+# result record, the column name, and the type of its values.
+EXTENDEDCOLUMNS = (("mwas.starttime", "Obsid", int),
+                   ("mwas.stoptime", "Stop Time", int),
+                   ("mwas.creator", "Creator", str),
+                   ("mwas.projectid", "ProjectID", str),
+                   ("mwas.obsname", "Obs. Name", str),
+                   ("sm.ra_pointing", "RA [deg]", float),
+                   ("sm.dec_pointing", "Dec [deg]", float),
+                   ("mwas.ra_phase_center", "Pointing RA [deg]", float),
+                   ("mwas.dec_phase_center", "Pointing Dec [deg]", float),
+                   ("sm.azimuth_pointing", "Azimuth [deg]", float),
+                   ("sm.elevation_pointing", "Elevation [deg]", float),
+                   ("sm.gridpoint_number", "Gridpoint", int),
+                   ("local_sidereal_time_deg", "LST [deg]", float),
+                   ("mwas.freq_res", "Freq. Res. [kHz]", float),
+                   ("mwas.int_time", "Int. Time [s]", float),
+                   ("mwas.mode", "Mode", str),
+                   ("numfiles", "Num. Files", int),
+                   ("rfs.frequencies", "Freq. Chans", list),
+                   ("mwas.dataquality", "Data Quality", int),
+                   ("mwas.dataqualitycomment", "Data Quality Comment", str))
+
+# The columns of a brief query's table, in order, with the type of their values.
+BRIEFCOLUMNS = (("Obsid", int),
+                ("Obs. Name", str),
+                ("Creator", str),
+                ("ProjectID", str),
+                ("RA [deg]", float),
+                ("Dec [deg]", float))
+
+
+def channels_column(name, channel_lists, min_width=COARSECHANNELS):
+    """
+    Build a 2D integer column from the coarse-channel list of each
+    observation. Lists shorter than the longest one (or min_width) are padded
+    with masked values.
+    """
+    # NumPy and astropy are imported where they're needed, as they are slow
+    # to import and aren't used by queries which don't build tables.
+    import numpy as np
+    from astropy.table import Column, MaskedColumn
+
+    width = max([len(c) for c in channel_lists if c] + [min_width])
+    data = np.zeros((len(channel_lists), width), dtype=np.int64)
+    mask = np.ones((len(channel_lists), width), dtype=bool)
+    for i, channels in enumerate(channel_lists):
+        if channels:
+            data[i, :len(channels)] = channels
+            mask[i, :len(channels)] = False
+    if mask.any():
+        return MaskedColumn(data, name=name, mask=mask)
+    return Column(data, name=name)
+
+
+def _via_daemon(url):
+    """
+    Fetch a page of results through the mwaqa daemon, if one is running, or return None if there is no daemon.
+    """
+    if daemon.ACTIVE is None:
+        return None
+    try:
+        with instrument.timer("fetch"):
+            results = daemon.forward("find", url=url)
+    except daemon.DaemonUnavailable:
+        return None
+    instrument.note("daemon", True)
+    return results
 
 
 def complete_parameters():
@@ -64,89 +137,286 @@ class Query(object):
         self.params["pagesize"] = pagesize
 
     def params2url(self):
-        u = "{0}&{1}".format("http://mro.mwa128t.org/metadata/find/?search=search",
-                             urlencode(self.params))
+        self.url = self._url(self.params)
+
+    def _url(self, params):
+        u = "{0}&{1}".format(FINDURL, urlencode(params))
         if self.extended:
             u += "&dict"
-        self.url = u
+        return u
+
+    @staticmethod
+    @instrument.traced("find_page")
+    def _fetch(url):
+        instrument.note("service", "metadata/find")
+        instrument.note("url", url)
+        if cache.ACTIVE is not None:
+            results = cache.ACTIVE.get(url)
+            instrument.note("cache", "miss" if results is None else "hit")
+            if results is not None:
+                instrument.note("rows", len(results))
+                return results
+
+        def fetch():
+            results = _via_daemon(url)
+            if results is not None:
+                if cache.ACTIVE is not None:
+                    cache.ACTIVE.put(url, results)
+                return results
+
+            try:
+                with instrument.timer("fetch"):
+                    body = resilience.call(lambda timeout: transport.request(url, timeout=timeout), url)
+                with instrument.timer("decode"):
+                    results = json.loads(body.decode("utf-8"))
+            except HTTPError as error:
+                raise RuntimeError("HTTP error from server: code=%d" % error.code)
+            except URLError as error:
+                raise ValueError("URL or network error: %s" % error.reason)
 
+            if cache.ACTIVE is not None:
+                cache.ACTIVE.put(url, results)
+            return results
+
+        # If another thread is already fetching the same page, share its results.
+        results = flight.do(("find", cache.canonical_url(url)), fetch)
+        instrument.note("rows", len(results))
+        return results
+
+    @instrument.traced_generator("iter_results")
+    def iter_results(self, batch_size=None):
+        """
+        Make the query, yielding each result as it is decoded from the
+        response (a dictionary in extended mode, or a list otherwise) rather
+        than building self.table. If batch_size is given, yield lists of up to
+        batch_size results instead.
+        """
+        if not hasattr(self, "url"):
+            self.params2url()
+        instrument.note("service", "metadata/find")
+        instrument.note("url", self.url)
+
+        results = cache.ACTIVE.get(self.url) if cache.ACTIVE is not None else None
+        if cache.ACTIVE is not None:
+            instrument.note("cache", "miss" if results is None else "hit")
+        if results is None:
+            # The daemon (if there is one) sends the whole page at once.
+            results = _via_daemon(self.url)
+        if results is None:
+            try:
+                url = self.url
+                response = resilience.call(lambda timeout: transport.open_url(url, timeout=timeout), url)
+            except HTTPError as error:
+                raise RuntimeError("HTTP error from server: code=%d" % error.code)
+            except URLError as error:
+                raise ValueError("URL or network error: %s" % error.reason)
+            results = stream.JSONArrayStream(response.iter_chunks())
+
+        if batch_size:
+            results = stream.batches(results, batch_size)
+        for item in results:
+            instrument.add("rows", len(item) if batch_size else 1)
+            yield item
+
+    @instrument.traced("make_query")
     def make_query(self, warn=True):
         if not hasattr(self, "url"):
             self.params2url()
 
-        try:
-            results = json.load(urlopen(self.url))
-        except HTTPError as error:
-            raise RuntimeError("HTTP error from server: code=%d" % error.code)
-        except URLError as error:
-            raise ValueError("URL or network error: %s" % error.reason)
+        results = self._fetch(self.url)
 
         # Warn if we've hit the pagesize limit of results.
         if warn and len(results) >= self.params["pagesize"]:
             print("Query results may be truncated due to the pagesize parameter.",
                   file=sys.stderr)
 
+        self._build_table(results)
+
+    @instrument.traced("make_paged_query")
+    def make_paged_query(self, window=None, max_workers=4, warn=True, windows=None):
+        """
+        Fetch the complete result set of the query, rather than a single page.
+
+        The [mintime, maxtime] range (inclusive, GPS seconds) is split into
+        adjacent sub-windows of `window` seconds (by default, one sub-window
+        per worker), and each sub-window is requested separately. Any
+        sub-window that fills a whole page is split in half and requested
+        again, until every page is complete. At most `max_workers` requests
+        are in flight at once. The pages are merged, in time order, into
+        self.table.
+
+        Alternatively, `windows` can be a list of inclusive (mintime, maxtime)
+        pairs to request instead (e.g. from mwaqa.planner.windows), in which
+        case the mintime and maxtime parameters are ignored.
+        """
+        self._build_table(self.paged_results(window=window, max_workers=max_workers, warn=warn, windows=windows))
+
+    def paged_results(self, window=None, max_workers=4, warn=True, windows=None):
+        """
+        Fetch the complete result set of the query like make_paged_query, but
+        return the results (dictionaries in extended mode, or lists otherwise),
+        in time order, rather than building self.table.
+        """
+        if windows is None:
+            try:
+                mintime = int(self.params["mintime"])
+                maxtime = int(self.params["maxtime"])
+            except ValueError:
+                raise ValueError("Paged queries need both mintime and maxtime to be specified.")
+            if maxtime < mintime:
+                raise ValueError("maxtime (%d) is earlier than mintime (%d)." % (maxtime, mintime))
+
+            if window is None:
+                window = (maxtime - mintime) // max_workers + 1
+            window = max(int(window), 1)
+            windows = [(lo, min(lo + window - 1, maxtime)) for lo in range(mintime, maxtime + 1, window)]
+
+        pagesize = self.params["pagesize"]
+        pages = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = {}
+
+            def submit(lo, hi):
+                params = dict(self.params, mintime=lo, maxtime=hi)
+                pending[pool.submit(resilience.bind(self._fetch), self._url(params))] = (lo, hi)
+
+            for lo, hi in windows:
+                submit(lo, hi)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    lo, hi = pending.pop(future)
+                    results = future.result()
+                    if len(results) >= pagesize and hi > lo:
+                        mid = (lo + hi) // 2
+                        submit(lo, mid)
+                        submit(mid + 1, hi)
+                        continue
+                    if warn and len(results) >= pagesize:
+                        print("Query results for %d may be truncated due to the pagesize parameter." % lo,
+                              file=sys.stderr)
+                    pages.append((lo, results))
+
+        results = []
+        for _, page in sorted(pages, key=lambda p: p[0]):
+            results.extend(page)
+        return results
+
+    def _build_table(self, results):
+        instrument.note("service", "metadata/find")
+        instrument.note("rows", len(results))
+        with instrument.timer("table"):
+            self.table = self._table(results)
+
+    def _table(self, results):
+        from astropy.table import Table
+        from mwaqa.tables import typed_column
+
         if self.extended:
-            columns = (('local_sidereal_time_deg', "LST [deg]"),
-                       ('mwas.creator', "Creator"),
-                       ('mwas.dataquality', "Data Quality"),
-                       ('mwas.dataqualitycomment', "Data Quality Comment"),
-                       ('mwas.dec_phase_center', "Pointing Dec [deg]"),
-                       ('mwas.freq_res', "Freq. Res. [kHz]"),
-                       ('mwas.int_time', "Int. Time [s]"),
-                       ('mwas.mode', "Mode"),
-                       ('mwas.obsname', "Obs. Name"),
-                       ('mwas.projectid', "ProjectID"),
-                       ('mwas.ra_phase_center', "Pointing RA [deg]"),
-                       ('mwas.starttime', "Obsid"),
-                       ('mwas.stoptime', "Stop Time"),
-                       ('numfiles', "Num. Files"),
-                       ('rfs.frequencies', "Freq. Chans"),
-                       ('sm.azimuth_pointing', "Azimuth [deg]"),
-                       ('sm.dec_pointing', "Dec [deg]"),
-                       ('sm.elevation_pointing', "Elevation [deg]"),
-                       ('sm.gridpoint_number', "Gridpoint"),
-                       ('sm.ra_pointing', "RA [deg]"))
-
-            # astropy doesn't know how to format the "Freq. Chans" column of the
-            # metadata (a list of ints for each frequency of the coarse-band
-            # channels). Just turn it into a string.
-            for r in results:
-                r["rfs.frequencies"] = str(r["rfs.frequencies"])
-            self.table = Table(results)
-            self.table.rename_columns(*list(zip(*columns)))
-            self.table = self.table["Obsid",
-                                    "Stop Time",
-                                    "Creator",
-                                    "ProjectID",
-                                    "Obs. Name",
-                                    "RA [deg]",
-                                    "Dec [deg]",
-                                    "Pointing RA [deg]",
-                                    "Pointing Dec [deg]",
-                                    "Azimuth [deg]",
-                                    "Elevation [deg]",
-                                    "Gridpoint",
-                                    "LST [deg]",
-                                    "Freq. Res. [kHz]",
-                                    "Int. Time [s]",
-                                    "Mode",
-                                    "Num. Files",
-                                    "Freq. Chans",
-                                    "Data Quality",
-                                    "Data Quality Comment",
-                                    ]
+            # Build each column straight from the records, already typed and
+            # in its final order.
+            columns = []
+            for key, name, kind in EXTENDEDCOLUMNS:
+                if key == "rfs.frequencies":
+                    columns.append(channels_column(name, [r.get(key) for r in results]))
+                else:
+                    columns.append(typed_column(name, [r.get(key) for r in results], kind))
+            return Table(columns)
         else:
-            columns = ("Obsid",
-                       "Obs. Name",
-                       "Creator",
-                       "ProjectID",
-                       "RA [deg]",
-                       "Dec [deg]")
-            self.table = Table(np.array(results), names=columns)
+            if results:
+                values = list(zip(*results))
+            else:
+                values = [[]] * len(BRIEFCOLUMNS)
+            return Table([typed_column(name, v, kind) for (name, kind), v in zip(BRIEFCOLUMNS, values)])
+
+    @property
+    def column_names(self):
+        if self.extended:
+            return [name for _, name, _ in EXTENDEDCOLUMNS]
+        return [name for name, _ in BRIEFCOLUMNS]
+
+    def _rows(self, results):
+        """
+        Return results as lists of values in column order, without building a
+        table.
+        """
+        if self.extended:
+            return [[r.get(key) for key, _, _ in EXTENDEDCOLUMNS] for r in results]
+        return results
+
+    def fetch_rows(self, warn=True):
+        """
+        Make the query and return its results as lists of values in the order
+        of column_names, without building self.table, so that neither astropy
+        nor NumPy needs to be imported.
+        """
+        rows = []
+        for results in self.iter_results(batch_size=10000):
+            rows.extend(self._rows(results))
+
+        # Warn if we've hit the pagesize limit of results.
+        if warn and len(rows) >= self.params["pagesize"]:
+            print("Query results may be truncated due to the pagesize parameter.",
+                  file=sys.stderr)
+        return rows
+
+    def flat_table(self):
+        """
+        Return self.table with the coarse-channel column turned into a string
+        (e.g. "[109, 110, ...]"), for formats which can't hold array columns,
+        such as CSV.
+        """
+        import numpy as np
+
+        table = self.table.copy(copy_data=False)
+        for name in table.colnames:
+            column = table[name]
+            if column.ndim > 1:
+                mask = np.ma.getmaskarray(column)
+                table[name] = [str([int(c) for c, m in zip(row, row_mask) if not m])
+                               for row, row_mask in zip(np.ma.getdata(column), mask)]
+        return table
+
+    def export(self, output_filename, format=None, batch_size=10000, warn=True, **kwargs):
+        """
+        Make the query and write its results to a binary columnar or
+        delimited text file (see mwaqa.export), converting and writing
+        batch_size results at a time as they are decoded, rather than building
+        self.table.
+
+        :param output_filename: The file to write, or (for CSV and TSV) an open stream such as sys.stdout.
+        :param format: One of mwaqa.export.FORMATS or TEXTFORMATS, or None to guess from the file's extension.
+        :param batch_size: The number of results to convert and write at a time.
+        :param kwargs: Passed to the writer (see mwaqa.export.open_writer).
+        :return: The number of results written.
+        """
+        from mwaqa import export
+
+        nresults = 0
+        if format in export.TEXTFORMATS:
+            kwargs.setdefault("columns", self.column_names)
+        with export.open_writer(output_filename, format=format, **kwargs) as writer:
+            for results in self.iter_results(batch_size=batch_size):
+                # Delimited text needs no table; write the values as they are.
+                if hasattr(writer, "write_rows"):
+                    writer.write_rows(self._rows(results))
+                else:
+                    writer.write(self._table(results))
+                nresults += len(results)
+            if nresults == 0 and not hasattr(writer, "write_rows"):
+                writer.write(self._table([]))
+
+        # Warn if we've hit the pagesize limit of results.
+        if warn and nresults >= self.params["pagesize"]:
+            print("Query results may be truncated due to the pagesize parameter.",
+                  file=sys.stderr)
+        return nresults
 
     def write_csv(self, output_filename):
-        ap_ascii.write(self.table,
+        from astropy.io import ascii as ap_ascii
+
+        ap_ascii.write(self.flat_table(),
                        output_filename,
                        overwrite=True,
                        delimiter=',')
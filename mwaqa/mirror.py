@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+import mwaqa.util as u
+from mwaqa import constraints as c
+from mwaqa.obsids import MINOBSID, gps_now
+from mwaqa.schema import QACOLUMNS, QACOLUMNNAMES, QACOLUMNTYPES
+
+
+logger = logging.getLogger("quality")
+
+# Where the mirror database lives, if no path is given.
+DEFAULTPATH = os.path.join(os.path.expanduser("~"), ".cache", "mwaqa", "mirror.sqlite")
+# Rows with obsids this close (in seconds) to the watermark are re-fetched by a re-check, as recent QA is still
+# being filled in.
+RECHECKSECONDS = 30 * 86400
+# How often (in seconds) sync() re-checks the recent rows.
+RECHECKINTERVAL = 86400
+# Columns which get an index in the mirror, in addition to obsid.
+INDEXEDCOLUMNS = ("projectid", "gridpoint_number", "eor_field", "lowest_channel")
+
+SQLTYPES = {int: "INTEGER",
+            float: "REAL",
+            str: "TEXT"}
+
+
+class Mirror(object):
+    """
+    A local, indexed copy of the QA table, stored in an SQLite database.
+
+    The mirror is filled by sync(), which fetches rows newer than the highest obsid already mirrored (the
+    watermark), and periodically re-fetches the rows close to the watermark. select() answers queries in the same
+    format as util.select() from the local copy.
+    """
+    def __init__(self, path=DEFAULTPATH):
+        self.path = path
+        if path != ":memory:" and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Match PostgreSQL, where LIKE is case sensitive.
+        self._db.execute("PRAGMA case_sensitive_like = ON")
+
+        columns = ", ".join('"%s" %s' % (name, SQLTYPES[kind]) for name, kind in QACOLUMNS)
+        self._db.execute("CREATE TABLE IF NOT EXISTS qa (%s, PRIMARY KEY (obsid))" % columns)
+        for name in INDEXEDCOLUMNS:
+            self._db.execute('CREATE INDEX IF NOT EXISTS "qa_%s" ON qa ("%s")' % (name, name))
+        self._db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)")
+        self._db.commit()
+
+    def _get_state(self, key, default=None):
+        row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_state(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+
+    def watermark(self):
+        """
+        Return the highest obsid in the mirror, or None if it is empty.
+        """
+        with self._lock:
+            return self._db.execute("SELECT MAX(obsid) FROM qa").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM qa").fetchone()[0]
+
+    def _store(self, rows, min_obsid=None, max_obsid=None):
+        """
+        Replace the mirrored rows between min_obsid and max_obsid (if given) with rows.
+        """
+        insert = "INSERT OR REPLACE INTO qa VALUES (%s)" % ", ".join("?" * len(QACOLUMNS))
+        with self._lock:
+            if min_obsid is not None:
+                self._db.execute("DELETE FROM qa WHERE obsid BETWEEN ? AND ?", (min_obsid, max_obsid))
+            self._db.executemany(insert, rows)
+            self._db.commit()
+
+    def _fetch(self, min_obsid, max_obsid, **kwargs):
+        return list(u.iselect_sharded(column_list=QACOLUMNNAMES,
+                                      min_obsid=min_obsid,
+                                      max_obsid=max_obsid,
+                                      **kwargs))
+
+    def sync(self, recheck_seconds=RECHECKSECONDS, recheck_interval=RECHECKINTERVAL, force_recheck=False,
+             nshards=8, max_workers=4, pagesize=10000):
+        """
+        Bring the mirror up to date with the QA database, and return the number of rows fetched.
+
+        Rows with obsids above the watermark are always fetched. If the last re-check was more than recheck_interval
+        seconds ago (or force_recheck is True), the rows within recheck_seconds of the watermark are also re-fetched
+        and replaced, so later changes to recent QA (and deleted rows) are picked up.
+
+        :param recheck_seconds: The width of the obsid range, below the watermark, to re-check.
+        :param recheck_interval: The minimum time in seconds between re-checks.
+        :param force_recheck: Boolean - if True, re-check regardless of when the last re-check was.
+        :param nshards: Passed to util.iselect_sharded.
+        :param max_workers: Passed to util.iselect_sharded.
+        :param pagesize: Passed to util.iselect_sharded.
+        :return: The number of rows fetched from the QA database.
+        """
+        kwargs = dict(nshards=nshards, max_workers=max_workers, pagesize=pagesize)
+        watermark = self.watermark()
+        now = time.time()
+        fetched = 0
+
+        with self._lock:
+            last_recheck = self._get_state("last_recheck", 0)
+        if watermark is not None and (force_recheck or now - last_recheck >= recheck_interval):
+            lo = max(watermark - recheck_seconds, MINOBSID)
+            logger.debug("re-checking mirrored obsids %d-%d" % (lo, watermark))
+            rows = self._fetch(lo, watermark, **kwargs)
+            self._store(rows, lo, watermark)
+            fetched += len(rows)
+            with self._lock:
+                self._set_state("last_recheck", now)
+                self._db.commit()
+
+        lo = MINOBSID if watermark is None else watermark + 1
+        hi = gps_now()
+        if lo <= hi:
+            logger.debug("fetching obsids %d-%d" % (lo, hi))
+            rows = self._fetch(lo, hi, **kwargs)
+            self._store(rows)
+            fetched += len(rows)
+            # The first sync fetches everything, so it also counts as a re-check.
+            if watermark is None:
+                with self._lock:
+                    self._set_state("last_recheck", now)
+                    self._db.commit()
+
+        logger.debug("mirror sync fetched %d rows" % fetched)
+        return fetched
+
+    def select(self, constraints=None, column_list=None, pagesize=100, desc=False):
+        """
+        Query the mirror with the same arguments and result format as util.select().
+
+        :param constraints: A nested list of constraints, in the format described for util.select.
+        :param column_list: A list of column names to return. All columns are returned if this is None.
+        :param pagesize: The maximum number of rows to return.
+        :param desc: Boolean - if False, sort the rows by obsid, if True, sort the rows in reverse order of obsid.
+        :return: The result dictionary, as returned by util.select.
+        """
+        if column_list is None:
+            column_list = QACOLUMNNAMES
+        for name in column_list:
+            if name not in QACOLUMNTYPES:
+                return {"errors": {0: "Unknown column: %s" % name}, "success": False, "query": None, "rows": []}
+        try:
+            c.validate(constraints)
+            where, params = c.to_sql(constraints)
+        except (ValueError, IndexError, TypeError) as error:
+            return {"errors": {0: str(error)}, "success": False, "query": None, "rows": []}
+
+        query = 'SELECT %s FROM qa WHERE %s ORDER BY obsid %s LIMIT ?' % (", ".join('"%s"' % c for c in column_list),
+                                                                        where,
+                                                                        "DESC" if desc else "ASC")
+        with self._lock:
+            rows = self._db.execute(query, params + [pagesize]).fetchall()
+        return {"errors": {},
+                "success": True,
+                "query": query,
+                "rows": [list(row) for row in rows]}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
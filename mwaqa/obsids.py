@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import numpy as np
+
+
+# The earliest obsid to look for, when a range has no start: obsids are GPS start times, and this is before the first
+# MWA observation (September 2011).
+MINOBSID = 1000000000
+
+
+def gps_now():
+    """
+    Return the current GPS time in whole seconds, which is the largest obsid that can exist. The leap seconds between
+    UTC and GPS time are taken from astropy's table, which is kept up to date.
+    """
+    # astropy is slow to import, and most queries have a complete obsid range.
+    from astropy.time import Time
+    return int(Time.now().gps)
+
+
+def load(filename):
+    """
+    Read a file of obsids (one per line, as accepted by np.loadtxt), and return them as a sorted, unique int64 array.
+    """
+    return np.unique(np.loadtxt(filename, dtype=np.int64, ndmin=1))
+
+
+def isin(values, obsids):
+    """
+    Return a boolean mask, True where each of values is one of obsids.
+
+    obsids are sorted once and looked up with a binary search, so this costs O((n + m) log m) rather than the
+    O(n * m) of testing each value against the list in turn.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    obsids = np.unique(np.asarray(obsids, dtype=np.int64))
+    if len(obsids) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(obsids, values)
+    positions[positions == len(obsids)] = 0
+    return obsids[positions] == values
+
+
+def prune_rows(rows, obsids, index=0):
+    """
+    Return the rows (e.g. result['rows'] from util.select) whose obsid is one of obsids, preserving their order.
+
+    :param rows: A list of rows, where each row is a list of values.
+    :param obsids: The obsids to keep.
+    :param index: The position of the obsid in each row.
+    :return: A new list of the rows to keep.
+    """
+    if not rows:
+        return []
+    keep = isin([row[index] for row in rows], obsids)
+    return [row for row, k in zip(rows, keep) if k]
+
+
+def prune_table(table, obsids, column="obsid"):
+    """
+    Return the rows of an astropy Table whose obsid is one of obsids.
+
+    :param table: The astropy Table to prune.
+    :param obsids: The obsids to keep.
+    :param column: The name of the column holding obsids, e.g. "Obsid" for metadata.Query tables.
+    :return: A new Table of the rows to keep.
+    """
+    return table[isin(table[column], obsids)]
@@ -0,0 +1,216 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import numpy as np
+
+
+# The typical spacing (in seconds) between consecutive obsids, used to estimate how many rows a range contains.
+OBSSPACING = 120
+# Estimated transfer cost (in bytes) of one result row.
+ROWBYTES = 150
+# Estimated cost (in bytes of URL) of an ("=", "obsid", ...) constraint.
+EQUALITYBYTES = 45
+# Estimated cost (in bytes of URL) of an obsid range constraint.
+RANGEBYTES = 100
+# Estimated fixed cost of a request (round trip latency and headers), in equivalent bytes.
+REQUESTBYTES = 20000
+# The maximum number of constraint terms combined into one request, to keep URLs to a sensible length.
+MAXTERMS = 100
+
+
+class Term(object):
+    """
+    One part of a query plan: either the inclusive obsid range [lo, hi] ("range"), or the listed obsids ("equal").
+    """
+    def __init__(self, kind, lo, hi, obsids):
+        self.kind = kind
+        self.lo = lo
+        self.hi = hi
+        self.obsids = obsids
+
+    def __repr__(self):
+        return "Term(%r, %d, %d, %d obsids)" % (self.kind, self.lo, self.hi, len(self.obsids))
+
+    def nterms(self):
+        """
+        The number of constraint terms this needs in a request.
+        """
+        return 1 if self.kind == "range" else len(self.obsids)
+
+    def constraints(self):
+        """
+        Return the constraint tree selecting this term's obsids, in the format described for util.select.
+        """
+        if self.kind == "range":
+            return ("and",
+                    (">=", "obsid", self.lo),
+                    ("<=", "obsid", self.hi))
+        return any_of([("=", "obsid", int(o)) for o in self.obsids])
+
+    def split(self):
+        """
+        Split this term into two halves, e.g. when its results do not fit in one page. A range of one obsid, or a
+        single equality, can't be split, and raises a ValueError.
+        """
+        if self.hi <= self.lo or (self.kind == "equal" and len(self.obsids) < 2):
+            raise ValueError("Can't split %r" % (self,))
+        if self.kind == "range":
+            mid = (self.lo + self.hi) // 2
+            inside = self.obsids[self.obsids <= mid]
+            return [Term("range", self.lo, mid, inside),
+                    Term("range", mid + 1, self.hi, self.obsids[self.obsids > mid])]
+        half = len(self.obsids) // 2
+        return [make_term("equal", self.obsids[:half]),
+                make_term("equal", self.obsids[half:])]
+
+
+def make_term(kind, obsids):
+    return Term(kind, int(obsids[0]), int(obsids[-1]), obsids)
+
+
+def any_of(constraints):
+    """
+    Combine constraints with 'or', as a balanced tree so that long lists do not nest deeply.
+    """
+    if len(constraints) == 1:
+        return constraints[0]
+    half = len(constraints) // 2
+    return ("or", any_of(constraints[:half]), any_of(constraints[half:]))
+
+
+class Plan(object):
+    """
+    A set of requests which together select every obsid in a list. Each request is a list of Terms, to be combined
+    with 'or'.
+    """
+    def __init__(self, strategy, requests, estimated_rows, cost):
+        self.strategy = strategy
+        self.requests = requests
+        self.estimated_rows = estimated_rows
+        self.cost = cost
+
+    def __repr__(self):
+        return "Plan(%r, %d requests, ~%d rows, cost %d)" % (self.strategy, len(self.requests),
+                                                             self.estimated_rows, self.cost)
+
+    def constraints(self):
+        """
+        Return the constraint tree for each request in the plan.
+        """
+        return [any_of([term.constraints() for term in request]) for request in self.requests]
+
+
+def estimate_rows(lo, hi, spacing=OBSSPACING):
+    """
+    Estimate the number of rows with obsids in the inclusive range [lo, hi].
+    """
+    return (hi - lo) // spacing + 1
+
+
+def clusters(obsids, spacing=OBSSPACING, row_bytes=ROWBYTES, range_bytes=RANGEBYTES):
+    """
+    Split obsids into runs of neighbours, where a run is broken wherever the rows expected in the gap would
+    cost more to download than a separate range constraint.
+
+    :return: A list of sorted int64 arrays, one per run.
+    """
+    obsids = np.unique(np.asarray(obsids, dtype=np.int64))
+    if len(obsids) == 0:
+        return []
+    extra_rows = np.diff(obsids) // spacing - 1
+    breaks = np.nonzero(extra_rows * row_bytes > range_bytes)[0] + 1
+    return np.split(obsids, breaks)
+
+
+def batch(terms, max_terms=MAXTERMS):
+    """
+    Group terms into requests of at most max_terms constraint terms each.
+    """
+    requests, current, size = [], [], 0
+    for term in terms:
+        for piece in _pieces(term, max_terms):
+            if current and size + piece.nterms() > max_terms:
+                requests.append(current)
+                current, size = [], 0
+            current.append(piece)
+            size += piece.nterms()
+    if current:
+        requests.append(current)
+    return requests
+
+
+def _pieces(term, max_terms):
+    """
+    Split a term into pieces of at most max_terms constraint terms each. Only equality terms can need more than one
+    constraint term; they are cut into runs of max_terms obsids, rather than halved, so that the pieces are full.
+    """
+    if term.nterms() <= max_terms:
+        return [term]
+    return [make_term("equal", term.obsids[i:i + max_terms]) for i in range(0, len(term.obsids), max_terms)]
+
+
+def plan(obsids, spacing=OBSSPACING, row_bytes=ROWBYTES, equality_bytes=EQUALITYBYTES, range_bytes=RANGEBYTES,
+         request_bytes=REQUESTBYTES, max_terms=MAXTERMS):
+    """
+    Choose the cheapest set of requests which select every obsid in a list.
+
+    Two strategies are costed: the single bounding range from the smallest to the largest obsid, and a clustered
+    plan in which each run of neighbouring obsids is fetched either as a tight range or as an 'or' of equalities
+    (whichever is cheaper), with the terms batched into requests of at most max_terms terms. Costs are estimated
+    in bytes, from the expected rows transferred, the size of the constraints and a fixed cost per request.
+
+    Range terms may return obsids which are not in the list, so the results should be pruned afterwards (see
+    obsids.prune_rows).
+
+    :param obsids: The obsids to select.
+    :param spacing: The typical spacing in seconds between consecutive obsids.
+    :param row_bytes: The estimated cost of transferring one row.
+    :param equality_bytes: The estimated cost of one ("=", "obsid", ...) constraint.
+    :param range_bytes: The estimated cost of one obsid range constraint.
+    :param request_bytes: The estimated fixed cost of one request.
+    :param max_terms: The maximum number of constraint terms in one request.
+    :return: The cheapest Plan.
+    """
+    runs = clusters(obsids, spacing=spacing, row_bytes=row_bytes, range_bytes=range_bytes)
+    if not runs:
+        return Plan("empty", [], 0, 0)
+
+    terms, clustered_rows, clustered_cost = [], 0, 0
+    for run in runs:
+        range_rows = max(estimate_rows(run[0], run[-1], spacing), len(run))
+        range_cost = range_bytes + range_rows * row_bytes
+        equal_cost = len(run) * (equality_bytes + row_bytes)
+        if len(run) > 1 and range_cost < equal_cost:
+            terms.append(make_term("range", run))
+            clustered_rows += range_rows
+            clustered_cost += range_cost
+        else:
+            terms.append(make_term("equal", run))
+            clustered_rows += len(run)
+            clustered_cost += equal_cost
+    requests = batch(terms, max_terms=max_terms)
+    clustered = Plan("clustered", requests, clustered_rows, clustered_cost + len(requests) * request_bytes)
+
+    everything = np.concatenate(runs)
+    bounding_rows = max(estimate_rows(everything[0], everything[-1], spacing), len(everything))
+    bounding = Plan("bounding",
+                    [[make_term("range", everything)]],
+                    bounding_rows,
+                    request_bytes + range_bytes + bounding_rows * row_bytes)
+
+    return min((clustered, bounding), key=lambda p: p.cost)
+
+
+def windows(obsids, spacing=OBSSPACING, row_bytes=ROWBYTES, request_bytes=REQUESTBYTES):
+    """
+    Return inclusive (mintime, maxtime) windows covering every obsid, for services (like metadata/find) which can
+    only be constrained by a time range. Each window is a separate request, so neighbouring obsids share a window
+    unless the rows expected in the gap between them would cost more than another request.
+    """
+    return [(int(run[0]), int(run[-1]))
+            for run in clusters(obsids, spacing=spacing, row_bytes=row_bytes, range_bytes=request_bytes)]
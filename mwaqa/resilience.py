@@ -0,0 +1,338 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+from mwaqa import instrument
+
+# Python3
+try:
+    from urllib.parse import urlsplit
+    from urllib.error import HTTPError, URLError
+# Python2
+except ImportError:
+    from urlparse import urlsplit
+    from urllib2 import HTTPError, URLError
+
+
+logger = logging.getLogger("quality")
+
+# The maximum number of attempts at each request, including the first.
+MAXATTEMPTS = 4
+# The backoff before the first retry, and the most it can grow to, in seconds. Each retry waits a random time of up
+# to BASEDELAY * 2**retry ("full jitter"), so that many clients retrying at once don't all hit the server together.
+BASEDELAY = 0.5
+MAXDELAY = 30.0
+# HTTP status codes which are worth retrying; any other HTTP error is returned straight away.
+RETRYSTATUSES = (408, 429, 500, 502, 503, 504)
+# The number of consecutive failed requests to a host which opens its circuit, and the number of seconds before a
+# single trial request is let through again.
+FAILURETHRESHOLD = 5
+RESETSECONDS = 30.0
+
+
+class CircuitOpenError(URLError):
+    """
+    Raised, without making a request, when a host's circuit is open after too many consecutive failures.
+    """
+
+
+class DeadlineExceeded(URLError):
+    """
+    Raised when there isn't enough time left before a deadline to make (or retry) a request.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Track consecutive failures of requests to one host. After failure_threshold failures the circuit opens and
+    requests are refused for reset_seconds; then one trial request is allowed through ("half open"), which closes
+    the circuit if it succeeds, or opens it again if it fails.
+    """
+    def __init__(self, failure_threshold=FAILURETHRESHOLD, reset_seconds=RESETSECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.time() - self.opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        """
+        Return True if a request may be made now.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.reset_seconds or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        """
+        Record a failed request, and return True if this opened the circuit.
+        """
+        with self._lock:
+            self.failures += 1
+            reopened = self._trial
+            self._trial = False
+            if reopened or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                return True
+            return False
+
+
+# The deadline (a time.time() value) of the requests being made by each thread; see deadline().
+_local = threading.local()
+
+
+def current_deadline():
+    """
+    Return the deadline set by deadline() for the current thread, or None.
+    """
+    return getattr(_local, "deadline", None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Give every request made inside this block (including retries and backoff) at most seconds to finish, in
+    total. Nested deadlines can only shorten the outer one. The deadline follows work handed to a thread pool
+    with bind().
+    """
+    previous = current_deadline()
+    _local.deadline = time.time() + seconds
+    if previous is not None:
+        _local.deadline = min(_local.deadline, previous)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = previous
+
+
+def bind(func):
+    """
+    Wrap func so that it runs under the current thread's deadline, e.g. when it is submitted to a thread pool.
+    """
+    bound = current_deadline()
+    if bound is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        previous = current_deadline()
+        _local.deadline = bound
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+    return wrapper
+
+
+class Policy(object):
+    """
+    Retry failed requests with exponential backoff and jitter, refuse requests to hosts whose circuit is open, and
+    stop once a deadline has passed.
+
+    Reads (e.g. select and find) are always retried. Writes (insert, update and delete) are only retried if
+    retry_writes is True, because a write which failed after reaching the server may already have been applied.
+    """
+    def __init__(self, max_attempts=MAXATTEMPTS, base_delay=BASEDELAY, max_delay=MAXDELAY, retry_writes=False,
+                 retry_statuses=RETRYSTATUSES, timeout=None, failure_threshold=FAILURETHRESHOLD,
+                 reset_seconds=RESETSECONDS):
+        """
+        :param max_attempts: The maximum number of attempts at each request, including the first.
+        :param base_delay: The backoff before the first retry, in seconds; it doubles with each retry.
+        :param max_delay: The longest backoff between two attempts, in seconds.
+        :param retry_writes: Boolean - if True, retry writes as well as reads.
+        :param retry_statuses: The HTTP status codes to retry.
+        :param timeout: The default deadline for each call, in seconds, or None for no deadline.
+        :param failure_threshold: The number of consecutive failures which opens a host's circuit.
+        :param reset_seconds: How long a host's circuit stays open before a trial request.
+        """
+        self.max_attempts = max(int(max_attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_writes = retry_writes
+        self.retry_statuses = tuple(retry_statuses)
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0,
+                       "attempts": 0,
+                       "retries": 0,
+                       "successes": 0,
+                       "failures": 0,
+                       "circuit_opened": 0,
+                       "circuit_rejected": 0,
+                       "deadline_exceeded": 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        """
+        Return a dictionary of counters: calls made, attempts (including retries), retries, calls which succeeded or
+        finally failed, circuits opened, requests refused by an open circuit, and calls stopped by a deadline.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def breaker(self, host):
+        """
+        Return the CircuitBreaker for a host (e.g. "ws.mwatelescope.org").
+        """
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+            return self._breakers[host]
+
+    def _retryable(self, error):
+        if isinstance(error, HTTPError):
+            return error.code in self.retry_statuses
+        return not isinstance(error, (CircuitOpenError, DeadlineExceeded))
+
+    def _backoff(self, retry, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        # Respect the server's Retry-After header (in seconds), if it sent one.
+        if isinstance(error, HTTPError) and error.headers is not None:
+            try:
+                delay = max(delay, min(float(error.headers.get("Retry-After")), self.max_delay))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    def call(self, request, url, write=False, timeout=None):
+        """
+        Call request(timeout) until it succeeds, the attempts run out, the error isn't worth retrying, or the
+        deadline passes, and return its result. The request is passed the number of seconds left before the
+        deadline (or None), to use as its socket timeout.
+
+        Errors are raised as HTTPError or URLError, like urlopen(): the last error from the request, a
+        CircuitOpenError if the host's circuit is open, or a DeadlineExceeded if there was no time left to try.
+
+        :param request: A function of one argument (the timeout), which makes the request.
+        :param url: The URL being requested, used to find its host's circuit breaker and for logging.
+        :param write: Boolean - True if the request changes data on the server.
+        :param timeout: A deadline for this call, in seconds, or None to use the policy's default.
+        :return: The result of request().
+        """
+        self._count("calls")
+        deadlines = [d for d in (current_deadline(),) if d is not None]
+        timeout = self.timeout if timeout is None else timeout
+        if timeout is not None:
+            deadlines.append(time.time() + timeout)
+        end = min(deadlines) if deadlines else None
+
+        parts = urlsplit(url)
+        breaker = self.breaker(parts.netloc)
+        attempts = self.max_attempts if (self.retry_writes or not write) else 1
+        for attempt in range(attempts):
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining <= 0:
+                self._count("deadline_exceeded")
+                self._count("failures")
+                raise DeadlineExceeded("Deadline passed before %s%s could be requested" % (parts.netloc, parts.path))
+            if not breaker.allow():
+                self._count("circuit_rejected")
+                self._count("failures")
+                raise CircuitOpenError("Too many failed requests to %s; not trying again for %g seconds"
+                                       % (parts.netloc, self.reset_seconds))
+
+            self._count("attempts")
+            instrument.add("attempts", 1)
+            try:
+                result = request(remaining)
+            except (HTTPError, URLError) as error:
+                # A client error (e.g. a bad request) says nothing about the health of the server.
+                opened = False
+                if not isinstance(error, HTTPError) or error.code >= 500 or error.code in self.retry_statuses:
+                    opened = breaker.record_failure()
+                    if opened:
+                        self._count("circuit_opened")
+                        logger.warning("opened the circuit for %s after %d failures" %
+                                       (parts.netloc, breaker.failures))
+                else:
+                    breaker.record_success()
+                if opened or attempt + 1 >= attempts or not self._retryable(error):
+                    self._count("failures")
+                    raise
+                delay = self._backoff(attempt, error)
+                if end is not None and time.time() + delay >= end:
+                    self._count("deadline_exceeded")
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                # Log the path only; the query string can hold a secure_key.
+                logger.warning("request to %s%s failed (%s); retrying in %.2f seconds (attempt %d of %d)" %
+                               (parts.netloc, parts.path, error, delay, attempt + 2, attempts))
+                time.sleep(delay)
+            else:
+                breaker.record_success()
+                self._count("successes")
+                return result
+
+
+# The policy used by util.getmeta and metadata.Query, or None to make each request just once. See configure().
+ACTIVE = Policy()
+
+
+def configure(**kwargs):
+    """
+    Replace the active policy with a new Policy(**kwargs), and return it, e.g.
+    configure(max_attempts=8, retry_writes=True, timeout=600).
+    """
+    global ACTIVE
+    ACTIVE = Policy(**kwargs)
+    return ACTIVE
+
+
+def disable():
+    """
+    Make each request just once, without retries or circuit breaking.
+    """
+    global ACTIVE
+    ACTIVE = None
+
+
+def call(request, url, write=False, timeout=None):
+    """
+    Make a request with the active policy (see Policy.call), or just once if there isn't one.
+    """
+    if ACTIVE is None:
+        return request(timeout)
+    return ACTIVE.call(request, url, write=write, timeout=timeout)
+
+
+def stats():
+    """
+    Return the counters of the active policy (see Policy.stats), or an empty dictionary.
+    """
+    return ACTIVE.stats() if ACTIVE is not None else {}
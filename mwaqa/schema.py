@@ -0,0 +1,31 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+
+# Columns in the QA database, in table order, with the Python type of their (non-null) values.
+QACOLUMNS = (("obsid", int),
+             ("projectid", str),
+             ("lowest_channel", int),
+             ("gridpoint_number", int),
+             ("duration_seconds", int),
+             ("eor_field", int),
+             ("calibration_qa", float),
+             ("rts_cal_qa", float),
+             ("noise_qa", float),
+             ("iono_magnitude", float),
+             ("iono_pca", float),
+             ("iono_qa", int),
+             ("window_power", float),
+             ("iono_abs_tec", float),
+             ("uvfits_path", str),
+             ("rts_cal_source", str),
+             ("rts_peel_source", str),
+             ("sourcelist", str))
+
+QACOLUMNNAMES = tuple(name for name, _ in QACOLUMNS)
+QACOLUMNTYPES = dict(QACOLUMNS)
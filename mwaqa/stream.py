@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import json
+import codecs
+
+
+# Trim the parsed part of the buffer once it is longer than this many characters.
+TRIMSIZE = 1024 * 1024
+_WHITESPACE = " \t\n\r"
+# Characters which can continue a JSON number.
+_NUMBERCHARS = "0123456789eE.+-"
+
+
+class JSONArrayStream(object):
+    """
+    Incrementally decode the items of a JSON array from a stream of chunks of bytes, yielding each item as soon as
+    it has been received, without holding the whole document in memory.
+
+    The array is either the whole document (key=None, e.g. for metadata/find), or the value of the given key in a
+    top-level JSON object (e.g. key="rows" for quality/select). The object's other keys are decoded into the meta
+    dictionary, which is complete once iteration has finished. If the object has no such key, no items are yielded.
+    """
+    def __init__(self, chunks, key=None):
+        """
+        :param chunks: An iterable of chunks of UTF-8 encoded bytes, e.g. transport.Response.iter_chunks().
+        :param key: The key of the array in the top-level object, or None if the document is an array.
+        """
+        self.key = key
+        self.meta = {}
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _more(self):
+        """
+        Read another chunk into the buffer, returning False at the end of the stream.
+        """
+        if self._eof:
+            return False
+        if self._pos > TRIMSIZE:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            self._buf += self._text.decode(b"", final=True)
+            return True
+        self._buf += self._text.decode(chunk)
+        return True
+
+    def _peek(self):
+        """
+        Skip whitespace and return the next character (without consuming it), or "" at the end of the stream.
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._more():
+                return ""
+
+    def _expect(self, chars):
+        ch = self._peek()
+        if ch not in chars or ch == "":
+            raise ValueError("Expected one of %r at character %d of the stream, found %r" % (chars, self._pos, ch))
+        self._pos += 1
+        return ch
+
+    def _value(self):
+        """
+        Decode and return the next complete JSON value.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A number at (or just before an exponent, fraction or sign at) the end of the buffer may continue in
+                # the next chunk, e.g. "12e" followed by "5".
+                if self._eof or not self._truncated(value, end):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._more()
+
+    def _truncated(self, value, end):
+        """
+        Return True if the decoded value is a number which may continue beyond the end of the buffer.
+        """
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+        return end == len(self._buf) or self._buf[end] in _NUMBERCHARS
+
+    def _items(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def __iter__(self):
+        for item in self._document():
+            yield item
+        # Read to the end of the stream, so that (e.g.) the connection it came from can be re-used.
+        if self._peek() != "":
+            raise ValueError("Unexpected data after the end of the JSON document at character %d" % self._pos)
+
+    def _document(self):
+        if self.key is None:
+            for item in self._items():
+                yield item
+            return
+
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            name = self._value()
+            self._expect(":")
+            if name == self.key and self._peek() == "[":
+                for item in self._items():
+                    yield item
+            else:
+                self.meta[name] = self._value()
+            if self._expect(",}") == "}":
+                return
+
+
+def batches(items, size):
+    """
+    Group an iterable of items into lists of (at most) size items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
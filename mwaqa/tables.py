@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import logging
+
+import numpy as np
+from astropy.table import Table, Column, MaskedColumn
+
+from mwaqa import instrument
+from mwaqa.schema import QACOLUMNTYPES
+
+
+logger = logging.getLogger("quality")
+
+# NumPy dtypes for each Python type in the schema, and the value stored under the mask for nulls.
+DTYPES = {int: (np.int64, 0),
+          float: (np.float64, np.nan),
+          str: (np.str_, "")}
+
+
+def typed_column(name, values, kind):
+    """
+    Build a Column of the given Python type (int, float or str) from a sequence of values, masking any Nones.
+
+    If the values cannot be converted to that type, NumPy's own type inference is used instead. Integer columns with
+    non-integral numbers (as the schema's types are not given by the server) are stored as floats, with a warning.
+    """
+    null = np.fromiter((v is None for v in values), dtype=bool, count=len(values))
+    if kind in DTYPES:
+        dtype, fill = DTYPES[kind]
+        filled = [fill if n else v for v, n in zip(values, null)] if null.any() else values
+        try:
+            data = np.array(filled, dtype=dtype)
+            if kind is int:
+                # Casting to int64 would silently truncate any fractions.
+                exact = np.array(filled)
+                if exact.dtype.kind == "f" and not np.all(np.mod(exact, 1) == 0):
+                    logger.warning("Column %r has non-integer values, so is stored as floats rather than integers."
+                                   % (name,))
+                    data = np.array(filled, dtype=np.float64)
+        except (TypeError, ValueError):
+            data = None
+    else:
+        data = None
+
+    if data is None:
+        data = np.array(values, dtype=object) if null.any() else np.array(values)
+    if null.any():
+        return MaskedColumn(data, name=name, mask=null)
+    return Column(data, name=name)
+
+
+@instrument.traced("table_from_rows")
+def table_from_rows(rows, column_list, types=QACOLUMNTYPES):
+    """
+    Build an astropy Table from select() rows, with one typed NumPy column per column in column_list.
+
+    Known columns (those in types, by default the QA schema) get int64, float64 or unicode columns; nulls are
+    masked rather than turning the whole column into objects or strings. Columns not in types keep NumPy's
+    inferred type.
+
+    :param rows: A list (or iterable) of rows, where each row is a list of values, e.g. result['rows'].
+    :param column_list: The names of the columns, in the order they appear in each row.
+    :param types: A dictionary mapping column names to Python types (int, float or str).
+    :return: An astropy Table.
+    """
+    rows = rows if isinstance(rows, list) else list(rows)
+    instrument.note("rows", len(rows))
+    with instrument.timer("table"):
+        if not rows:
+            return Table([typed_column(name, [], types.get(name)) for name in column_list])
+
+        columns = list(zip(*rows))
+        if len(columns) != len(column_list):
+            raise ValueError("Rows have %d values, but %d column names were given." % (len(columns), len(column_list)))
+        return Table([typed_column(name, values, types.get(name)) for name, values in zip(column_list, columns)])
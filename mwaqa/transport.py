@@ -0,0 +1,357 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import str
+
+import io
+import zlib
+import errno
+import base64
+import socket
+import logging
+import threading
+from timeit import default_timer
+
+# Python3
+try:
+    import http.client as httplib
+    from urllib.parse import urlsplit, urljoin, unquote
+    from urllib.error import HTTPError, URLError
+    from urllib.request import getproxies, proxy_bypass
+# Python2
+except ImportError:
+    import httplib
+    from urlparse import urlsplit, urljoin
+    from urllib import unquote, getproxies, proxy_bypass
+    from urllib2 import HTTPError, URLError
+
+from mwaqa import instrument
+
+
+logger = logging.getLogger("quality")
+
+# The maximum number of idle connections kept open to each host.
+MAXIDLE = 8
+# The maximum number of redirects followed for one request.
+MAXREDIRECTS = 5
+# The size of the chunks read from the network when streaming a response.
+CHUNKSIZE = 64 * 1024
+USERAGENT = "mwaqa"
+# Raised (on Python 3) when the server closes the connection before sending a status line.
+_DISCONNECTED = getattr(httplib, "RemoteDisconnected", None)
+
+
+class Transport(object):
+    """
+    An HTTP client which keeps connections to each host alive and re-uses them for later requests, and asks servers
+    to gzip their responses. Proxies are used as urlopen() would use them, from the http_proxy, https_proxy and
+    no_proxy environment variables (or the system settings).
+
+    A Transport can be shared between threads; each request takes an idle connection from the pool for its host
+    (or opens a new one), and returns it to the pool once the response has been read.
+    """
+    def __init__(self, timeout=None, max_idle=MAXIDLE, gzip=True):
+        """
+        :param timeout: The socket timeout in seconds for new connections, or None for the system default.
+        :param max_idle: The maximum number of idle connections to keep per host.
+        :param gzip: Boolean - if True, ask for gzip-compressed responses.
+        """
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.gzip = gzip
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._stats = {"requests": 0,
+                       "connections_opened": 0,
+                       "connections_reused": 0,
+                       "bytes_received": 0,
+                       "bytes_decoded": 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        """
+        Return a dictionary of pool statistics: the number of requests made, connections opened and re-used, bytes
+        received on the wire and after decompression, and connections currently idle in the pool.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["connections_idle"] = sum(len(conns) for conns in self._idle.values())
+        return stats
+
+    def _checkout(self, key):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                self._stats["connections_reused"] += 1
+                return conns.pop(), True
+            self._stats["connections_opened"] += 1
+
+        scheme, host, proxy = key
+        if proxy is None:
+            if scheme == "https":
+                return httplib.HTTPSConnection(host, timeout=self.timeout), False
+            return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+        # Connect to the proxy instead. HTTPS requests are tunnelled through it with CONNECT; plain HTTP requests
+        # are sent to it with the whole URL (see _send).
+        proxy_parts = urlsplit(proxy)
+        proxy_host = proxy_parts.hostname + (":%d" % proxy_parts.port if proxy_parts.port else "")
+        if proxy_parts.scheme == "https":
+            conn = httplib.HTTPSConnection(proxy_host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(proxy_host, timeout=self.timeout)
+        if scheme == "https":
+            conn.set_tunnel(host, headers=_proxy_headers(proxy_parts))
+        return conn, False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, url, method, body, headers, timeout=None):
+        """
+        Send a request on a pooled connection, and return the connection's pool key, the connection and the
+        response (with its body not yet read).
+        """
+        parts = urlsplit(url)
+        proxy = _proxy(parts)
+        key = (parts.scheme, parts.netloc, proxy)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        if proxy is not None and parts.scheme != "https":
+            # A plain HTTP proxy is sent the absolute URL, and any credentials it needs.
+            path = "%s://%s%s" % (parts.scheme, parts.netloc, path)
+            headers = dict(headers, **_proxy_headers(urlsplit(proxy)))
+
+        conn, reused = self._checkout(key)
+        # Pooled connections may have been opened with a different timeout.
+        conn.timeout = self.timeout if timeout is None else timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout if conn.timeout is not None else socket.getdefaulttimeout())
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error) as error:
+            conn.close()
+            # The server may have closed an idle keep-alive connection before the request reached it; if so, try once
+            # more on a fresh one. Otherwise (e.g. after a timeout) the server may have acted on the request, and a
+            # write mustn't be made twice, so give up; resilience decides whether to try again.
+            if reused and _closed_early(error):
+                logger.debug("re-used connection to %s failed (%s), reconnecting" % (parts.netloc, error))
+                with self._lock:
+                    self._stats["connections_reused"] -= 1
+                return self._send(url, method, body, headers, timeout)
+            raise URLError(error)
+        return key, conn, response
+
+    def open(self, url, method="GET", body=None, headers=None, timeout=None):
+        """
+        Make a request, following redirects, and return a Response from which the body can be read incrementally.
+
+        Errors are raised in the same way as urlopen(): an HTTPError for an error status, or a URLError for a
+        network problem. The Response should be read to the end or closed, so that its connection can be re-used.
+
+        :param url: The URL to request.
+        :param method: The HTTP method, e.g. "GET" or "POST".
+        :param body: The request body (bytes), or None.
+        :param headers: A dictionary of extra request headers.
+        :param timeout: The socket timeout in seconds for this request, or None for the Transport's timeout.
+        :return: A Response.
+        """
+        all_headers = {"User-Agent": USERAGENT}
+        if self.gzip:
+            all_headers["Accept-Encoding"] = "gzip"
+        if headers:
+            all_headers.update(headers)
+
+        start = default_timer()
+        for _ in range(MAXREDIRECTS + 1):
+            self._count("requests")
+            key, conn, response = self._send(url, method, body, all_headers, timeout)
+            instrument.note("ttfb", default_timer() - start)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                Response(self, key, conn, response).read()
+                url = urljoin(url, response.getheader("Location"))
+                if response.status == 303:
+                    method, body = "GET", None
+                continue
+            break
+        else:
+            raise URLError("Too many redirects")
+
+        result = Response(self, key, conn, response)
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(result.read()))
+        return result
+
+    def request(self, url, method="GET", body=None, headers=None, timeout=None):
+        """
+        Make a request and return the (decompressed) body of the response as bytes. See open() for details.
+        """
+        return self.open(url, method=method, body=body, headers=headers, timeout=timeout).read()
+
+
+def _closed_early(error):
+    """
+    Return True if error shows that the server closed the connection before sending any of its response, as it may do
+    to an idle keep-alive connection at any time, so that the request can safely be sent again.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if _DISCONNECTED is not None and isinstance(error, _DISCONNECTED):
+        return True
+    if isinstance(error, httplib.BadStatusLine):
+        # Python 2 gives an empty status line instead.
+        return error.line in ("", "''")
+    return getattr(error, "errno", None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+def _proxy(parts):
+    """
+    Return the URL of the proxy to use for a request (from the http_proxy, https_proxy and no_proxy environment
+    variables, or the system settings, as urlopen() does), or None to connect directly.
+    """
+    proxy = getproxies().get(parts.scheme)
+    if not proxy or proxy_bypass(parts.hostname or ""):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    return proxy
+
+
+def _proxy_headers(proxy_parts):
+    """
+    Return the headers which authenticate with a proxy, if its URL includes a user name and password.
+    """
+    if proxy_parts.username is None:
+        return {}
+    credentials = "%s:%s" % (unquote(proxy_parts.username), unquote(proxy_parts.password or ""))
+    return {"Proxy-Authorization": "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")}
+
+
+class Response(object):
+    """
+    The body of a response from a Transport, decompressed as it is read. The connection is returned to the pool
+    once the body has been read to the end.
+    """
+    def __init__(self, transport, key, conn, response):
+        self._transport = transport
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.headers = response.msg
+
+        encoding = (response.getheader("Content-Encoding") or "").lower()
+        if encoding == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self._decompressor = zlib.decompressobj()
+        else:
+            self._decompressor = None
+
+    def iter_chunks(self, size=CHUNKSIZE):
+        """
+        Yield the (decompressed) body as chunks of bytes, as they arrive.
+        """
+        if self._conn is None:
+            return
+        try:
+            while True:
+                try:
+                    data = self._response.read(size)
+                except (httplib.HTTPException, socket.error) as error:
+                    raise URLError(error)
+                if not data:
+                    break
+                self._transport._count("bytes_received", len(data))
+                instrument.add("bytes", len(data))
+                if self._decompressor is not None:
+                    data = self._decompressor.decompress(data)
+                if data:
+                    self._transport._count("bytes_decoded", len(data))
+                    yield data
+            if self._decompressor is not None:
+                data = self._decompressor.flush()
+                if data:
+                    self._transport._count("bytes_decoded", len(data))
+                    yield data
+        except BaseException:
+            self.close()
+            raise
+        self._release()
+
+    def read(self):
+        """
+        Return the whole (decompressed) body.
+        """
+        return b"".join(self.iter_chunks())
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._response.will_close:
+            self._conn.close()
+        else:
+            self._transport._checkin(self._key, self._conn)
+        self._conn = None
+
+    def close(self):
+        """
+        Close the connection without reading the rest of the body.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# The transport shared by util.getmeta and metadata.Query.
+DEFAULT = Transport()
+
+
+def request(url, method="GET", body=None, headers=None, timeout=None):
+    """
+    Make a request with the shared Transport (see Transport.request).
+    """
+    return DEFAULT.request(url, method=method, body=body, headers=headers, timeout=timeout)
+
+
+def open_url(url, method="GET", body=None, headers=None, timeout=None):
+    """
+    Make a streaming request with the shared Transport (see Transport.open).
+    """
+    return DEFAULT.open(url, method=method, body=body, headers=headers, timeout=timeout)
+
+
+def stats():
+    """
+    Return the pool statistics of the shared Transport (see Transport.stats).
+    """
+    return DEFAULT.stats()
@@ -8,22 +8,25 @@ from future.builtins import range, str
 
 import json
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Python3
 try:
     from urllib.parse import urlencode
-    from urllib.request import urlopen
     from urllib.error import HTTPError, URLError
     import configparser as ConfigParser
 # Python2
 except ImportError:
     from urllib import urlencode
-    from urllib2 import urlopen, HTTPError, URLError
+    from urllib2 import HTTPError, URLError
     import ConfigParser
 
+from mwaqa import cache, daemon, flight, instrument, resilience, stream, transport
+from mwaqa.constraints import obsid_range, validate as validate_constraints
+
 
-# configure the logging
-logging.basicConfig(format="# %(levelname)s:%(name)s: %(message)s")
 logger = logging.getLogger("quality")
 
 # This server only has read-only access to the table, only select queries will work.
@@ -34,9 +37,21 @@ DEFAULTID = "quality"
 CPPATH = ["/usr/local/etc/quality.conf", "./quality.conf"]
 # Placeholder for the user_name/secure_key global dictionary
 KEYS = None
+# The approximate maximum size (in bytes of JSON) and number of rows sent in each batch by insert_many().
+MAXPOSTBYTES = 256 * 1024
+MAXPOSTROWS = 1000
+# The number of metadata/obs results kept in memory by get_obs_many(), and the default number of requests it runs at
+# once (the number of idle connections the transport keeps open to each host, so that every worker reuses one).
+OBSMEMOSIZE = 100000
+OBSWORKERS = transport.MAXIDLE
+
+# Results of get_obs_many(), by obsid, oldest first.
+_obs_memo = OrderedDict()
+_obs_lock = threading.Lock()
 
 
-def getmeta(servicetype="metadata", service="obs", params=None):
+@instrument.traced("getmeta")
+def getmeta(servicetype="metadata", service="obs", params=None, post=False):
     """
     Given a JSON web servicetype ('observation', 'metadata', 'quality', etc), a service name (eg 'obs', find, or 'con')
     and a set of parameters as a Python dictionary, return the result of calling that service.
@@ -47,6 +62,8 @@ def getmeta(servicetype="metadata", service="obs", params=None):
     :param servicetype: Service type (the Django package name), eg 'quality'.
     :param service: Service name (the Django function), eg 'select'.
     :param params: A dictionary containing the name/value pairs to pass to the service call.
+    :param post: Boolean - if True, send the parameters in the body of a POST request rather than in the URL, e.g.
+                 when they are too large for a query string. POST results are never cached.
     :return: A Python object converted from a JSON string, or the raw string if it's not in JSON format.
     """
     if params:
@@ -54,23 +71,168 @@ def getmeta(servicetype="metadata", service="obs", params=None):
     else:
         data = ""
 
-    # Get the data
-    returnstring = ""
-    try:
-        returnstring = urlopen(BASEURL + servicetype + '/' + service + '?' + data).read()
-        result = json.loads(returnstring)
-    except ValueError:   # Result isn't in JSON format
-        result = returnstring
-    except HTTPError as error:
-        print("HTTP error from server: code=%d, response:\n %s" % (error.code, error.read()))
-        return
-    except URLError as error:
-        print("URL or network error: %s" % error.reason)
-        return
+    if post:
+        url = BASEURL + servicetype + '/' + service
+    else:
+        url = BASEURL + servicetype + '/' + service + '?' + data
+    return _getmeta_url(url, data=data if post else None)
+
+
+def _getmeta_url(url, data=None):
+    """
+    Return the result of calling the service at the given URL, as for getmeta. If data is given, it is sent as the
+    body of a POST request instead.
+    """
+    post = data is not None
+    servicetype, service = cache.service_name(url).split("/")
+    write = (servicetype + '/' + service) in cache.WRITESERVICES
+    cacheable = cache.ACTIVE is not None and not write and not post
+    instrument.note("service", servicetype + '/' + service)
+    instrument.note("url", url)
+
+    # Use a cached result, if we have one.
+    if cacheable:
+        result = cache.ACTIVE.get(url)
+        instrument.note("cache", "miss" if result is None else "hit")
+        if result is not None:
+            instrument.note("rows", _nrows(result))
+            return result
+
+    # Get the data, retrying failed requests according to the resilience policy.
+    if post:
+        def request(timeout):
+            return transport.request(url,
+                                     method="POST",
+                                     body=data.encode("utf-8"),
+                                     headers={"Content-Type": "application/x-www-form-urlencoded"},
+                                     timeout=timeout)
+    else:
+        def request(timeout):
+            return transport.request(url, timeout=timeout)
+
+    def fetch():
+        if not write and not post:
+            forwarded, result = _via_daemon(url)
+            if forwarded:
+                if cacheable and isinstance(result, (dict, list)):
+                    cache.ACTIVE.put(url, result)
+                return result
+
+        returnstring = ""
+        try:
+            with instrument.timer("fetch"):
+                returnstring = resilience.call(request, url, write=write)
+            with instrument.timer("decode"):
+                result = json.loads(returnstring)
+        except ValueError:   # Result isn't in JSON format
+            result = returnstring
+        except HTTPError as error:
+            instrument.note("error", "HTTP %d" % error.code)
+            print("HTTP error from server: code=%d, response:\n %s" % (error.code, error.read()))
+            return
+        except URLError as error:
+            instrument.note("error", "URL error: %s" % error.reason)
+            print("URL or network error: %s" % error.reason)
+            return
+        finally:
+            if cache.ACTIVE is not None and write:
+                cache.ACTIVE.invalidate_for_write(url)
+
+        if cacheable and isinstance(result, (dict, list)):
+            cache.ACTIVE.put(url, result)
+        return result
+
+    # Writes are always sent; reads share the result of an identical request already in flight, if there is one.
+    if write:
+        result = fetch()
+    else:
+        result = flight.do(("getmeta", cache.canonical_url(url), data if post else None), fetch)
+    instrument.note("rows", _nrows(result))
     # Return the result dictionary
     return result
 
 
+def _via_daemon(url):
+    """
+    Make a read request for the given URL through the mwaqa daemon, if one is running, and return (True, its result).
+    Return (False, None) if there is no daemon, so that the caller makes the request itself.
+    """
+    if daemon.ACTIVE is None:
+        return False, None
+    try:
+        with instrument.timer("fetch"):
+            result = daemon.forward("getmeta", url=url)
+    except daemon.DaemonUnavailable:
+        return False, None
+    instrument.note("daemon", True)
+    return True, result
+
+
+def _nrows(result):
+    """
+    Return the number of rows (or records) in a service result, for instrumentation.
+    """
+    if isinstance(result, dict):
+        return len(result.get("rows") or [])
+    if isinstance(result, list):
+        return len(result)
+    return 0
+
+
+def get_obs_many(obsids, max_workers=OBSWORKERS, memo=True):
+    """
+    Return the full metadata of many observations, from the metadata/obs service, as a list in the same order as
+    obsids.
+
+    Each obsid is requested once, however many times it appears, with up to max_workers requests running at once
+    over reused connections. Results are remembered for the life of the process (up to OBSMEMOSIZE of them), so
+    asking again for the same observations makes no requests.
+
+    :param obsids: A list of obsids.
+    :param max_workers: The maximum number of requests to run at once.
+    :param memo: Boolean - if False, request every observation again, rather than re-using remembered results.
+    :return: A list of dictionaries (as returned by getmeta), with None for any observation which couldn't be fetched.
+    """
+    obsids = [int(o) for o in obsids]
+    found = {}
+    if memo:
+        with _obs_lock:
+            for obsid in obsids:
+                if obsid in _obs_memo:
+                    found[obsid] = _obs_memo[obsid]
+    missing = sorted(set(obsids) - set(found))
+
+    def fetch(obsid):
+        return getmeta(servicetype="metadata", service="obs", params={"obs_id": obsid})
+
+    if len(missing) == 1:
+        found[missing[0]] = fetch(missing[0])
+    elif missing:
+        with ThreadPoolExecutor(max_workers=max(min(max_workers, len(missing)), 1)) as pool:
+            fetch = resilience.bind(fetch)
+            for obsid, result in zip(missing, pool.map(fetch, missing)):
+                found[obsid] = result
+
+    # Remember what was fetched, except for failures, forgetting the oldest results if there are too many.
+    with _obs_lock:
+        for obsid in missing:
+            if isinstance(found[obsid], dict):
+                _obs_memo.pop(obsid, None)
+                _obs_memo[obsid] = found[obsid]
+        while len(_obs_memo) > OBSMEMOSIZE:
+            _obs_memo.popitem(last=False)
+
+    return [found[obsid] for obsid in obsids]
+
+
+def clear_obs_memo():
+    """
+    Forget the metadata remembered by get_obs_many().
+    """
+    with _obs_lock:
+        _obs_memo.clear()
+
+
 def load_config_options():
     """
     Populate the KEYS global variable using the config file. This dictionary maps user names to secure keys (passwords).
@@ -134,6 +296,182 @@ def insert(row=None, user_name=DEFAULTID, secure_key=None):
     return result
 
 
+def _row_dicts(rows):
+    """
+    Yield each row of an astropy Table (as a dictionary of JSON-serialisable values), or each row of an iterable of
+    dictionaries unchanged.
+    """
+    if hasattr(rows, "colnames"):
+        # Convert a column at a time; tolist() turns NumPy scalars into Python values and masked values into None.
+        columns = [rows[name].tolist() for name in rows.colnames]
+        for values in zip(*columns):
+            yield dict(zip(rows.colnames, values))
+    else:
+        for row in rows:
+            yield row
+
+
+def _batches(rows, max_bytes, max_rows):
+    """
+    Group rows into batches of (index, row, JSON-encoded row) tuples, each at most max_rows rows and (unless a single
+    row is larger) max_bytes bytes of JSON.
+    """
+    batch, size = [], 0
+    for i, row in enumerate(_row_dicts(rows)):
+        encoded = json.dumps(row)
+        if batch and (size + len(encoded) + 2 > max_bytes or len(batch) >= max_rows):
+            yield batch
+            batch, size = [], 0
+        batch.append((i, row, encoded))
+        size += len(encoded) + 2
+    if batch:
+        yield batch
+
+
+def _batch_errors(batch, result):
+    """
+    Map the result of a batched call onto the rows of the batch, returning a dictionary of row index: error message.
+    """
+    if result is None or not isinstance(result, dict):
+        return dict((i, "Request failed: %s" % (result,)) for i, _, _ in batch)
+    errors = result.get("errors") or {}
+    if result.get("success", True) and not errors:
+        return {}
+
+    row_errors = {}
+    for key, message in errors.items():
+        try:
+            position = int(key)
+        except (TypeError, ValueError):
+            position = None
+        if position is not None and 0 <= position < len(batch):
+            row_errors[batch[position][0]] = message
+        else:
+            # Not attributable to a single row, so it applies to the whole batch.
+            for i, _, _ in batch:
+                row_errors.setdefault(i, message)
+    if not result.get("success", True) and not row_errors:
+        row_errors = dict((i, "Batch failed") for i, _, _ in batch)
+    return row_errors
+
+
+def insert_many(rows, user_name=DEFAULTID, secure_key=None, max_bytes=MAXPOSTBYTES, max_rows=MAXPOSTROWS,
+                batched=False, max_workers=OBSWORKERS):
+    """
+    Insert many rows, making several insert() calls at once over the re-used connections of the transport.
+
+    By default, each row is sent in the body of its own POST request to the insert() web service (in the 'row'
+    parameter, as insert() sends it), with up to max_workers requests at once. The MWA servers' insert() service
+    takes only one row per call, so this is still one authenticated request per row.
+
+    With batched=True, rows are instead grouped into batches of at most max_rows rows and roughly max_bytes of JSON,
+    and each batch is sent as a JSON list in the 'rows' parameter of one POST request. This is much faster, but only
+    works with a server whose insert() service accepts the 'rows' parameter, which the MWA servers do not (yet).
+
+    The function returns a dictionary summarising every call, with the following key/value pairs:
+
+    result['errors'] - A dictionary mapping the (zero-based) position of each row which failed, in the order the rows
+                       were given, to its error message. An error for a batch as a whole is given for each of its rows.
+    result['success'] - A Boolean, True if every row was inserted.
+    result['inserted'] - The number of rows inserted.
+    result['batches'] - The number of requests made.
+
+    :param rows: An iterable of dictionaries (as for insert()), or an astropy Table. Every row needs an obsid.
+    :param user_name: A project ID code (or a pseudo-ID) to authenticate against on the server for permission.
+    :param secure_key: A password to match against the value on the server for the given user_name, for permission.
+    :param max_bytes: The approximate maximum size of each batch, in bytes of JSON (with batched=True).
+    :param max_rows: The maximum number of rows in each batch (with batched=True).
+    :param batched: Boolean - if True, send batches of rows in each request, otherwise one row per request. Only
+                    for servers which accept the 'rows' parameter.
+    :param max_workers: The maximum number of requests to make at once, when batched is False. If 0 or None, the
+                        rows are sent one at a time from the calling thread (e.g. at exit, when no new threads can
+                        be started).
+    :return: The result dictionary, described above.
+    """
+    if KEYS is None:
+        load_config_options()
+
+    if secure_key is None:
+        secure_key = KEYS.get(user_name, "")
+
+    if "mro" not in BASEURL:
+        logger.critical("INSERT calls won't work unless BASEURL is set to the MRO server")
+        return
+
+    if not secure_key:
+        logger.critical("INSERT calls won't work without a valid user_name and secure_key, check the config file.")
+        return
+
+    errors, total, nrequests = {}, 0, 0
+    if batched:
+        for batch in _batches(rows, max_bytes, max_rows):
+            result = getmeta(servicetype="quality", service="insert", post=True,
+                             params={"rows": "[%s]" % ", ".join(encoded for _, _, encoded in batch),
+                                     "user_name": user_name,
+                                     "secure_key": secure_key})
+            errors.update(_batch_errors(batch, result))
+            nrequests += 1
+            total += len(batch)
+    else:
+        def insert_row(row):
+            return getmeta(servicetype="quality", service="insert", post=True,
+                           params={"row": json.dumps(row), "user_name": user_name, "secure_key": secure_key})
+
+        if not max_workers:
+            for i, row in enumerate(_row_dicts(rows)):
+                errors.update(_batch_errors([(i, None, None)], insert_row(row)))
+                total += 1
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                results = pool.map(resilience.bind(insert_row), _row_dicts(rows))
+                for i, result in enumerate(results):
+                    errors.update(_batch_errors([(i, None, None)], result))
+                    total += 1
+        nrequests = total
+
+    return {"errors": errors,
+            "success": not errors,
+            "inserted": total - len(errors),
+            "batches": nrequests}
+
+
+def upsert_many(rows, user_name=DEFAULTID, secure_key=None, max_bytes=MAXPOSTBYTES, max_rows=MAXPOSTROWS,
+                batched=False, max_workers=OBSWORKERS):
+    """
+    Insert many rows with insert_many(), then update() the existing rows for any that could not be inserted (e.g.
+    because their obsid is already in the table).
+
+    The function returns a dictionary in the same format as insert_many(), with an extra 'updated' key giving the
+    number of rows updated; 'errors' only lists rows which could be neither inserted nor updated.
+
+    See insert_many() for a description of the parameters.
+    """
+    rows = list(_row_dicts(rows))
+    result = insert_many(rows, user_name=user_name, secure_key=secure_key, max_bytes=max_bytes, max_rows=max_rows,
+                         batched=batched, max_workers=max_workers)
+    if result is None:
+        return
+
+    errors, updated = {}, 0
+    for i, message in sorted(result["errors"].items()):
+        row = rows[i]
+        data = dict((k, v) for k, v in row.items() if k != "obsid")
+        update_result = update(constraints=("=", "obsid", row.get("obsid")),
+                               data=data,
+                               user_name=user_name,
+                               secure_key=secure_key)
+        if update_result is not None and update_result.get("success", False) and update_result.get("rowcount", 1):
+            updated += 1
+        else:
+            errors[i] = "Insert failed (%s), and update failed (%s)" % (
+                message, update_result.get("errors") if isinstance(update_result, dict) else update_result)
+
+    result["errors"] = errors
+    result["success"] = not errors
+    result["updated"] = updated
+    return result
+
+
 def update(constraints=None, data=None, user_name=DEFAULTID, secure_key=None):
     """
     Call the update() web service to change the contents of the rows matching the constraints.
@@ -185,6 +523,12 @@ def update(constraints=None, data=None, user_name=DEFAULTID, secure_key=None):
         logger.critical("UPDATE calls won't work without a valid user_name and secure_key, check the config file.")
         return
 
+    try:
+        validate_constraints(constraints)
+    except ValueError as error:
+        logger.critical("UPDATE calls won't work with invalid constraints: %s" % error)
+        return
+
     result = getmeta(servicetype="quality", service="update", params={"constraints": json.dumps(constraints),
                                                                       "data": json.dumps(data),
                                                                       "user_name": user_name,
@@ -240,6 +584,12 @@ def delete(constraints=None, user_name=DEFAULTID, secure_key=None):
         logger.critical("DELETE calls won't work without a valid user_name and secure_key, check the config file.")
         return
 
+    try:
+        validate_constraints(constraints)
+    except ValueError as error:
+        logger.critical("DELETE calls won't work with invalid constraints: %s" % error)
+        return
+
     result = getmeta(servicetype="quality", service="delete", params={"constraints": json.dumps(constraints),
                                                                       "user_name": user_name,
                                                                       "secure_key": secure_key})
@@ -288,6 +638,12 @@ def select(constraints=None, column_list=None, pagesize=100, desc=False, user_na
     :return: The result dictionary, described above.
     """
 
+    try:
+        validate_constraints(constraints)
+    except ValueError as error:
+        logger.critical("SELECT calls won't work with invalid constraints: %s" % error)
+        return
+
     params = {"constraints": json.dumps(constraints),
               "column_list": json.dumps(column_list),
               "limit": pagesize,
@@ -297,5 +653,346 @@ def select(constraints=None, column_list=None, pagesize=100, desc=False, user_na
     if desc:
         params["desc"] = 1   # Sort in descending order
 
-    result = getmeta(servicetype="quality", service="select", params=params)
-    return result
+    # Requests for an obsid range can be answered by a request for a wider range (with the same columns and
+    # further constraints) which is already in flight, e.g. one shard of select_sharded() by a whole-range select.
+    bounds = obsid_range(constraints) if column_list is not None and "obsid" in column_list else None
+    if bounds is None or flight.ACTIVE is None:
+        return getmeta(servicetype="quality", service="select", params=params)
+
+    lo, hi, further = bounds
+    family = (json.dumps(further), json.dumps(column_list), bool(desc))
+    wider = flight.ACTIVE.find(lambda info: info[0] == family and _contains(info[1:3], (lo, hi)))
+    if wider is not None:
+        result = _subset(wider, column_list.index("obsid"), lo, hi, pagesize)
+        if result is not None:
+            instrument.note("coalesced", True)
+            return result
+
+    url = BASEURL + "quality/select?" + urlencode(params)
+    return flight.do(("select", cache.canonical_url(url)),
+                     lambda: getmeta(servicetype="quality", service="select", params=params),
+                     info=(family, lo, hi, pagesize))
+
+
+def _contains(outer, inner):
+    """
+    Return True if the inclusive obsid range outer contains inner. Either end of a range may be None (unbounded).
+    """
+    (outer_lo, outer_hi), (inner_lo, inner_hi) = outer, inner
+    if outer_lo is not None and (inner_lo is None or inner_lo < outer_lo):
+        return False
+    if outer_hi is not None and (inner_hi is None or inner_hi > outer_hi):
+        return False
+    return True
+
+
+def _subset(wider, obsid_index, lo, hi, pagesize):
+    """
+    Wait for a select() of a wider obsid range, and return the rows of its result inside [lo, hi] (as a result
+    dictionary), or None if it failed or may have been truncated by its pagesize.
+    """
+    try:
+        result = wider.wait()
+    except (HTTPError, URLError, RuntimeError, ValueError):
+        return None
+    if not isinstance(result, dict) or not result.get("success", True) or "rows" not in result:
+        return None
+    if len(result["rows"]) >= wider.info[3]:
+        return None
+    rows = [row for row in result["rows"]
+            if (lo is None or row[obsid_index] >= lo) and (hi is None or row[obsid_index] <= hi)]
+    return {"errors": {},
+            "success": True,
+            "query": None,
+            "rows": rows[:pagesize]}
+
+
+def iselect(constraints=None, column_list=None, pagesize=100, desc=False, user_name=DEFAULTID, secure_key=None,
+            batch_size=None):
+    """
+    Generator version of select(), yielding each row as it is decoded from the response, rather than waiting for
+    (and holding) the whole response. Memory use stays flat however many rows are returned.
+
+    A RuntimeError is raised if the call fails. See select() for a description of the other parameters.
+
+    :param batch_size: If given, yield lists of up to batch_size rows instead of single rows.
+    """
+    try:
+        validate_constraints(constraints)
+    except ValueError as error:
+        raise ValueError("SELECT calls won't work with invalid constraints: %s" % error)
+
+    params = {"constraints": json.dumps(constraints),
+              "column_list": json.dumps(column_list),
+              "limit": pagesize,
+              "user_name": user_name,
+              "secure_key": secure_key}
+
+    if desc:
+        params["desc"] = 1   # Sort in descending order
+
+    rows = _iter_rows(BASEURL + "quality/select?" + urlencode(params))
+    if batch_size:
+        rows = stream.batches(rows, batch_size)
+    for item in rows:
+        yield item
+
+
+@instrument.traced_generator("iselect")
+def _iter_rows(url):
+    instrument.note("service", "quality/select")
+    instrument.note("url", url)
+    if cache.ACTIVE is not None:
+        result = cache.ACTIVE.get(url)
+        instrument.note("cache", "miss" if result is None else "hit")
+        if result is not None:
+            instrument.note("rows", len(result["rows"]))
+            for row in result["rows"]:
+                yield row
+            return
+
+    # The daemon (if there is one) sends the whole result at once.
+    forwarded, result = _via_daemon(url)
+    if forwarded:
+        if not isinstance(result, dict) or not result.get("success", True):
+            raise RuntimeError("select failed: %s" % (result.get("errors") if isinstance(result, dict) else result))
+        instrument.note("rows", len(result["rows"]))
+        for row in result["rows"]:
+            yield row
+        return
+
+    try:
+        response = resilience.call(lambda timeout: transport.open_url(url, timeout=timeout), url)
+    except HTTPError as error:
+        raise RuntimeError("HTTP error from server: code=%d, response:\n %s" % (error.code, error.read()))
+    except URLError as error:
+        raise RuntimeError("URL or network error: %s" % error.reason)
+
+    with response:
+        rows = stream.JSONArrayStream(response.iter_chunks(), key="rows")
+        for row in rows:
+            instrument.add("rows", 1)
+            yield row
+    if not rows.meta.get("success", True):
+        raise RuntimeError("select failed: %s" % rows.meta.get("errors"))
+
+
+def _shard_constraints(constraints, lo, hi):
+    """
+    Restrict the given constraints to the inclusive obsid range [lo, hi].
+    """
+    obsid_range = ("and",
+                   (">=", "obsid", lo),
+                   ("<=", "obsid", hi))
+    if constraints is None:
+        return obsid_range
+    return ("and", obsid_range, constraints)
+
+
+def iselect_sharded(constraints=None, column_list=None, min_obsid=None, max_obsid=None, nshards=8, max_workers=4,
+                    pagesize=10000, desc=False, user_name=DEFAULTID, secure_key=None):
+    """
+    Generator version of select_sharded(), yielding each row as soon as the shard containing it has been fetched.
+
+    Rows are yielded in the order their shards complete, not in obsid order. A row is only yielded once, even if
+    it is returned by more than one shard; rows are identified by their obsid if "obsid" is in column_list, or
+    otherwise by their full contents.
+
+    A RuntimeError is raised if any shard cannot be fetched. See select_sharded() for a description of the
+    parameters.
+    """
+    if min_obsid is None or max_obsid is None:
+        raise ValueError("Sharded selects need both min_obsid and max_obsid to be specified.")
+    min_obsid, max_obsid = int(min_obsid), int(max_obsid)
+    if max_obsid < min_obsid:
+        raise ValueError("max_obsid (%d) is less than min_obsid (%d)." % (max_obsid, min_obsid))
+
+    if column_list is not None and "obsid" in column_list:
+        obsid_index = list(column_list).index("obsid")
+        key = lambda row: row[obsid_index]
+    else:
+        key = tuple
+    seen = set()
+
+    shard_width = (max_obsid - min_obsid) // max(int(nshards), 1) + 1
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def submit(lo, hi):
+            future = pool.submit(resilience.bind(select),
+                                 constraints=_shard_constraints(constraints, lo, hi),
+                                 column_list=column_list,
+                                 pagesize=pagesize,
+                                 desc=desc,
+                                 user_name=user_name,
+                                 secure_key=secure_key)
+            pending[future] = (lo, hi)
+
+        for lo in range(min_obsid, max_obsid + 1, shard_width):
+            submit(lo, min(lo + shard_width - 1, max_obsid))
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                lo, hi = pending.pop(future)
+                result = future.result()
+                if result is None or not isinstance(result, dict) or not result.get("success", True):
+                    for f in pending:
+                        f.cancel()
+                    errors = result.get("errors") if isinstance(result, dict) else result
+                    raise RuntimeError("select failed for obsids %d-%d: %s" % (lo, hi, errors))
+
+                rows = result["rows"]
+                # A full page means the shard may be truncated; split it and fetch both halves instead.
+                if len(rows) >= pagesize and hi > lo:
+                    mid = (lo + hi) // 2
+                    submit(lo, mid)
+                    submit(mid + 1, hi)
+                    continue
+                if len(rows) >= pagesize:
+                    logger.warning("select results for obsid %d may be truncated due to the pagesize parameter." % lo)
+
+                for row in rows:
+                    k = key(row)
+                    if k not in seen:
+                        seen.add(k)
+                        yield row
+
+
+def select_sharded(constraints=None, column_list=None, min_obsid=None, max_obsid=None, nshards=8, max_workers=4,
+                   pagesize=10000, desc=False, user_name=DEFAULTID, secure_key=None):
+    """
+    Call the select() web service over a large obsid range by splitting it into smaller shards.
+
+    The inclusive range [min_obsid, max_obsid] is split into nshards sub-ranges of equal width, and each sub-range is
+    joined to the given constraints with an 'and' and selected separately, with up to max_workers requests running
+    at once. A shard that fills a whole page is split in half and selected again, so the complete result set is
+    always returned. Duplicate rows are removed.
+
+    The function returns a dictionary in the same format as select(), with the rows sorted by obsid (if
+    "obsid" is in column_list). As the shards are fetched separately, result['query'] is not available.
+
+    :param constraints: A nested list of constraints, in the format described for select(), or None.
+    :param column_list: A list of column names to return in the SELECT query.
+    :param min_obsid: The earliest obsid in the range.
+    :param max_obsid: The latest obsid in the range.
+    :param nshards: The number of sub-ranges to initially split the obsid range into.
+    :param max_workers: The maximum number of select() calls to run at once.
+    :param pagesize: The maximum number of rows to return for each shard.
+    :param desc: Boolean - if False, sort the rows by obsid, if True, sort the rows in reverse order of obsid.
+    :param user_name: A project ID code (or a pseudo-ID), which the server ignores for SELECT queries.
+    :param secure_key: A password, which the server ignores for SELECT queries.
+    :return: The result dictionary, described above.
+    """
+    rows = list(iselect_sharded(constraints=constraints,
+                                column_list=column_list,
+                                min_obsid=min_obsid,
+                                max_obsid=max_obsid,
+                                nshards=nshards,
+                                max_workers=max_workers,
+                                pagesize=pagesize,
+                                desc=desc,
+                                user_name=user_name,
+                                secure_key=secure_key))
+    if column_list is not None and "obsid" in column_list:
+        obsid_index = list(column_list).index("obsid")
+        rows.sort(key=lambda row: row[obsid_index], reverse=desc)
+
+    return {"errors": {},
+            "success": True,
+            "query": None,
+            "rows": rows}
+
+
+def select_obsids(obsids, column_list=None, constraints=None, max_workers=4, pagesize=10000, desc=False,
+                  user_name=DEFAULTID, secure_key=None, **plan_options):
+    """
+    Call the select() web service for a list of obsids, using the cheapest set of requests found by planner.plan().
+
+    Sparse lists are fetched with tight ranges or 'or'-ed equalities around each run of neighbouring obsids, rather
+    than everything between the smallest and largest obsid. The planned requests are run on a thread pool of up to
+    max_workers, any request that fills a whole page is split and run again, and rows for obsids which are not in
+    the list are removed.
+
+    The function returns a dictionary in the same format as select(), with the rows sorted by obsid.
+    As the rows are fetched by several requests, result['query'] is not available.
+
+    :param obsids: The obsids to select.
+    :param column_list: A list of column names to return in the SELECT query. Must include "obsid".
+    :param constraints: Optional further constraints, in the format described for select(), which every row must
+                        also satisfy.
+    :param max_workers: The maximum number of select() calls to run at once.
+    :param pagesize: The maximum number of rows to return for each request. Requests which fill a page are split,
+                     so every matching row is returned whatever the page size.
+    :param desc: Boolean - if False, sort the rows by obsid, if True, sort the rows in reverse order of obsid. Each
+                 request is made in the same order.
+    :param user_name: A project ID code (or a pseudo-ID), which the server ignores for SELECT queries.
+    :param secure_key: A password, which the server ignores for SELECT queries.
+    :param plan_options: Any further keyword arguments are passed to planner.plan().
+    :return: The result dictionary, described above.
+    """
+    from mwaqa import planner
+    from mwaqa.obsids import prune_rows
+
+    if column_list is None or "obsid" not in column_list:
+        raise ValueError("select_obsids needs 'obsid' in column_list.")
+    obsid_index = list(column_list).index("obsid")
+
+    query_plan = planner.plan(obsids, **plan_options)
+    logger.debug("select_obsids plan: %r" % query_plan)
+
+    rows = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def submit(terms):
+            request = planner.any_of([term.constraints() for term in terms])
+            if constraints is not None:
+                request = ("and", request, constraints)
+            future = pool.submit(resilience.bind(select),
+                                 constraints=request,
+                                 column_list=column_list,
+                                 pagesize=pagesize,
+                                 desc=desc,
+                                 user_name=user_name,
+                                 secure_key=secure_key)
+            pending[future] = terms
+
+        for terms in query_plan.requests:
+            submit(terms)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                terms = pending.pop(future)
+                result = future.result()
+                if result is None or not isinstance(result, dict) or not result.get("success", True):
+                    for f in pending:
+                        f.cancel()
+                    errors = result.get("errors") if isinstance(result, dict) else result
+                    raise RuntimeError("select failed for obsids %d-%d: %s" % (terms[0].lo, terms[-1].hi, errors))
+
+                # A full page means the results may be truncated; split the request and run both halves instead.
+                if len(result["rows"]) >= pagesize:
+                    if len(terms) > 1:
+                        submit(terms[:len(terms) // 2])
+                        submit(terms[len(terms) // 2:])
+                        continue
+                    if terms[0].hi > terms[0].lo:
+                        for half in terms[0].split():
+                            if len(half.obsids):
+                                submit([half])
+                        continue
+                    logger.warning("select results for obsid %d may be truncated due to the pagesize parameter."
+                                   % terms[0].lo)
+
+                for row in result["rows"]:
+                    rows[row[obsid_index]] = row
+
+    rows = prune_rows(sorted(rows.values(), key=lambda row: row[obsid_index], reverse=desc),
+                      obsids,
+                      index=obsid_index)
+    return {"errors": {},
+            "success": True,
+            "query": None,
+            "rows": rows}
@@ -0,0 +1,327 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+A write-behind queue for QA updates, so that a pipeline doesn't wait for the server on every change, e.g.
+
+    from mwaqa.writequeue import WriteQueue
+
+    with WriteQueue() as queue:
+        for obsid in obsids:
+            queue.update(obsid, iono_qa=...)
+            queue.update(obsid, noise_qa=...)     # Sent with the iono_qa change, as one row change.
+
+Changes are kept in an SQLite file until the server has accepted them, so they survive a crash, and are sent by
+the next WriteQueue to open the same file.
+"""
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import os
+import json
+import time
+import atexit
+import random
+import sqlite3
+import logging
+import weakref
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import mwaqa.util as u
+from mwaqa import resilience
+from mwaqa.schema import QACOLUMNNAMES
+
+
+logger = logging.getLogger("quality")
+
+# Where the queue is kept, if no path is given.
+DEFAULTPATH = os.path.join(os.path.expanduser("~"), ".cache", "mwaqa", "writes.sqlite")
+# The most obsids whose changes are sent together, and the longest time (in seconds) a change waits to be sent.
+BATCHSIZE = 500
+FLUSHINTERVAL = 2.0
+# The number of times a change is sent before giving up on it, and the backoff (in seconds) before the first retry,
+# which doubles with each retry up to MAXDELAY.
+MAXATTEMPTS = 8
+BASEDELAY = 1.0
+MAXDELAY = 300.0
+
+
+class WriteQueue(object):
+    """
+    Queue changes to QA rows, and send them to the server in batches on a background thread.
+
+    Changes to the same obsid which are waiting to be sent are merged into one row change, with later values of a
+    column replacing earlier ones. Every BATCHSIZE obsids, or every `interval` seconds, the waiting changes are sent:
+    obsids with identical changes share one update() request, or (with upsert=True) the rows are sent with
+    upsert_many(). A change which fails is retried with exponential backoff, and after max_attempts is moved to the
+    failed list (see failed() and retry_failed()).
+
+    Call flush() to send everything at once and wait for it. close() (which is also called at exit) stops the
+    background thread and flushes whatever is left; anything which still couldn't be sent stays in the file.
+    """
+    def __init__(self, path=DEFAULTPATH, user_name=u.DEFAULTID, secure_key=None, batch_size=BATCHSIZE,
+                 interval=FLUSHINTERVAL, max_attempts=MAXATTEMPTS, upsert=False, max_workers=4):
+        """
+        :param path: The SQLite file holding the queue.
+        :param user_name: A project ID code (or a pseudo-ID) to authenticate against on the server for permission.
+        :param secure_key: A password for user_name; by default, it is read from the config file.
+        :param batch_size: The most obsids whose changes are sent together.
+        :param interval: The longest time (in seconds) a change waits before it is sent.
+        :param max_attempts: The number of times a change is sent before it is moved to the failed list.
+        :param upsert: Boolean - if True, insert rows for obsids which aren't in the table yet (see
+                       util.upsert_many), otherwise only update existing rows.
+        :param max_workers: The maximum number of requests to run at once.
+        """
+        if u.KEYS is None:
+            u.load_config_options()
+        if secure_key is None:
+            secure_key = u.KEYS.get(user_name, "")
+        if "mro" not in u.BASEURL or not secure_key:
+            raise ValueError("QA writes won't work without a valid user_name and secure_key, check the config file.")
+
+        self.path = path
+        self.user_name = user_name
+        self.secure_key = secure_key
+        self.batch_size = max(int(batch_size), 1)
+        self.interval = interval
+        self.max_attempts = max(int(max_attempts), 1)
+        self.upsert = upsert
+        self.max_workers = max_workers
+
+        if path != ":memory:" and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        self._lock = threading.Lock()
+        # Only one batch is sent at a time, by the background thread or by flush().
+        self._sending = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # version counts the changes merged into each row, so that a row changed while it was being sent is kept.
+        self._db.execute("CREATE TABLE IF NOT EXISTS pending (obsid INTEGER PRIMARY KEY, data TEXT, version INTEGER, "
+                         "queued REAL, attempts INTEGER, next_attempt REAL, error TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS failed (obsid INTEGER PRIMARY KEY, data TEXT, attempts INTEGER, "
+                         "error TEXT, failed REAL)")
+        self._db.commit()
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mwaqa-writequeue")
+        self._thread.daemon = True
+        self._thread.start()
+        # Drain at exit, through a weak reference so that a closed queue (and its database) can be freed.
+        self._at_exit = functools.partial(_close_at_exit, weakref.ref(self))
+        atexit.register(self._at_exit)
+
+    def update(self, obsid, **columns):
+        """
+        Queue a change to the row of an obsid, e.g. update(1065880128, iono_qa=1, iono_magnitude=0.5).
+        """
+        unknown = set(columns) - set(QACOLUMNNAMES)
+        if unknown or "obsid" in columns:
+            raise ValueError("Can't queue changes to the columns %s" % ", ".join(sorted(unknown | set(columns) &
+                                                                                        {"obsid"})))
+        if not columns:
+            return
+        if self._stop.is_set():
+            raise ValueError("Can't queue changes once the queue is closed.")
+        obsid = int(obsid)
+        with self._lock:
+            row = self._db.execute("SELECT data, version FROM pending WHERE obsid = ?", (obsid,)).fetchone()
+            if row is None:
+                self._db.execute("INSERT INTO pending VALUES (?, ?, 1, ?, 0, 0, NULL)",
+                                 (obsid, json.dumps(columns), time.time()))
+            else:
+                data = json.loads(row[0])
+                data.update(columns)
+                self._db.execute("UPDATE pending SET data = ?, version = ? WHERE obsid = ?",
+                                 (json.dumps(data), row[1] + 1, obsid))
+            self._db.commit()
+            npending = self._db.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+        if npending >= self.batch_size:
+            self._wake.set()
+
+    def pending(self):
+        """
+        Return the number of obsids with changes waiting to be sent.
+        """
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def failed(self):
+        """
+        Return the changes which were given up on, as a list of (obsid, columns, error message) tuples.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT obsid, data, error FROM failed ORDER BY obsid").fetchall()
+        return [(obsid, json.loads(data), error) for obsid, data, error in rows]
+
+    def retry_failed(self):
+        """
+        Queue the failed changes again. Changes queued since they failed take precedence.
+        """
+        for obsid, columns, _ in self.failed():
+            with self._lock:
+                row = self._db.execute("SELECT data FROM pending WHERE obsid = ?", (obsid,)).fetchone()
+                if row is not None:
+                    columns.update(json.loads(row[0]))
+                self._db.execute("DELETE FROM failed WHERE obsid = ?", (obsid,))
+                self._db.commit()
+            self.update(obsid, **columns)
+
+    def _due(self, obsids=None):
+        """
+        Return a batch of changes which are due to be sent, or the changes to the given obsids whatever their backoff,
+        as a list of (obsid, columns, version, attempts) tuples.
+        """
+        with self._lock:
+            if obsids is None:
+                rows = self._db.execute("SELECT obsid, data, version, attempts FROM pending WHERE next_attempt <= ? "
+                                        "ORDER BY obsid LIMIT ?", (time.time(), self.batch_size)).fetchall()
+            else:
+                rows = []
+                for obsid in obsids:
+                    rows.extend(self._db.execute("SELECT obsid, data, version, attempts FROM pending WHERE obsid = ?",
+                                                 (obsid,)).fetchall())
+        return [(obsid, json.loads(data), version, attempts) for obsid, data, version, attempts in rows]
+
+    def _send(self, batch):
+        """
+        Send the changes of a batch, and return a dictionary of obsid: error message for those which failed.
+        """
+        # Once closing (perhaps at exit, when no new threads can be started), send the requests one at a time.
+        closing = self._stop.is_set()
+        if self.upsert:
+            rows = [dict(columns, obsid=obsid) for obsid, columns, _, _ in batch]
+            result = u.upsert_many(rows, user_name=self.user_name, secure_key=self.secure_key,
+                                   max_workers=0 if closing else self.max_workers)
+            if result is None:
+                return dict((obsid, "Request failed") for obsid, _, _, _ in batch)
+            return dict((rows[i]["obsid"], str(message)) for i, message in result["errors"].items())
+
+        from mwaqa import planner
+
+        # Obsids with identical changes share a request.
+        groups = {}
+        for obsid, columns, _, _ in batch:
+            groups.setdefault(json.dumps(columns, sort_keys=True), []).append(obsid)
+        requests = []
+        for key, obsids in groups.items():
+            for start in range(0, len(obsids), planner.MAXTERMS):
+                requests.append((json.loads(key), obsids[start:start + planner.MAXTERMS]))
+
+        def send(request):
+            columns, obsids = request
+            constraints = planner.any_of([("=", "obsid", obsid) for obsid in obsids])
+            return u.update(constraints=constraints, data=columns, user_name=self.user_name,
+                            secure_key=self.secure_key)
+
+        if len(requests) == 1 or closing:
+            results = [send(request) for request in requests]
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                results = list(pool.map(resilience.bind(send), requests))
+
+        errors = {}
+        for (_, obsids), result in zip(requests, results):
+            if result is None or not isinstance(result, dict) or not result.get("success", False):
+                message = str(result.get("errors") if isinstance(result, dict) else "Request failed")
+                errors.update((obsid, message) for obsid in obsids)
+        return errors
+
+    def _record(self, batch, errors):
+        now = time.time()
+        with self._lock:
+            for obsid, columns, version, attempts in batch:
+                if obsid not in errors:
+                    # Keep the row if it was changed while it was being sent, so the new changes are sent too.
+                    self._db.execute("DELETE FROM pending WHERE obsid = ? AND version = ?", (obsid, version))
+                elif attempts + 1 >= self.max_attempts:
+                    logger.error("giving up on the QA change to obsid %d after %d attempts: %s"
+                                 % (obsid, attempts + 1, errors[obsid]))
+                    self._db.execute("INSERT OR REPLACE INTO failed VALUES (?, ?, ?, ?, ?)",
+                                     (obsid, json.dumps(columns), attempts + 1, errors[obsid], now))
+                    self._db.execute("DELETE FROM pending WHERE obsid = ? AND version = ?", (obsid, version))
+                else:
+                    delay = random.uniform(0, min(MAXDELAY, BASEDELAY * 2 ** attempts))
+                    self._db.execute("UPDATE pending SET attempts = ?, next_attempt = ?, error = ? WHERE obsid = ?",
+                                     (attempts + 1, now + delay, errors[obsid], obsid))
+            self._db.commit()
+
+    def _flush_batch(self, obsids=None):
+        """
+        Send one batch of changes (see _due), and return the number of obsids sent and the number which failed.
+        """
+        with self._sending:
+            batch = self._due(obsids)
+            if not batch:
+                return 0, 0
+            try:
+                errors = self._send(batch)
+            except Exception as error:
+                errors = dict((obsid, "%s: %s" % (type(error).__name__, error)) for obsid, _, _, _ in batch)
+            if errors:
+                logger.warning("%d of %d QA changes failed; they will be retried" % (len(errors), len(batch)))
+            self._record(batch, errors)
+            return len(batch), len(errors)
+
+    def flush(self):
+        """
+        Send every change queued so far now (including those waiting to be retried), and wait for them to be sent.
+        Each change is sent once; those which fail are retried later, as usual.
+
+        :return: A dictionary with the number of obsids 'sent', the number which 'failed', and the number still
+                 'pending'.
+        """
+        with self._lock:
+            obsids = [row[0] for row in self._db.execute("SELECT obsid FROM pending ORDER BY obsid")]
+        sent = failed = 0
+        for start in range(0, len(obsids), self.batch_size):
+            nsent, nfailed = self._flush_batch(obsids[start:start + self.batch_size])
+            sent += nsent
+            failed += nfailed
+        return {"sent": sent, "failed": failed, "pending": self.pending()}
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                while self._flush_batch()[0] >= self.batch_size:
+                    pass
+            except Exception as error:
+                logger.error("the QA write queue failed: %s" % error)
+
+    def close(self):
+        """
+        Stop the background thread, and send whatever is left. Changes which still can't be sent stay in the file.
+        """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        # Python 2 has no atexit.unregister; there, the weak reference is left behind.
+        if hasattr(atexit, "unregister"):
+            atexit.unregister(self._at_exit)
+        self._wake.set()
+        self._thread.join()
+        result = self.flush()
+        if result["pending"]:
+            logger.warning("%d QA changes could not be sent, and are kept in %s" % (result["pending"], self.path))
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _close_at_exit(ref):
+    queue = ref()
+    if queue is not None:
+        queue.close()
@@ -8,16 +8,24 @@
 from __future__ import print_function
 from future.builtins import range, str
 
+import os
 import sys
+import atexit
+import errno
+import logging
 import argparse
 
-import numpy as np
-from astropy.io import ascii as ap_ascii
-
 from mwaqa.metadata import Query
+import mwaqa.cache
+import mwaqa.daemon
+import mwaqa.instrument
+import mwaqa.jobs
+from mwaqa.export import FORMATS, PRINTROWS, TEXTFORMATS, guess_format, write_table, print_rows
 
 
 if __name__ == "__main__":
+    logging.basicConfig(format="# %(levelname)s:%(name)s: %(message)s")
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--pagesize", type=int, default=10,
                         help="The limit on the number of results to return from the query. Default: %(default)s")
@@ -61,16 +69,66 @@ if __name__ == "__main__":
                         help="Integration time in seconds. e.g. 0.5")
     parser.add_argument("--minfiles", type=int,
                         help="Minimum number of files. e.g. 25")
+    parser.add_argument("--cache", action="store_true",
+                        help="Cache query results on disk (in %s), and re-use them while they are valid." % mwaqa.cache.DEFAULTPATH)
+    parser.add_argument("--daemon", action="store_true",
+                        help="Send requests through the mwaqa daemon (mwaqa_daemon.py), if it's running.")
+    parser.add_argument("--profile", action="store_true",
+                        help="At exit, print a breakdown of the time spent in each service call to stderr.")
     parser.add_argument("--csv", action="store_true",
                         help="Return results in a CSV format.")
     parser.add_argument("--output_filename", type=str,
                         help="The filename where CSV results are to be written. Default: %(default)s")
+    parser.add_argument("--format", type=str, choices=TEXTFORMATS + FORMATS,
+                        help="The format of the file written with --output_filename. By default, this is guessed "
+                             "from the file's extension, or CSV if the extension isn't recognised.")
+    parser.add_argument("--delimiter", type=str,
+                        help="Use this delimiter when printing CSV tables. Default: a comma, or a tab for TSV.")
     parser.add_argument("--brief", action="store_true",
                         help="Return only a few columns (disables the \"extended\" feature).")
+    parser.add_argument("--paginate", action="store_true",
+                        help="Fetch every page of results between mintime and maxtime, rather than only the first "
+                             "--pagesize results.")
+    parser.add_argument("--job", action="store_true",
+                        help="Like --paginate, but as a resumable job checkpointed in %s. If it is interrupted, run "
+                             "the same command again to fetch only what is missing." % mwaqa.jobs.DEFAULTPATH)
+    parser.add_argument("--max_workers", type=int, default=4,
+                        help="The maximum number of pages to fetch at once with --paginate or --job. Default: %(default)s")
     args = parser.parse_args()
 
     # Parameters not related to the MWA metadata service.
-    unrelated = ["csv", "output_filename", "brief"]
+    unrelated = ["obsid_file", "csv", "output_filename", "brief", "paginate", "max_workers", "cache", "format",
+                 "delimiter", "job", "profile", "daemon"]
+
+    if args.cache:
+        mwaqa.cache.enable()
+
+    # Use the daemon's connections and cache, if asked to and it's running.
+    if args.daemon and mwaqa.daemon.connect() is None:
+        print("The mwaqa daemon isn't running; making requests directly.", file=sys.stderr)
+
+    if args.profile:
+        profile = mwaqa.instrument.add_sink(mwaqa.instrument.HistogramSink())
+        atexit.register(profile.report, sys.stderr)
+
+    # Work out the output format: CSV (or TSV) if printing with --csv or writing
+    # to a file with an unrecognised extension.
+    if args.format is None and args.output_filename:
+        args.format = guess_format(args.output_filename) or "csv"
+    elif args.format is None and args.csv:
+        args.format = "csv"
+    if args.format in FORMATS and not args.output_filename:
+        print("The %s format needs an output file (--output_filename)." % args.format,
+              file=sys.stderr)
+        exit(1)
+
+    # Make it possible to use tabs as delimiters from the command line.
+    if args.delimiter == "\\t":
+        args.delimiter = "\t"
+    writer_options = {}
+    if args.format in TEXTFORMATS and args.delimiter:
+        writer_options["delimiter"] = args.delimiter
+    output = args.output_filename or sys.stdout
 
     # Create a query object.
     q = Query(extended_results=not args.brief)
@@ -82,32 +140,71 @@ if __name__ == "__main__":
         elif getattr(args, arg) is not None:
             q.params[arg] = getattr(args, arg)
 
-    # If we've been passed a file, just query all obsids between the
-    # minimum and maximum inside the file, then prune the ones not in the file.
+    # If we've been passed a file, query time windows around the runs of
+    # neighbouring obsids inside the file, then prune the ones not in the file.
     if args.obsid_file:
-        obsids = np.loadtxt(args.obsid_file, dtype=int)
-        q.params["mintime"] = np.min(obsids).astype(str)
-        q.params["maxtime"] = np.max(obsids).astype(str)
+        # These need NumPy, which is slow to import, so only import them here.
+        from mwaqa.obsids import load as load_obsids, prune_table
+        from mwaqa import planner
+
+        obsids = load_obsids(args.obsid_file)
+        q.params["mintime"] = str(obsids.min())
+        q.params["maxtime"] = str(obsids.max())
 
-    # Make the query.
-    q.make_query()
+    if args.job and args.obsid_file:
+        print("Cannot combine --job with --obsid_file",
+              file=sys.stderr)
+        exit(1)
+    elif args.job:
+        try:
+            job = mwaqa.jobs.FindJob(q)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            exit(1)
+        progress = job.progress()
+        if progress["shards"] and progress["missing"]:
+            print("Resuming job %s: %d results already fetched, %d shards to go."
+                  % (job.id, progress["rows"], progress["missing"]),
+                  file=sys.stderr)
+        try:
+            job.run(max_workers=args.max_workers)
+        except RuntimeError as error:
+            print("%s\nRun the same command again to resume." % error,
+                  file=sys.stderr)
+            exit(1)
+
+    # Make the query. A single page (or a finished job) is written out in
+    # batches, as it arrives.
+    if args.format and args.job:
+        job.export(output, format=args.format, **writer_options)
+        exit(0)
+    elif args.job:
+        q.table = job.table()
+    elif args.format and not args.obsid_file and not args.paginate:
+        try:
+            q.export(output, format=args.format, **writer_options)
+        except IOError as error:
+            # Stop quietly if the output was piped into (e.g.) head, and it has exited.
+            if error.errno != errno.EPIPE:
+                raise
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        exit(0)
+    elif not args.format and not args.obsid_file and not args.paginate and args.pagesize <= PRINTROWS:
+        # Print a single small page without building a table, as astropy is
+        # slow to import.
+        print_rows(q.fetch_rows(), q.column_names)
+        exit(0)
+    elif args.obsid_file:
+        q.make_paged_query(max_workers=args.max_workers, windows=planner.windows(obsids))
+    elif args.paginate:
+        q.make_paged_query(max_workers=args.max_workers)
+    else:
+        q.make_query()
 
     if args.obsid_file:
-        to_be_deleted = []
-        for i, o in enumerate(q.table["Obsid"]):
-            if o not in obsids:
-                to_be_deleted.append(i)
-        q.table.remove_rows(to_be_deleted)
-
-    # If the output_filename has been specified, then we don't need to print the
-    # query results, only write them to a file.
-    if args.output_filename:
-        q.write_csv(output_filename=args.output_filename)
-    # Otherwise, handle the printing.
+        q.table = prune_table(q.table, obsids, column="Obsid")
+
+    if args.format:
+        write_table(q.table, output, format=args.format, **writer_options)
     else:
-        if args.csv:
-            ap_ascii.write(q.table,
-                           sys.stdout,
-                           delimiter=',')
-        else:
-            q.table.pprint(max_lines=-1, max_width=-1)
+        q.flat_table().pprint(max_lines=-1, max_width=-1)
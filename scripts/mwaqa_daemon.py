@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Run a local daemon which makes QA and metadata requests for the other
+# scripts when given --daemon (and anything else using the mwaqa library
+# which calls mwaqa.daemon.connect()), keeping its connections open and
+# recent results in memory. Stop it with Ctrl-C or SIGTERM.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range, str
+
+import sys
+import signal
+import logging
+import argparse
+
+import mwaqa.daemon
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default=mwaqa.daemon.DEFAULTPATH,
+                        help="The Unix socket to listen on. Default: %(default)s")
+    parser.add_argument("--max_mb", type=int, default=mwaqa.daemon.DEFAULTMAXBYTES // 2 ** 20,
+                        help="The size budget of the in-memory cache of results, in MB. Default: %(default)s")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Log every request. Default: %(default)s")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="# %(levelname)s:%(name)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    # Remove the socket on SIGTERM, as well as on Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        mwaqa.daemon.serve(args.socket, max_bytes=args.max_mb * 2 ** 20)
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as error:
+        print(error, file=sys.stderr)
+        exit(1)
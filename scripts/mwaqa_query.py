@@ -28,37 +28,113 @@
 from __future__ import print_function, division
 from future.builtins import range, str
 
+import os
 import sys
+import atexit
+import errno
+import logging
 import argparse
 
-import numpy as np
-from astropy.table import Table
-from astropy.io import ascii as ap_ascii
 
 import mwaqa.util as u
+import mwaqa.cache
+import mwaqa.daemon
+import mwaqa.instrument
+import mwaqa.jobs
+from mwaqa.export import FORMATS, PRINTROWS, TEXTFORMATS, guess_format, open_writer, print_rows
 
 
-def query(args,
-          columns=("obsid", "projectid", "lowest_channel", "eor_field", "iono_qa"),
-          pagesize=10,
-          actual_obsids=None,
-          warn=True):
-
+def make_constraints(args):
     if not args.obsid and not args.min:
         print("Expected --min, but it was not specified!",
               file=sys.stderr)
         exit(1)
 
     if args.obsid:
-        constraints = ("=", "obsid", args.obsid)
+        return ("=", "obsid", args.obsid)
     elif args.max:
-        constraints = ("and",
-                       (">=", "obsid", args.min),
-                       ("<=", "obsid", args.max))
+        return ("and",
+                (">=", "obsid", args.min),
+                ("<=", "obsid", args.max))
     else:
-        constraints = (">=", "obsid", args.min)
+        return (">=", "obsid", args.min)
+
+
+def export(args, columns, writer, batch_size=10000, warn=True):
+    """
+    Write the query results to writer in batches, as they are decoded, rather
+    than holding them all in memory.
+    """
+    # Delimited text needs no table; write the values as they are.
+    if hasattr(writer, "write_rows"):
+        write = writer.write_rows
+    else:
+        from mwaqa.tables import table_from_rows
+        write = lambda rows: writer.write(table_from_rows(rows, columns))
+
+    if args.obsid_file:
+        from mwaqa.obsids import load as load_obsids
+        results = query(args, columns=columns, pagesize=10000, actual_obsids=load_obsids(args.obsid_file))
+        write(results["rows"])
+        return
+
+    if args.job:
+        job = run_job(args, columns)
+        for rows in job.iter_batches():
+            write(rows)
+        return
+
+    nrows = 0
+    for rows in u.iselect(constraints=make_constraints(args),
+                          column_list=columns,
+                          pagesize=args.pagesize,
+                          batch_size=batch_size):
+        write(rows)
+        nrows += len(rows)
+    if nrows == 0:
+        write([])
+
+    # Warn if we've hit the pagesize limit of results.
+    if warn and nrows >= args.pagesize:
+        print("Query results may be truncated due to the pagesize parameter.",
+              file=sys.stderr)
+
+
+def run_job(args, columns):
+    """
+    Fetch every row between --min and --max as a resumable job. If an earlier
+    run of the same command was interrupted, only the missing shards are
+    fetched.
+    """
+    job = mwaqa.jobs.SelectJob(column_list=columns, min_obsid=args.min, max_obsid=args.max)
+    progress = job.progress()
+    if progress["shards"] and progress["missing"]:
+        print("Resuming job %s: %d rows already fetched, %d shards to go."
+              % (job.id, progress["rows"], progress["missing"]),
+              file=sys.stderr)
+    try:
+        job.run(max_workers=args.max_workers)
+    except RuntimeError as error:
+        print("%s\nRun the same command again to resume." % error,
+              file=sys.stderr)
+        exit(1)
+    return job
+
+
+def query(args,
+          columns=("obsid", "projectid", "lowest_channel", "eor_field", "iono_qa"),
+          pagesize=10,
+          actual_obsids=None,
+          warn=True):
 
-    results = u.select(constraints=constraints,
+    # Fetch a list of obsids with as few, and as tight, requests as possible.
+    if actual_obsids is not None:
+        return u.select_obsids(actual_obsids,
+                               column_list=columns,
+                               max_workers=args.max_workers,
+                               pagesize=pagesize)
+
+    results = u.select(constraints=make_constraints(args),
                        column_list=columns,
                        pagesize=pagesize)
 
@@ -67,20 +143,12 @@ def query(args,
         print("Query results may be truncated due to the pagesize parameter.",
               file=sys.stderr)
 
-    # If actual_obsids is specified, then prune obsids that do not belong.
-    if actual_obsids is not None:
-        to_be_deleted = []
-        for i, row in enumerate(results["rows"]):
-            obsid = row[0]
-            if obsid not in actual_obsids:
-                to_be_deleted.append(i)
-        for i in reversed(to_be_deleted):
-            del results["rows"][i]
-
     return results
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format="# %(levelname)s:%(name)s: %(message)s")
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--pagesize", type=int, default=10,
                         help="The limit on the number of results to return from the query. Default: %(default)s")
@@ -92,12 +160,29 @@ if __name__ == '__main__':
                         help="Use this parameter to specify the latest obsid in a range.")
     parser.add_argument("--obsid_file", type=str,
                         help="Use this parameter to specify a file of obsids.")
+    parser.add_argument("--max_workers", type=int, default=4,
+                        help="The maximum number of requests to run at once for an --obsid_file query or a --job. "
+                             "Default: %(default)s")
+    parser.add_argument("--job", action="store_true",
+                        help="Fetch every row between --min and --max (or now), regardless of --pagesize, as a resumable "
+                             "job checkpointed in %s. If it is interrupted, run the same command again to fetch only "
+                             "what is missing." % mwaqa.jobs.DEFAULTPATH)
+    parser.add_argument("--cache", action="store_true",
+                        help="Cache query results on disk (in %s), and re-use them while they are valid." % mwaqa.cache.DEFAULTPATH)
+    parser.add_argument("--daemon", action="store_true",
+                        help="Send requests through the mwaqa daemon (mwaqa_daemon.py), if it's running.")
+    parser.add_argument("--profile", action="store_true",
+                        help="At exit, print a breakdown of the time spent in each service call to stderr.")
     parser.add_argument("--csv", action="store_true",
-                        help="Print results in a CSV format.")
+                        help="Print results in a CSV format, as they arrive.")
     parser.add_argument("-f", "--output_filename", type=str,
-                        help="If specified, write the query results as a CSV to the specified file. By default, results are printed to screen.")
-    parser.add_argument("--delimiter", type=str, default=',',
-                        help="Use this delimiter when printing CSV tables.")
+                        help="If specified, write the query results to the specified file (as a CSV, unless --format or "
+                             "the file's extension say otherwise). By default, results are printed to screen.")
+    parser.add_argument("--format", type=str, choices=TEXTFORMATS + FORMATS,
+                        help="The format of the file written with -f. By default, this is guessed from the file's "
+                             "extension, or CSV if the extension isn't recognised.")
+    parser.add_argument("--delimiter", type=str,
+                        help="Use this delimiter when printing CSV tables. Default: a comma, or a tab for TSV.")
     parser.add_argument("--projectid", action="store_false",
                         help="Print the projectid column. Default: %(default)s")
     parser.add_argument("--lowest_channel", action="store_false",
@@ -133,17 +218,21 @@ if __name__ == '__main__':
         print("Cannot combine --obsid with --obsid_file",
               file=sys.stderr)
         exit(1)
+    elif args.job and (args.obsid or args.obsid_file):
+        print("--job needs a range of obsids (--min and --max)",
+              file=sys.stderr)
+        exit(1)
 
-    # Print in a CSV format if the output_filename argument is set.
-    if (not args.csv and args.output_filename):
-        args.csv = True
+    if args.cache:
+        mwaqa.cache.enable()
 
-    if args.output_filename is None:
-        args.output_filename = sys.stdout
+    # Use the daemon's connections and cache, if asked to and it's running.
+    if args.daemon and mwaqa.daemon.connect() is None:
+        print("The mwaqa daemon isn't running; making requests directly.", file=sys.stderr)
 
-    # Make it possible to use tabs as delimiters from the command line.
-    if args.delimiter == "\\t":
-        args.delimiter = "\t"
+    if args.profile:
+        profile = mwaqa.instrument.add_sink(mwaqa.instrument.HistogramSink())
+        atexit.register(profile.report, sys.stderr)
 
     columns = ["obsid", "projectid", "lowest_channel", "eor_field", "gridpoint_number", "iono_qa"]
     column_dict = {
@@ -158,21 +247,54 @@ if __name__ == '__main__':
         elif v:
             columns.append(k)
 
-    # If we've been passed a file, just query all obsids between the
-    # minimum and maximum inside the file, then prune the ones not in the file.
+    # Work out the output format: CSV (or TSV) if printing with --csv or writing
+    # to a file with an unrecognised extension.
+    if args.format is None and args.output_filename:
+        args.format = guess_format(args.output_filename) or "csv"
+    elif args.format is None and args.csv:
+        args.format = "csv"
+    if args.format in FORMATS and not args.output_filename:
+        print("The %s format needs an output file (-f)." % args.format,
+              file=sys.stderr)
+        exit(1)
+
+    if args.output_filename is None:
+        args.output_filename = sys.stdout
+
+    # Make it possible to use tabs as delimiters from the command line.
+    if args.delimiter == "\\t":
+        args.delimiter = "\t"
+    writer_options = {}
+    if args.format in TEXTFORMATS:
+        writer_options["columns"] = columns
+        if args.delimiter:
+            writer_options["delimiter"] = args.delimiter
+
+    # Write the results in batches, as they arrive.
+    if args.format:
+        try:
+            with open_writer(args.output_filename, format=args.format, **writer_options) as writer:
+                export(args, columns, writer)
+        except IOError as error:
+            # Stop quietly if the output was piped into (e.g.) head, and it has exited.
+            if error.errno != errno.EPIPE:
+                raise
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        exit(0)
+
+    # Otherwise, print a table to the screen. Small tables are printed without
+    # astropy, which is slow to import.
     if args.obsid_file:
-        obsids = np.loadtxt(args.obsid_file, dtype=int)
-        args.min = np.min(obsids).astype(str)
-        args.max = np.max(obsids).astype(str)
-        results = query(args, columns=columns, pagesize=100000000, actual_obsids=obsids)
+        from mwaqa.obsids import load as load_obsids
+        obsids = load_obsids(args.obsid_file)
+        results = query(args, columns=columns, pagesize=10000, actual_obsids=obsids)
+    elif args.job:
+        results = {"rows": run_job(args, columns).rows()}
     else:
         results = query(args, columns=columns, pagesize=args.pagesize)
 
-    t = Table(np.array(results["rows"]), names=columns)
-    if args.csv:
-        ap_ascii.write(t,
-                       args.output_filename,
-                       overwrite=True,
-                       delimiter=args.delimiter)
+    if len(results["rows"]) <= PRINTROWS:
+        print_rows(results["rows"], columns)
     else:
-        t.pprint(max_lines=-1, max_width=-1)
+        from mwaqa.tables import table_from_rows
+        table_from_rows(results["rows"], columns).pprint(max_lines=-1, max_width=-1)
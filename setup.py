@@ -22,8 +22,12 @@ setup(name="mwaqa",
       license="MPL 2.0",
       keywords="",
       packages=["mwaqa"],
-      scripts=["scripts/mwaqa_query.py"],
+      scripts=["scripts/mwaqa_query.py", "scripts/mwaqa_daemon.py"],
       install_requires=["numpy",
                         "astropy",
-                        "future"],
+                        "future",
+                        "futures; python_version < '3'"],
+      extras_require={"parquet": ["pyarrow"],
+                      "feather": ["pyarrow"],
+                      "hdf5": ["h5py"]},
      )
@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+import server
+
+
+@pytest.fixture
+def stand_ins():
+    """
+    A function which starts a local stand-in for the web services (see benchmarks/server.py), taking the same
+    arguments as server.start(). Every server started is stopped after the test.
+    """
+    started = []
+
+    def start(**kwargs):
+        kwargs.setdefault("nrows", 100)
+        started.append(server.start(**kwargs))
+        return started[-1]
+    yield start
+    for stand_in in started:
+        stand_in.shutdown()
+        stand_in.server_close()
+
+
+@pytest.fixture
+def stand_in(stand_ins):
+    return stand_ins()
+
+
+@pytest.fixture
+def misbehave(monkeypatch):
+    """
+    Return a list of actions for the stand-in servers to take on the requests they receive, in turn: None to answer
+    normally, "close" to close the connection without answering, "stall" to answer after half a second, or "partial"
+    to send the start of a response and then close the connection.
+    """
+    actions = []
+    handle = server.Handler._handle
+
+    def misbehaving(self, query):
+        action = actions.pop(0) if actions else None
+        if action in ("close", "partial"):
+            if action == "partial":
+                self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n{\"rows\"")
+                self.wfile.flush()
+            self.close_connection = True
+            return
+        if action == "stall":
+            time.sleep(0.5)
+        handle(self, query)
+
+    monkeypatch.setattr(server.Handler, "_handle", misbehaving)
+    return actions
@@ -0,0 +1,129 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import sys
+import json
+import asyncio
+
+import pytest
+
+if sys.version_info < (3, 7):
+    pytest.skip("mwaqa.aio needs Python 3.7 or later", allow_module_level=True)
+
+from urllib.error import HTTPError, URLError
+
+from mwaqa import aio, cache
+
+COLUMNS = ["obsid", "projectid", "iono_qa"]
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.setattr(cache, "ACTIVE", None)
+
+
+def expected_rows(stand_in, pagesize):
+    result = stand_in.select({"constraints": "null", "column_list": json.dumps(COLUMNS), "limit": str(pagesize)})
+    return json.loads(json.dumps(result))["rows"]
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+@pytest.mark.parametrize("gzip", [False, True])
+def test_select(stand_ins, chunked, gzip):
+    stand_in = stand_ins(chunked=chunked)
+
+    async def run():
+        async with aio.Client(baseurl=stand_in.baseurl, gzip=gzip) as client:
+            return await client.select(column_list=COLUMNS, pagesize=50)
+    result = asyncio.run(run())
+    assert result["success"]
+    assert result["rows"] == expected_rows(stand_in, 50)
+
+
+def test_keep_alive_reuse(stand_ins):
+    stand_in = stand_ins(chunked=True)
+
+    async def run():
+        async with aio.Client(baseurl=stand_in.baseurl) as client:
+            for _ in range(5):
+                await client.select(column_list=COLUMNS, pagesize=10)
+    asyncio.run(run())
+    assert stand_in.requests == 5
+    assert stand_in.connections == 1
+
+
+def test_concurrency_limit(stand_in):
+    async def run():
+        async with aio.Client(baseurl=stand_in.baseurl, max_concurrency=2) as client:
+            return await asyncio.gather(*[client.select(column_list=COLUMNS, pagesize=10) for _ in range(6)])
+    assert all(result["success"] for result in asyncio.run(run()))
+    assert stand_in.connections <= 2
+
+
+def test_client_reused_across_event_loops(stand_in):
+    client = aio.Client(baseurl=stand_in.baseurl)
+
+    async def run():
+        return await client.select(column_list=COLUMNS, pagesize=10)
+    assert asyncio.run(run())["success"]
+    assert asyncio.run(run())["success"]
+
+
+def test_error_status(stand_in, capsys):
+    async def run():
+        async with aio.Client(baseurl=stand_in.baseurl) as client:
+            with pytest.raises(HTTPError) as error:
+                await client.request(stand_in.baseurl + "quality/missing")
+            assert error.value.code == 404
+            # getmeta reports errors as util.getmeta does, and the connection is still usable afterwards.
+            assert await client.getmeta(servicetype="quality", service="missing") is None
+            return await client.select(column_list=COLUMNS, pagesize=10)
+    assert asyncio.run(run())["success"]
+    assert "code=404" in capsys.readouterr().out
+    assert stand_in.connections == 1
+
+
+def test_network_error(stand_in):
+    url = stand_in.baseurl
+    stand_in.shutdown()
+    stand_in.server_close()
+
+    async def run():
+        async with aio.Client(baseurl=url) as client:
+            await client.request(url + "quality/select")
+    with pytest.raises(URLError):
+        asyncio.run(run())
+
+
+def test_find(stand_in):
+    async def run():
+        async with aio.Client(findurl=stand_in.findurl) as client:
+            query = aio.Query(pagesize=20)
+            query.params.update(mintime=0, maxtime=2 ** 31)
+            return await query.fetch(client)
+    table = asyncio.run(run())
+    assert len(table) == 20
+
+
+def test_closed_keep_alive_connection_is_retried(stand_in, misbehave):
+    misbehave.extend([None, "close"])
+
+    async def run():
+        async with aio.Client(baseurl=stand_in.baseurl) as client:
+            await client.select(column_list=COLUMNS, pagesize=10)
+            return await client.select(column_list=COLUMNS, pagesize=10)
+    assert asyncio.run(run())["rows"] == expected_rows(stand_in, 10)
+    assert (stand_in.requests, stand_in.connections) == (2, 2)
+
+
+def test_partial_response_is_not_retried(stand_in, misbehave):
+    misbehave.extend([None, "partial"])
+
+    async def run():
+        async with aio.Client(baseurl=stand_in.baseurl) as client:
+            await client.select(column_list=COLUMNS, pagesize=10)
+            return await client.select(column_list=COLUMNS, pagesize=10)
+    # Network errors are reported, as by util.select(), rather than raised.
+    assert asyncio.run(run()) is None
+    assert (stand_in.requests, stand_in.connections) == (1, 1)
@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import pytest
+
+import server
+import mwaqa.util as u
+from mwaqa import cache, daemon, flight, metadata
+
+SELECT = "http://mro.example/quality/select?limit=10&column_list=%5B%22obsid%22%5D"
+FIND = "http://mro.example/metadata/find/?search=search&pagesize=10"
+UPDATE = "http://mro.example/quality/update?data=%7B%7D"
+RESULT = {"rows": [[1065880128]], "errors": {}, "success": True}
+
+
+class Clock(object):
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(cache.time, "time", lambda: self.now)
+
+
+@pytest.fixture(params=["disk", "memory"])
+def make_cache(request, tmpdir):
+    def make(**kwargs):
+        if request.param == "disk":
+            return cache.ResponseCache(str(tmpdir.join("responses.sqlite")), **kwargs)
+        return cache.MemoryCache(**kwargs)
+    return make
+
+
+def test_canonical_url():
+    assert cache.canonical_url("http://h/quality/select/?b=2&a=1") == cache.canonical_url("http://h/quality/select?a=1&b=2")
+    assert cache.service_name(SELECT) == "quality/select"
+    assert cache.service_name(FIND) == "metadata/find"
+
+
+def test_hit_and_miss(make_cache):
+    c = make_cache()
+    assert c.get(SELECT) is None
+    c.put(SELECT, RESULT)
+    # Equivalent URLs share an entry.
+    assert c.get("http://mro.example/quality/select?column_list=%5B%22obsid%22%5D&limit=10") == RESULT
+    assert c.get(SELECT.replace("limit=10", "limit=11")) is None
+    assert (c.hits, c.misses) == (1, 2)
+
+
+def test_expiry(make_cache, monkeypatch):
+    clock = Clock(monkeypatch)
+    c = make_cache(ttls={"quality/select": 10})
+    c.put(SELECT, RESULT)
+    c.put(FIND, [{"mwas.starttime": 1065880128}])
+    clock.now += 10
+    assert c.get(SELECT) == RESULT
+    clock.now += 1
+    assert c.get(SELECT) is None
+    # metadata/find keeps its default TTL.
+    assert c.get(FIND) is not None
+
+
+def test_failures_are_not_cached(make_cache):
+    c = make_cache()
+    for failure in ({"success": False, "errors": {"0": "database unavailable"}, "rows": []},
+                    {"errors": {"0": "bad constraints"}},
+                    "Internal Server Error"):
+        c.put(SELECT, failure)
+        assert c.get(SELECT) is None
+    assert c.size() == 0
+
+
+def test_writes_invalidate_selects(make_cache):
+    c = make_cache()
+    c.put(SELECT, RESULT)
+    c.put(SELECT.replace("limit=10", "limit=20"), RESULT)
+    c.put(FIND, [{"mwas.starttime": 1065880128}])
+    c.invalidate_for_write(UPDATE)
+    assert c.get(SELECT) is None
+    assert c.get(SELECT.replace("limit=10", "limit=20")) is None
+    assert c.get(FIND) is not None
+
+
+def test_lru_eviction(make_cache, monkeypatch):
+    clock = Clock(monkeypatch)
+    entry = {"rows": [["x" * 1000]], "errors": {}, "success": True}
+    probe = make_cache()
+    probe.put(SELECT, entry)
+    c = make_cache(max_bytes=probe.size() * 3)
+    urls = [SELECT.replace("limit=10", "limit=%d" % i) for i in range(4)]
+    for url in urls[:3]:
+        clock.now += 1
+        c.put(url, entry)
+    clock.now += 1
+    assert c.get(urls[0]) is not None
+    clock.now += 1
+    c.put(urls[3], entry)
+    # The least recently used entry (urls[1]) made room for the new one.
+    assert [c.get(url) is not None for url in urls] == [True, False, True, True]
+    assert c.size() <= c.max_bytes
+
+
+def test_getmeta_cache(stand_in, monkeypatch, tmpdir):
+    state = {"fail": 1}
+    respond = server.Server.respond
+
+    def flaky(self, path, params):
+        if "select" in path and state["fail"]:
+            state["fail"] -= 1
+            return {"success": False, "errors": {"0": "database unavailable"}, "rows": []}
+        return respond(self, path, params)
+
+    monkeypatch.setattr(server.Server, "respond", flaky)
+    monkeypatch.setattr(u, "BASEURL", stand_in.baseurl + "mro/")
+    monkeypatch.setattr(u, "KEYS", {None: None, u.DEFAULTID: "test"})
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", None)
+    monkeypatch.setattr(cache, "ACTIVE", cache.ResponseCache(str(tmpdir.join("responses.sqlite"))))
+
+    def select():
+        return u.select(column_list=["obsid"], pagesize=5)
+
+    assert select()["success"] is False
+    assert select()["success"] is True
+    assert select()["success"] is True
+    assert stand_in.requests == 2
+    u.update(constraints=("=", "obsid", 1), data={"iono_qa": 1})
+    assert select()["success"] is True
+    assert stand_in.requests == 4
+    cache.ACTIVE.close()
+
+
+def test_persists_across_instances(tmpdir, monkeypatch):
+    clock = Clock(monkeypatch)
+    path = str(tmpdir.join("sub", "responses.sqlite"))
+    c = cache.ResponseCache(path, ttls={"quality/select": 10})
+    c.put(SELECT, RESULT)
+    size = c.size()
+    c.close()
+    c = cache.ResponseCache(path, ttls={"quality/select": 10})
+    assert c.get(SELECT) == RESULT
+    assert c.size() == size
+    # Entries keep their original age.
+    clock.now += 11
+    assert c.get(SELECT) is None
+    c.close()
+
+
+def test_oversized_results_are_not_stored(make_cache):
+    c = make_cache(max_bytes=10)
+    c.put(SELECT, {"rows": [["x" * 1000]], "errors": {}, "success": True})
+    assert c.get(SELECT) is None
+    assert c.size() == 0
+
+
+def test_enable_and_disable(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    path = str(tmpdir.join("responses.sqlite"))
+    active = cache.enable(path, ttls={"metadata/find": 60})
+    try:
+        assert cache.ACTIVE is active
+        assert (active.path, active.ttl("metadata/find"), active.ttl("quality/select")) == (path, 60, 3600)
+        active.put(SELECT, RESULT)
+        # Enabling again replaces (and closes) the active cache, but keeps its results.
+        assert cache.enable(path) is not active
+        assert cache.ACTIVE.get(SELECT) == RESULT
+    finally:
+        cache.disable()
+    assert cache.ACTIVE is None
+
+
+def test_query_cache(stand_ins, monkeypatch, tmpdir):
+    stand_in = stand_ins(nrows=200)
+    monkeypatch.setattr(metadata, "FINDURL", stand_in.findurl)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", None)
+    monkeypatch.setattr(cache, "ACTIVE", cache.ResponseCache(str(tmpdir.join("responses.sqlite"))))
+
+    def query():
+        q = metadata.Query(pagesize=50)
+        q.params.update(mintime=server.FIRSTOBSID, maxtime=server.FIRSTOBSID + 99 * server.SPACING)
+        return q.paged_results()
+
+    first = query()
+    requests = stand_in.requests
+    assert query() == first
+    assert len(first) == 100
+    assert stand_in.requests == requests
+    cache.ACTIVE.close()
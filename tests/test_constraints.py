@@ -0,0 +1,153 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+
+import sqlite3
+
+import numpy as np
+import pytest
+from astropy.table import Table, MaskedColumn
+
+from mwaqa import constraints as c
+
+
+def data():
+    # One non-null, one NaN/None and one masked value in each column.
+    return {"obsid": np.array([1, 2, 3, 4]),
+            "iono_qa": np.ma.array([1.0, np.nan, 3.0, 4.0], mask=[False, False, True, False]),
+            "projectid": np.array(["G0009", None, "D0005", "G_10%"], dtype=object)}
+
+
+def test_evaluate_comparisons_with_nulls():
+    assert list(c.evaluate((">", "iono_qa", 2), data())) == [False, False, False, True]
+    assert list(c.evaluate(("<=", "iono_qa", 2), data())) == [True, False, False, False]
+    assert list(c.evaluate(("=", "projectid", "G0009"), data())) == [True, False, False, False]
+    assert list(c.evaluate(("!=", "projectid", "G0009"), data())) == [False, False, True, True]
+    # A comparison with a null literal is never true, even "=".
+    assert not c.evaluate(("=", "obsid", None), data()).any()
+    assert not c.evaluate(("!=", "obsid", None), data()).any()
+
+
+def test_evaluate_not_of_null_is_not_true():
+    # Rows 2 (NaN) and 3 (masked) satisfy neither the comparison nor its negation.
+    assert list(c.evaluate(("not", (">", "iono_qa", 2)), data())) == [True, False, False, False]
+    assert list(c.evaluate(("not", ("not", (">", "iono_qa", 2))), data())) == [False, False, False, True]
+
+
+def test_evaluate_three_valued_and_or():
+    null = (">", "iono_qa", 0)   # Null in rows 2 and 3, true otherwise.
+    true = (">", "obsid", 0)
+    false = ("<", "obsid", 0)
+    # null AND false is false; null AND true is null.
+    assert list(c.evaluate(("not", ("and", null, false)), data())) == [True, True, True, True]
+    assert list(c.evaluate(("not", ("and", null, true)), data())) == [False, False, False, False]
+    # null OR true is true; null OR false is null.
+    assert list(c.evaluate(("or", null, true), data())) == [True, True, True, True]
+    assert list(c.evaluate(("not", ("or", null, false)), data())) == [False, False, False, False]
+
+
+def test_evaluate_column_to_column_and_tables():
+    t = Table([MaskedColumn([1, 2, 3], name="a", mask=[False, False, True]), MaskedColumn([1, 3, 1], name="b")])
+    assert list(c.evaluate(("<", "a", "b"), t)) == [False, True, False]
+    assert list(c.evaluate(None, t)) == [True, True, True]
+    assert len(c.filter_table(t, ("=", "a", "b"))) == 1
+    assert list(c.compile_constraints((">=", "b", 2), columns=["a", "b"])(t)) == [False, True, False]
+
+
+def test_evaluate_like():
+    d = data()
+    assert list(c.evaluate(("like", "projectid", "G%"), d)) == [True, False, False, True]
+    assert list(c.evaluate(("like", "projectid", "%"), d)) == [True, False, True, True]
+    assert list(c.evaluate(("like", "projectid", "_000_"), d)) == [True, False, True, False]
+    # Escaped wildcards only match themselves.
+    assert list(c.evaluate(("like", "projectid", "G\\_10\\%"), d)) == [False, False, False, True]
+    assert list(c.evaluate(("like", "projectid", "G\\_%"), d)) == [False, False, False, True]
+
+
+@pytest.mark.parametrize("pattern,matches,nonmatches", [
+    ("abc", ["abc"], ["abcd", "xabc", "ABC"]),
+    ("a%c", ["ac", "abc", "a\nbc"], ["acd", "ab"]),
+    ("a_c", ["abc", "a.c"], ["ac", "abbc"]),
+    ("100\\%", ["100%"], ["1000", "100"]),
+    ("a\\_c", ["a_c"], ["abc"]),
+    ("a\\\\b", ["a\\b"], ["ab"]),
+    ("trailing\\", ["trailing\\"], ["trailing"]),
+    ("1.5*(x)+[y]?$^|{2}", ["1.5*(x)+[y]?$^|{2}"], ["115xx+y$^|{2}", "1.5*(x)+[y]?$^|{2}!"]),
+])
+def test_like_to_regex(pattern, matches, nonmatches):
+    regex = c.like_to_regex(pattern)
+    for s in matches:
+        assert regex.match(s), (pattern, s)
+    for s in nonmatches:
+        assert not regex.match(s), (pattern, s)
+
+
+@pytest.mark.parametrize("constraints", [
+    ("=", "obsid"),
+    ("between", "obsid", 1),
+    ("and", ("=", "obsid", 1)),
+    ("and", ("=", "obsid", 1), "obsid"),
+    ("not", "obsid"),
+    ("=", "obsid", [1, 2]),
+    ("like", "projectid", 5),
+    [],
+    "obsid",
+])
+def test_validate_rejects(constraints):
+    with pytest.raises(ValueError):
+        c.validate(constraints)
+
+
+def test_validate_columns():
+    c.validate(None)
+    c.validate(("and", ("=", "obsid", 1), ("not", ("like", "projectid", "G%"))), columns=["obsid", "projectid"])
+    with pytest.raises(ValueError):
+        c.validate(("=", "nosuchcolumn", 1), columns=["obsid"])
+
+
+def test_to_sql_matches_evaluate():
+    constraints = ("or",
+                   ("and", (">=", "obsid", 2), ("not", ("like", "projectid", "G%"))),
+                   ("=", "iono_qa", 1.0))
+    sql, params = c.to_sql(constraints, columns=["obsid", "iono_qa", "projectid"])
+    assert sql == '((("obsid" >= ?) AND (NOT ("projectid" LIKE ?))) OR ("iono_qa" = ?))'
+    assert params == [2, "G%", 1.0]
+    assert c.to_sql(None) == ("1", [])
+
+    # SQLite has the same three-valued logic as evaluate(), and (with case_sensitive_like) the same LIKE.
+    d = data()
+    db = sqlite3.connect(":memory:")
+    db.execute("PRAGMA case_sensitive_like = ON")
+    db.execute("CREATE TABLE qa (obsid INTEGER, iono_qa REAL, projectid TEXT)")
+    iono_qa = [None if m or np.isnan(v) else float(v) for v, m in zip(d["iono_qa"].data, d["iono_qa"].mask)]
+    db.executemany("INSERT INTO qa VALUES (?, ?, ?)", zip(d["obsid"].tolist(), iono_qa, d["projectid"]))
+    selected = [row[0] for row in db.execute("SELECT obsid FROM qa WHERE %s ORDER BY obsid" % sql, params)]
+    assert selected == list(d["obsid"][c.evaluate(constraints, d)])
+
+
+def test_to_sql_values_named_like_columns():
+    # Only strings which are columns are quoted as names; other strings are bound as values.
+    assert c.to_sql(("=", "projectid", "obsid"), columns=["projectid"]) == ('("projectid" = ?)', ["obsid"])
+    with pytest.raises(ValueError):
+        c.to_sql(("between", "obsid", 1))
+
+
+@pytest.mark.parametrize("constraints,expected", [
+    (("=", "obsid", 5), (5, 5, None)),
+    ((">=", "obsid", 5), (5, None, None)),
+    (("<=", "obsid", 5), (None, 5, None)),
+    (("and", ("<=", "obsid", 9), (">=", "obsid", 5)), (5, 9, None)),
+    (("and", ("and", (">=", "obsid", 5), ("<=", "obsid", 9)), ("=", "iono_qa", 1)), (5, 9, ("=", "iono_qa", 1))),
+    (("and", (">=", "obsid", 5), ("=", "iono_qa", 1)), (5, None, ("=", "iono_qa", 1))),
+    ((">", "obsid", 5), None),
+    (("or", (">=", "obsid", 5), ("<=", "obsid", 9)), None),
+    # A second lower bound is kept as a further constraint.
+    (("and", (">=", "obsid", 5), (">=", "obsid", 9)), (5, None, (">=", "obsid", 9))),
+    ((">=", "obsid", True), None),
+    (None, None),
+])
+def test_obsid_range(constraints, expected):
+    assert c.obsid_range(constraints) == expected
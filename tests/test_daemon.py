@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import os
+import sys
+import stat
+import time
+import shutil
+import tempfile
+import subprocess
+
+import pytest
+
+import server
+import mwaqa.util as u
+from mwaqa import cache, daemon, flight, metadata
+
+
+@pytest.fixture
+def socket_path():
+    # Unix socket paths are limited to about 100 characters, so don't use pytest's (long) temporary directories.
+    directory = tempfile.mkdtemp(prefix="mwaqa")
+    yield os.path.join(directory, "daemon.sock")
+    shutil.rmtree(directory)
+
+
+@pytest.fixture
+def mwaqa_daemon(socket_path, stand_in, monkeypatch):
+    """
+    Run the daemon in another process, point the library at the stand-in server, and return the daemon's process.
+    """
+    script = "\n".join(["import sys",
+                        "sys.path.insert(0, %r)" % os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "from mwaqa import daemon",
+                        "daemon.serve(%r)" % socket_path])
+    process = subprocess.Popen([sys.executable, "-c", script])
+    end = time.time() + 10
+    while not daemon._running(socket_path):
+        assert time.time() < end and process.poll() is None, "the daemon didn't start"
+        time.sleep(0.05)
+
+    monkeypatch.setattr(u, "BASEURL", stand_in.baseurl + "mro/")
+    monkeypatch.setattr(u, "KEYS", {None: None, u.DEFAULTID: "test"})
+    monkeypatch.setattr(metadata, "FINDURL", stand_in.findurl)
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", None)
+    yield process
+    daemon.disconnect()
+    if process.poll() is None:
+        process.terminate()
+        process.wait()
+
+
+def test_connect(mwaqa_daemon, socket_path):
+    client = daemon.connect(socket_path)
+    assert daemon.ACTIVE is client
+    assert client.ping()["pid"] == mwaqa_daemon.pid
+    # Only the current user can connect.
+    assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+    daemon.disconnect()
+    assert daemon.ACTIVE is None
+
+
+def test_getmeta_through_the_daemon(mwaqa_daemon, socket_path, stand_in):
+    client = daemon.connect(socket_path)
+    requests = client.stats()["requests"]
+    first = u.select(column_list=["obsid"], pagesize=5)
+    assert len(first["rows"]) == 5
+    assert u.select(column_list=["obsid"], pagesize=5) == first
+    # The second select was answered from the daemon's cache.
+    assert stand_in.requests == 1
+    stats = client.stats()
+    assert stats["requests"] == requests + 3
+    assert (stats["cache"]["hits"], stats["cache"]["misses"], stats["cache"]["entries"]) == (1, 1, 1)
+
+
+def test_find_through_the_daemon(mwaqa_daemon, socket_path, stand_in):
+    daemon.connect(socket_path)
+
+    def query():
+        q = metadata.Query(pagesize=50)
+        q.params.update(mintime=server.FIRSTOBSID, maxtime=server.FIRSTOBSID + 79 * server.SPACING)
+        return q.paged_results()
+
+    first = query()
+    requests = stand_in.requests
+    assert [r["mwas.starttime"] for r in first] == list(range(server.FIRSTOBSID,
+                                                              server.FIRSTOBSID + 80 * server.SPACING,
+                                                              server.SPACING))
+    assert query() == first
+    assert stand_in.requests == requests
+
+
+def test_writes_are_not_made_by_the_daemon(mwaqa_daemon, socket_path, stand_in):
+    client = daemon.connect(socket_path)
+    requests = client.stats()["requests"]
+    u.update(constraints=("=", "obsid", int(stand_in.data["obsid"][0])), data={"iono_qa": 1})
+    assert stand_in.requests == 1
+    assert client.stats()["requests"] == requests + 1
+    with pytest.raises(ValueError):
+        client.request("getmeta", url=stand_in.baseurl + "quality/update?data=%7B%7D")
+
+
+@pytest.mark.parametrize("op", ["getmeta", "find"])
+def test_only_http_urls_are_fetched(mwaqa_daemon, socket_path, op):
+    client = daemon.connect(socket_path)
+    for url in ("file:///etc/passwd", "ftp://example.org/quality/select"):
+        with pytest.raises(ValueError) as error:
+            client.request(op, url=url)
+        assert "only fetches HTTP URLs" in str(error.value)
+    # The connection is still usable after an error.
+    assert client.ping()
+
+
+def test_unknown_operation(mwaqa_daemon, socket_path):
+    with pytest.raises(ValueError):
+        daemon.connect(socket_path).request("delete")
+
+
+def test_daemon_goes_away(mwaqa_daemon, socket_path, stand_in):
+    daemon.connect(socket_path)
+    mwaqa_daemon.terminate()
+    mwaqa_daemon.wait()
+    # Requests are made directly instead, from then on.
+    assert len(u.select(column_list=["obsid"], pagesize=5)["rows"]) == 5
+    assert daemon.ACTIVE is None
+    assert stand_in.requests == 1
+    with pytest.raises(daemon.DaemonUnavailable):
+        daemon.forward("ping")
+
+
+def test_second_daemon_refused(mwaqa_daemon, socket_path):
+    with pytest.raises(RuntimeError):
+        daemon.serve(socket_path)
+
+
+def test_no_daemon(socket_path, monkeypatch):
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    assert daemon.connect(socket_path) is None
+    with pytest.raises(daemon.DaemonUnavailable):
+        daemon.forward("ping")
+    with pytest.raises(daemon.DaemonUnavailable):
+        daemon.Client(socket_path).ping()
@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table, MaskedColumn
+
+from mwaqa import export
+
+
+def chunk(obsids, flags, flag_mask):
+    return Table([MaskedColumn(obsids, name="obsid", dtype=np.int64),
+                  MaskedColumn(flags, name="flagged", dtype=bool, mask=flag_mask),
+                  MaskedColumn([o / 10.0 for o in obsids], name="iono_magnitude"),
+                  MaskedColumn(["G%04d" % o for o in obsids], name="projectid")])
+
+
+@pytest.mark.filterwarnings("ignore:Column 'flagged' contains NULL")
+def test_fits_round_trip_with_bools(tmp_path):
+    path = str(tmp_path / "qa.fits")
+    with export.open_writer(path) as writer:
+        writer.write(chunk([1, 2, 3], [True, False, True], [False, False, False]))
+        writer.write(chunk([4, 5], [False, True], [True, False]))
+
+    with fits.open(path) as hdus:
+        header = hdus[1].header
+        data = hdus[1].data
+        assert header["NAXIS2"] == 5
+        assert header["TFORM2"] == "L"
+        assert list(data["obsid"]) == [1, 2, 3, 4, 5]
+        assert list(data["iono_magnitude"]) == [0.1, 0.2, 0.3, 0.4, 0.5]
+        assert list(data["projectid"]) == ["G0001", "G0002", "G0003", "G0004", "G0005"]
+
+    # Null logicals are zero bytes, which astropy only tells apart from False when reading them as bytes.
+    with fits.open(path, logical_as_bytes=True) as hdus:
+        assert list(hdus[1].data["flagged"]) == [b"T", b"F", b"T", b"", b"T"]
+
+    # The file is also readable as an astropy Table.
+    t = Table.read(path, hdu=1)
+    assert list(t["obsid"]) == [1, 2, 3, 4, 5]
+    assert t["flagged"].dtype == bool
+    assert list(t["flagged"][:3]) == [True, False, True]
+    assert t["flagged"][4]
+
+
+def paths(obsids, values):
+    return Table([MaskedColumn(obsids, name="obsid", dtype=np.int64),
+                  MaskedColumn([v or "" for v in values], name="uvfits_path", mask=[v is None for v in values]),
+                  MaskedColumn([o % 2 == 0 for o in obsids], name="flagged", dtype=bool)])
+
+
+CHUNKS = [([1, 2], ["a", "bb"]),
+          ([3], ["/very/long/path/file.uvfits"]),
+          ([4, 5], [None, "c"]),
+          ([6], [u"/even/longer/path/été/file.uvfits"])]
+EXPECTED = ["a", "bb", "/very/long/path/file.uvfits", "", "c", u"/even/longer/path/été/file.uvfits"]
+
+
+@pytest.mark.parametrize("format", ["fits", "hdf5"])
+def test_later_chunks_widen_strings(tmp_path, format):
+    path = str(tmp_path / ("qa." + format))
+    with export.open_writer(path, format=format) as writer:
+        for obsids, values in CHUNKS:
+            writer.write(paths(obsids, values))
+        assert writer.nrows == 6
+
+    if format == "fits":
+        with fits.open(path) as hdus:
+            assert hdus[1].header["NAXIS2"] == 6
+            data = hdus[1].data
+            # astropy gives bytes for columns with non-ASCII strings.
+            strings = [v.decode("utf-8") if isinstance(v, bytes) else v for v in data["uvfits_path"]]
+            obsids, flagged = list(data["obsid"]), list(data["flagged"])
+    else:
+        import h5py
+        with h5py.File(path, "r") as f:
+            assert list(f) == ["data"]
+            data = f["data"][:]
+            strings = [v.decode("utf-8") for v in data["uvfits_path"]]
+            obsids, flagged = list(data["obsid"]), list(data["flagged"])
+    assert strings == EXPECTED
+    assert obsids == [1, 2, 3, 4, 5, 6]
+    assert flagged == [False, True, False, True, False, True]
+
+
+def test_string_width_truncates(tmp_path):
+    path = str(tmp_path / "qa.fits")
+    with export.open_writer(path, string_width=4) as writer:
+        for obsids, values in CHUNKS[:2]:
+            writer.write(paths(obsids, values))
+    with fits.open(path) as hdus:
+        assert list(hdus[1].data["uvfits_path"]) == ["a", "bb", "/ver"]
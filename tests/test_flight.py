@@ -0,0 +1,183 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import time
+import threading
+
+import pytest
+
+import server
+import mwaqa.util as u
+from mwaqa import cache, daemon, flight, resilience
+
+
+def run(*funcs):
+    """
+    Call each function in its own thread, and return their results (or errors) in order, once all have finished.
+    """
+    results = [None] * len(funcs)
+
+    def call(i):
+        try:
+            results[i] = funcs[i]()
+        except Exception as error:
+            results[i] = error
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(funcs))]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def join(threads):
+    for thread in threads:
+        thread.join(10)
+
+
+def wait_for(condition):
+    end = time.time() + 10
+    while not condition():
+        assert time.time() < end
+        time.sleep(0.01)
+
+
+def test_identical_calls_are_shared():
+    group = flight.Group()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        release.wait(10)
+        return {"rows": []}
+
+    threads, results = run(*[lambda: group.do("key", slow)] * 5)
+    wait_for(lambda: group.stats()["shared"] == 4)
+    # A different key isn't shared.
+    assert group.do("other", lambda: "other") == "other"
+    release.set()
+    join(threads)
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert group.stats() == {"calls": 6, "shared": 4, "subsets": 0}
+    # Once a call has finished, the next one is made again.
+    group.do("key", slow)
+    assert len(calls) == 2
+
+
+def test_errors_are_shared():
+    group = flight.Group()
+    release = threading.Event()
+
+    def failing():
+        release.wait(10)
+        raise ValueError("bad")
+
+    threads, results = run(*[lambda: group.do("key", failing)] * 3)
+    wait_for(lambda: group.stats()["shared"] == 2)
+    release.set()
+    join(threads)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert group.do("key", lambda: "ok") == "ok"
+
+
+def test_waiting_respects_the_deadline():
+    group = flight.Group()
+    release = threading.Event()
+    threads, _ = run(lambda: group.do("key", lambda: release.wait(10)))
+    wait_for(lambda: group._flights)
+    with resilience.deadline(0.1):
+        with pytest.raises(resilience.DeadlineExceeded):
+            group.do("key", lambda: "not called")
+    release.set()
+    join(threads)
+
+
+def test_find():
+    group = flight.Group()
+    release = threading.Event()
+    threads, _ = run(lambda: group.do("wide", lambda: release.wait(10), info=(0, 100)))
+    wait_for(lambda: group._flights)
+    assert group.find(lambda info: info[0] <= 10 and info[1] >= 20).key == "wide"
+    assert group.find(lambda info: info[1] >= 200) is None
+    release.set()
+    join(threads)
+    assert group.find(lambda info: True) is None
+    assert group.stats()["subsets"] == 1
+
+
+def test_disable(monkeypatch):
+    monkeypatch.setattr(flight, "ACTIVE", flight.ACTIVE)
+    flight.disable()
+    calls = []
+    flight.do("key", lambda: calls.append(1))
+    flight.do("key", lambda: calls.append(1))
+    assert len(calls) == 2
+    assert flight.enable() is flight.ACTIVE
+    assert flight.enable() is flight.ACTIVE
+
+
+@pytest.fixture
+def selects(stand_in, monkeypatch):
+    """
+    Point the library at the stand-in server, which holds each select until the returned event is set, and return
+    (event, list of the constraints of each select received).
+    """
+    release = threading.Event()
+    received = []
+    respond = server.Server.respond
+
+    def held(self, path, params):
+        if "select" in path:
+            received.append(params["constraints"])
+            release.wait(10)
+        return respond(self, path, params)
+
+    monkeypatch.setattr(server.Server, "respond", held)
+    monkeypatch.setattr(u, "BASEURL", stand_in.baseurl)
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", flight.Group())
+    yield release, received
+    release.set()
+
+
+def select(stand_in, lo, hi, pagesize=100):
+    obsids = [int(o) for o in stand_in.data["obsid"]]
+    return u.select(constraints=("and", (">=", "obsid", obsids[lo]), ("<=", "obsid", obsids[hi])),
+                    column_list=["obsid", "iono_qa"], pagesize=pagesize)
+
+
+def test_select_sub_range_shares_a_wider_select(stand_in, selects):
+    release, received = selects
+    obsids = [int(o) for o in stand_in.data["obsid"]]
+    threads, results = run(lambda: select(stand_in, 10, 60))
+    wait_for(lambda: received)
+    # An identical select is answered from the wider one in the same way.
+    more, narrow = run(lambda: select(stand_in, 20, 30), lambda: select(stand_in, 10, 60))
+    wait_for(lambda: flight.ACTIVE.stats()["subsets"] == 2)
+    release.set()
+    join(threads + more)
+    assert [row[0] for row in results[0]["rows"]] == obsids[10:61]
+    assert [row[0] for row in narrow[0]["rows"]] == obsids[20:31]
+    assert narrow[1]["rows"] == results[0]["rows"]
+    assert len(received) == 1
+
+
+def test_select_sub_range_of_a_truncated_select(stand_in, selects):
+    release, received = selects
+    obsids = [int(o) for o in stand_in.data["obsid"]]
+    # The wider select fills its page, so may be missing rows of the narrower range, which is requested itself.
+    threads, results = run(lambda: select(stand_in, 10, 60, pagesize=20))
+    wait_for(lambda: received)
+    more, narrow = run(lambda: select(stand_in, 20, 40))
+    wait_for(lambda: flight.ACTIVE.stats()["subsets"] == 1)
+    release.set()
+    join(threads + more)
+    assert [row[0] for row in results[0]["rows"]] == obsids[10:30]
+    assert [row[0] for row in narrow[0]["rows"]] == obsids[20:41]
+    assert len(received) == 2
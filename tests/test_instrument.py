@@ -0,0 +1,181 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+
+import io
+import json
+import time
+import logging
+
+import pytest
+
+import mwaqa.util as u
+from mwaqa import cache, daemon, flight, instrument
+
+
+@pytest.fixture
+def records(monkeypatch):
+    """
+    Collect the record of every instrumented call made during the test.
+    """
+    monkeypatch.setattr(instrument, "SINKS", [])
+    collected = []
+    instrument.add_sink(collected.append)
+    return collected
+
+
+@pytest.fixture
+def library(stand_in, monkeypatch):
+    monkeypatch.setattr(u, "BASEURL", stand_in.baseurl + "mro/")
+    monkeypatch.setattr(u, "KEYS", {None: None, u.DEFAULTID: "secret"})
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", None)
+    return stand_in
+
+
+def test_nothing_is_recorded_without_sinks(monkeypatch):
+    monkeypatch.setattr(instrument, "SINKS", [])
+    with instrument.span("call") as record:
+        instrument.note("rows", 1)
+        instrument.add("bytes", 1)
+        with instrument.timer("fetch"):
+            pass
+    assert record is None
+    assert instrument.current() is None
+
+
+def test_span_fields(records):
+    with instrument.span("call", "quality/select", "http://h/quality/select?secure_key=abc&limit=1"):
+        instrument.note("rows", 3)
+        instrument.add("bytes", 10)
+        instrument.add("bytes", 5)
+        with instrument.timer("fetch"):
+            time.sleep(0.01)
+        with instrument.timer("fetch"):
+            time.sleep(0.01)
+    [record] = records
+    assert (record["call"], record["service"], record["rows"], record["bytes"]) == ("call", "quality/select", 3, 15)
+    assert record["url"] == "http://h/quality/select?secure_key=***&limit=1"
+    assert 0.02 <= record["fetch"] <= record["total"]
+    assert instrument.current() is None
+
+
+def test_nested_spans_share_a_record(records):
+    @instrument.traced("inner")
+    def inner():
+        instrument.add("rows", 1)
+
+    @instrument.traced("outer")
+    def outer():
+        inner()
+        inner()
+        return "result"
+
+    assert outer() == "result"
+    assert [(r["call"], r["rows"]) for r in records] == [("outer", 2)]
+
+
+def test_errors_are_recorded(records):
+    @instrument.traced("failing")
+    def failing():
+        raise ValueError("bad")
+
+    with pytest.raises(ValueError):
+        failing()
+    assert records[0]["error"] == "ValueError: bad"
+
+
+def test_traced_generator(records):
+    @instrument.traced_generator("generate")
+    def generate(n):
+        for i in range(n):
+            instrument.add("rows", 1)
+            yield i
+
+    items = []
+    for item in generate(3):
+        # The consumer runs outside the generator's span.
+        assert instrument.current() is None
+        items.append(item)
+    assert items == [0, 1, 2]
+    assert records[0]["rows"] == 3
+    assert records[0]["fetch"] <= records[0]["total"]
+
+    # Closing a generator early still sends its record, without an error.
+    generator = generate(10)
+    next(generator)
+    generator.close()
+    assert len(records) == 2
+    assert records[1]["rows"] == 1
+    assert "error" not in records[1]
+
+
+def test_failing_sink_is_ignored(records, caplog):
+    def broken(record):
+        raise RuntimeError("full disk")
+    instrument.add_sink(broken)
+    with caplog.at_level(logging.WARNING, logger="quality"):
+        with instrument.span("call"):
+            pass
+    assert len(records) == 1
+    assert "full disk" in caplog.text
+    instrument.remove_sink(broken)
+    instrument.remove_sink(broken)
+    assert instrument.SINKS == [records.append]
+
+
+def test_getmeta_records(records, library):
+    u.select(column_list=["obsid"], pagesize=5)
+    [record] = records
+    assert (record["call"], record["service"], record["rows"]) == ("getmeta", "quality/select", 5)
+    assert record["bytes"] > 0
+    assert "secret" not in record["url"]
+    for name in ("ttfb", "fetch", "decode", "total"):
+        assert 0 < record[name] <= record["total"]
+
+
+def test_sinks(monkeypatch, tmpdir, caplog, capsys):
+    monkeypatch.setattr(instrument, "SINKS", [])
+    histogram = instrument.add_sink(instrument.HistogramSink())
+    path = str(tmpdir.join("profile.jsonl"))
+    lines = instrument.add_sink(instrument.JSONLinesSink(path))
+    instrument.add_sink(instrument.LogSink(logging.INFO))
+    with caplog.at_level(logging.INFO, logger="quality"):
+        for rows in (1, 2, 3, 4):
+            with instrument.span("getmeta", "quality/select"):
+                instrument.note("cache", "hit" if rows == 1 else "miss")
+                instrument.note("rows", rows)
+                instrument.add("fetch", rows / 100)
+        with pytest.raises(ValueError):
+            with instrument.span("getmeta", "metadata/find"):
+                raise ValueError("bad")
+    lines.close()
+
+    with io.open(path, encoding="utf-8") as f:
+        written = [json.loads(line) for line in f]
+    assert [r.get("rows") for r in written] == [1, 2, 3, 4, None]
+    assert "getmeta quality/select: cache=hit rows=1" in caplog.text
+    assert "error=ValueError: bad" in caplog.text
+
+    summary = histogram.summary()
+    select = summary[("getmeta", "quality/select")]
+    assert (select["calls"], select["errors"], select["hits"], select["misses"], select["rows"]) == (4, 0, 1, 3, 10)
+    assert select["fetch"]["count"] == 4
+    assert select["fetch"]["sum"] == pytest.approx(0.1)
+    assert (select["fetch"]["p50"], select["fetch"]["max"]) == (0.03, 0.04)
+    assert summary[("getmeta", "metadata/find")]["errors"] == 1
+
+    histogram.report()
+    text = capsys.readouterr().err
+    assert text.startswith("# mwaqa profile")
+    assert "# getmeta quality/select: 4 calls (0 errors), cache 1 hits / 3 misses, 10 rows" in text
+    assert "#   fetch " in text
+
+
+def test_empty_report(capsys):
+    instrument.HistogramSink().report()
+    assert "no service calls were made" in capsys.readouterr().err
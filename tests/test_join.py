@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+
+import random
+
+import pytest
+
+from mwaqa.join import join_rows
+
+
+QA = ["obsid", "iono_qa"]
+META = ["Obsid", "LST [deg]"]
+# Obsid 2 is only in the QA rows, obsid 4 only in the metadata, and obsid 3 has two metadata rows.
+LEFT = [[1, 0.1], [2, 0.2], [3, 0.3], [5, 0.5]]
+RIGHT = [[1, 10.0], [3, 30.0], [3, 31.0], [4, 40.0], [5, 50.0]]
+EXPECTED = {"inner": [[1, 0.1, 10.0], [3, 0.3, 30.0], [3, 0.3, 31.0], [5, 0.5, 50.0]],
+            "left": [[1, 0.1, 10.0], [2, 0.2, None], [3, 0.3, 30.0], [3, 0.3, 31.0], [5, 0.5, 50.0]],
+            "outer": [[1, 0.1, 10.0], [2, 0.2, None], [3, 0.3, 30.0], [3, 0.3, 31.0], [4, None, 40.0],
+                      [5, 0.5, 50.0]]}
+
+
+@pytest.mark.parametrize("how", ["inner", "left", "outer"])
+@pytest.mark.parametrize("method", ["hash", "merge", "auto"])
+def test_join_rows(how, method):
+    rows, columns = join_rows(LEFT, RIGHT, QA, META, right_key="Obsid", how=how, method=method)
+    assert columns == ["obsid", "iono_qa", "LST [deg]"]
+    # The merge join gives rows sorted by key; the hash join keeps the left order, then the unmatched right rows.
+    assert sorted(rows, key=lambda row: row[0]) == EXPECTED[how]
+    if method != "hash":
+        assert rows == EXPECTED[how]
+
+
+@pytest.mark.parametrize("how", ["inner", "left", "outer"])
+def test_hash_join_keeps_left_order(how):
+    left = list(reversed(LEFT))
+    rows, _ = join_rows(left, RIGHT, QA, META, right_key="Obsid", how=how, method="auto")
+    keys = [row[0] for row in rows]
+    left_keys = [k for k in keys if k != 4]
+    assert left_keys == [k for k in [5, 3, 3, 2, 1] if how != "inner" or k != 2]
+    if how == "outer":
+        assert keys[-1] == 4
+
+
+@pytest.mark.parametrize("how", ["inner", "left", "outer"])
+def test_hash_and_merge_agree(how):
+    rng = random.Random(1)
+    left = sorted([rng.randrange(50), rng.random()] for _ in range(200))
+    right = sorted([rng.randrange(50), rng.random(), rng.random()] for _ in range(150))
+    hashed, _ = join_rows(left, right, ["k", "a"], ["k", "b", "c"], key="k", how=how, method="hash")
+    merged, _ = join_rows(left, right, ["k", "a"], ["k", "b", "c"], key="k", how=how, method="merge")
+    assert sorted(hashed, key=repr) == sorted(merged, key=repr)
+    # Duplicate keys on both sides give every pair of rows.
+    pairs = sum(sum(1 for r in right if r[0] == l[0]) for l in left)
+    assert sum(1 for row in merged if row[1] is not None and row[2] is not None) == pairs
+
+
+def test_join_rows_empty_and_iterables():
+    assert join_rows([], RIGHT, QA, META, right_key="Obsid", how="inner")[0] == []
+    assert join_rows(iter(LEFT), [], QA, META, right_key="Obsid", how="left")[0] == [row + [None] for row in LEFT]
+    assert join_rows([], iter(RIGHT), QA, META, right_key="Obsid", how="outer",
+                     method="merge")[0] == [[row[0], None, row[1]] for row in RIGHT]
+
+
+def test_join_rows_errors():
+    with pytest.raises(ValueError):
+        join_rows(LEFT, RIGHT, QA, META, right_key="Obsid", how="right")
+    with pytest.raises(ValueError):
+        join_rows(LEFT, RIGHT, QA, META, right_key="Obsid", method="sort")
+    # A missing key column.
+    with pytest.raises(ValueError):
+        join_rows(LEFT, RIGHT, QA, META)
@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import pytest
+
+import server
+from mwaqa import cache, daemon, flight, metadata
+
+
+@pytest.fixture
+def find(stand_ins, monkeypatch):
+    """
+    Point metadata.Query at a stand-in server with 1000 observations, and return the server.
+    """
+    stand_in = stand_ins(nrows=1000)
+    monkeypatch.setattr(metadata, "FINDURL", stand_in.findurl)
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", None)
+    return stand_in
+
+
+def query(lo, hi, pagesize=50, extended=True):
+    q = metadata.Query(extended_results=extended, pagesize=pagesize)
+    q.params.update(mintime=lo, maxtime=hi)
+    return q
+
+
+def obsids(lo, hi):
+    return list(range(lo, hi + 1, server.SPACING))
+
+
+def test_single_page_is_truncated(find, capsys):
+    lo, hi = server.FIRSTOBSID, server.FIRSTOBSID + 299 * server.SPACING
+    q = query(lo, hi)
+    q.make_query()
+    assert list(q.table["Obsid"]) == obsids(lo, hi)[:50]
+    assert "truncated" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("extended", [True, False])
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_paged_query_fetches_everything(find, capsys, extended, max_workers):
+    lo, hi = server.FIRSTOBSID + 10 * server.SPACING, server.FIRSTOBSID + 309 * server.SPACING
+    q = query(lo, hi, extended=extended)
+    q.make_paged_query(max_workers=max_workers)
+    assert list(q.table["Obsid"]) == obsids(lo, hi)
+    assert q.table.colnames == q.column_names
+    # 300 observations in pages of 50 need at least 6 requests, and full pages are split.
+    assert find.requests >= 6
+    assert "truncated" not in capsys.readouterr().err
+
+
+def test_paged_query_windows(find):
+    first = server.FIRSTOBSID
+    windows = [(first, first + 2 * server.SPACING), (first + 500 * server.SPACING, first + 800 * server.SPACING)]
+    results = query("", "", pagesize=100).paged_results(windows=windows)
+    assert [r["mwas.starttime"] for r in results] == obsids(*windows[0]) + obsids(*windows[1])
+
+
+def test_paged_query_small_window(find):
+    lo, hi = server.FIRSTOBSID, server.FIRSTOBSID + 99 * server.SPACING
+    results = query(lo, hi).paged_results(window=3 * server.SPACING)
+    assert [r["mwas.starttime"] for r in results] == obsids(lo, hi)
+
+
+def test_paged_query_needs_a_range(find):
+    with pytest.raises(ValueError):
+        query("", server.FIRSTOBSID).make_paged_query()
+    with pytest.raises(ValueError):
+        query(server.FIRSTOBSID + 1, server.FIRSTOBSID).make_paged_query()
+
+
+def test_iter_results_streams_a_page(find):
+    lo, hi = server.FIRSTOBSID, server.FIRSTOBSID + 99 * server.SPACING
+    batches = list(query(lo, hi, pagesize=100).iter_results(batch_size=30))
+    assert [len(batch) for batch in batches] == [30, 30, 30, 10]
+    assert [r["mwas.starttime"] for batch in batches for r in batch] == obsids(lo, hi)
@@ -0,0 +1,28 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+
+import time
+
+from mwaqa import mirror, obsids
+
+
+def test_gps_now_includes_leap_seconds():
+    # GPS time has been 18 seconds ahead of UTC since 2017; astropy's table would include any added since.
+    unix = int(time.time())
+    assert obsids.gps_now() - (unix - 315964800) >= 18
+
+
+def test_first_sync_starts_at_earliest_obsid(monkeypatch):
+    fetched = []
+    monkeypatch.setattr(mirror.Mirror, "_fetch", lambda self, lo, hi, **kwargs: fetched.append((lo, hi)) or [])
+    m = mirror.Mirror(":memory:")
+    before = obsids.gps_now()
+    m.sync()
+    assert len(fetched) == 1
+    lo, hi = fetched[0]
+    assert lo == obsids.MINOBSID
+    assert before <= hi <= obsids.gps_now()
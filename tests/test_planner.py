@@ -0,0 +1,105 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import numpy as np
+import pytest
+
+from mwaqa import planner
+from mwaqa.constraints import evaluate
+
+
+def obsids_of(request):
+    return sorted(int(o) for term in request for o in term.obsids)
+
+
+def request_terms(request):
+    return sum(term.nterms() for term in request)
+
+
+@pytest.mark.parametrize("nobsids,max_terms", [(500, 100), (101, 100), (100, 100), (7, 3), (1, 1)])
+def test_batch_respects_max_terms(nobsids, max_terms):
+    obsids = 1065880128 + np.arange(nobsids) * 100000
+    requests = planner.batch([planner.make_term("equal", obsids)], max_terms=max_terms)
+    assert all(request_terms(r) <= max_terms for r in requests)
+    assert sorted(o for r in requests for o in obsids_of(r)) == list(obsids)
+
+
+def test_batch_packs_mixed_terms():
+    terms = [planner.make_term("equal", np.arange(30)),
+             planner.make_term("range", np.arange(100, 200)),
+             planner.make_term("equal", np.arange(1000, 1250))]
+    requests = planner.batch(terms, max_terms=100)
+    assert all(request_terms(r) <= 100 for r in requests)
+    assert sum(request_terms(r) for r in requests) == 30 + 1 + 250
+
+
+def test_split_range():
+    term = planner.make_term("range", np.array([10, 20, 30, 40]))
+    first, second = term.split()
+    assert (first.lo, first.hi, list(first.obsids)) == (10, 25, [10, 20])
+    assert (second.lo, second.hi, list(second.obsids)) == (26, 40, [30, 40])
+
+
+def test_split_equal():
+    first, second = planner.make_term("equal", np.array([1, 2, 3])).split()
+    assert list(first.obsids) == [1] and list(second.obsids) == [2, 3]
+
+
+@pytest.mark.parametrize("kind", ["equal", "range"])
+def test_split_single_obsid_refused(kind):
+    with pytest.raises(ValueError):
+        planner.make_term(kind, np.array([1065880128])).split()
+
+
+def test_any_of_is_balanced():
+    tree = planner.any_of([("=", "obsid", o) for o in range(8)])
+
+    def depth(node):
+        return 1 + max(depth(node[1]), depth(node[2])) if node[0] == "or" else 0
+    assert depth(tree) == 3
+    assert list(evaluate(tree, {"obsid": np.arange(10)})) == [True] * 8 + [False] * 2
+
+
+def test_clusters():
+    runs = planner.clusters([1000, 1120, 1240, 500000, 1120, 500120], spacing=120)
+    assert [list(run) for run in runs] == [[1000, 1120, 1240], [500000, 500120]]
+    assert planner.clusters([]) == []
+
+
+def test_plan_sparse_obsids_use_equalities():
+    obsids = 1065880128 + np.arange(20) * 10000000
+    plan = planner.plan(obsids)
+    assert plan.strategy == "clustered"
+    assert all(term.kind == "equal" for request in plan.requests for term in request)
+    assert sorted(o for r in plan.requests for o in obsids_of(r)) == list(obsids)
+
+
+def test_plan_dense_obsids_use_one_range():
+    obsids = 1065880128 + np.arange(200) * 120
+    plan = planner.plan(obsids)
+    assert len(plan.requests) == 1
+    (term,) = plan.requests[0]
+    assert (term.kind, term.lo, term.hi) == ("range", obsids[0], obsids[-1])
+
+
+def test_plan_constraints_select_every_obsid():
+    obsids = list(1065880128 + np.arange(10) * 120) + list(1090000000 + np.arange(300) * 10000000)
+    plan = planner.plan(obsids, max_terms=50)
+    assert all(request_terms(r) <= 50 for r in plan.requests)
+    selected = np.zeros(len(obsids), dtype=bool)
+    for tree in plan.constraints():
+        selected |= evaluate(tree, {"obsid": np.array(obsids)})
+    assert selected.all()
+
+
+def test_plan_empty():
+    assert planner.plan([]).requests == []
+
+
+def test_windows():
+    assert planner.windows([1000, 1120, 10 ** 9]) == [(1000, 1120), (10 ** 9, 10 ** 9)]
@@ -0,0 +1,194 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import time
+import threading
+
+import pytest
+
+from mwaqa import resilience
+
+try:
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import HTTPError, URLError
+
+URL = "http://mro.example/quality/select?limit=10"
+
+
+class Flaky(object):
+    """
+    A request which raises the given errors in turn, then returns "ok", recording the timeout of each attempt.
+    """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.timeouts = []
+
+    def __call__(self, timeout):
+        self.timeouts.append(timeout)
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def http_error(code, headers=None):
+    return HTTPError(URL, code, "error %d" % code, headers, None)
+
+
+def policy(**kwargs):
+    kwargs.setdefault("base_delay", 0.001)
+    return resilience.Policy(**kwargs)
+
+
+def test_retries_until_success():
+    p = policy()
+    request = Flaky(http_error(503), URLError("connection refused"), http_error(429))
+    assert p.call(request, URL) == "ok"
+    assert len(request.timeouts) == 4
+    stats = p.stats()
+    assert (stats["attempts"], stats["retries"], stats["successes"], stats["failures"]) == (4, 3, 1, 0)
+
+
+def test_gives_up_after_max_attempts():
+    p = policy(max_attempts=3)
+    request = Flaky(*[http_error(500)] * 5)
+    with pytest.raises(HTTPError) as error:
+        p.call(request, URL)
+    assert error.value.code == 500
+    assert len(request.timeouts) == 3
+    assert p.stats()["failures"] == 1
+
+
+def test_client_errors_are_not_retried():
+    p = policy()
+    request = Flaky(http_error(404))
+    with pytest.raises(HTTPError):
+        p.call(request, URL)
+    assert len(request.timeouts) == 1
+    # They don't count against the host's circuit either.
+    assert p.breaker("mro.example").failures == 0
+
+
+@pytest.mark.parametrize("retry_writes", [False, True])
+def test_writes(retry_writes):
+    p = policy(retry_writes=retry_writes)
+    request = Flaky(http_error(503))
+    if retry_writes:
+        assert p.call(request, URL, write=True) == "ok"
+    else:
+        with pytest.raises(HTTPError):
+            p.call(request, URL, write=True)
+    assert len(request.timeouts) == (2 if retry_writes else 1)
+
+
+def test_backoff_respects_retry_after():
+    p = policy(base_delay=1, max_delay=30)
+    for retry in range(10):
+        assert 0 <= p._backoff(retry, URLError("refused")) <= min(30, 2 ** retry)
+    assert p._backoff(0, http_error(503, {"Retry-After": "12"})) >= 12
+    assert p._backoff(0, http_error(503, {"Retry-After": "3600"})) == 30
+    assert p._backoff(0, http_error(503, {"Retry-After": "soon"})) <= 1
+
+
+def test_circuit_opens_and_resets():
+    p = policy(max_attempts=1, failure_threshold=3, reset_seconds=0.2)
+    for _ in range(3):
+        with pytest.raises(URLError):
+            p.call(Flaky(URLError("refused")), URL)
+    breaker = p.breaker("mro.example")
+    assert breaker.state == "open"
+    request = Flaky()
+    with pytest.raises(resilience.CircuitOpenError):
+        p.call(request, URL)
+    assert request.timeouts == []
+    # Other hosts are unaffected.
+    assert p.call(Flaky(), "http://ws.example/metadata/find") == "ok"
+
+    time.sleep(0.25)
+    assert breaker.state == "half-open"
+    # A failed trial request opens the circuit again straight away.
+    with pytest.raises(URLError):
+        p.call(Flaky(URLError("refused")), URL)
+    assert breaker.state == "open"
+    time.sleep(0.25)
+    assert p.call(Flaky(), URL) == "ok"
+    assert breaker.state == "closed"
+    stats = p.stats()
+    assert (stats["circuit_opened"], stats["circuit_rejected"]) == (2, 1)
+
+
+def test_half_open_allows_one_trial():
+    breaker = resilience.CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    assert breaker.record_failure()
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_deadline(monkeypatch):
+    # Back off for the longest time allowed, 0.2 seconds, before each retry.
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: high)
+    p = policy(base_delay=0.2, max_delay=0.2)
+    request = Flaky(*[http_error(503)] * 10)
+    start = time.time()
+    with resilience.deadline(0.5):
+        with pytest.raises(HTTPError):
+            p.call(request, URL)
+    assert time.time() - start < 0.5
+    assert len(request.timeouts) == 3
+    # Each attempt was given the time left before the deadline as its timeout.
+    assert all(0 < timeout <= 0.5 for timeout in request.timeouts)
+    assert request.timeouts == sorted(request.timeouts, reverse=True)
+    assert p.stats()["deadline_exceeded"] == 1
+    assert resilience.current_deadline() is None
+
+
+def test_passed_deadline():
+    p = policy()
+    request = Flaky()
+    with pytest.raises(resilience.DeadlineExceeded):
+        p.call(request, URL, timeout=0)
+    assert request.timeouts == []
+
+
+def test_nested_deadlines_only_shorten():
+    with resilience.deadline(10) as outer:
+        with resilience.deadline(100) as inner:
+            assert inner == outer
+        with resilience.deadline(1) as inner:
+            assert inner < outer
+        assert resilience.current_deadline() == outer
+
+
+def test_bind_carries_the_deadline_to_other_threads():
+    seen = []
+
+    def work():
+        seen.append(resilience.current_deadline())
+    with resilience.deadline(10) as end:
+        bound = resilience.bind(work)
+    for func in (work, bound):
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+    assert seen == [None, end]
+    assert resilience.bind(work) is work
+
+
+def test_disable(monkeypatch):
+    monkeypatch.setattr(resilience, "ACTIVE", resilience.ACTIVE)
+    resilience.disable()
+    request = Flaky(http_error(503))
+    with pytest.raises(HTTPError):
+        resilience.call(request, URL)
+    assert len(request.timeouts) == 1
+    assert resilience.stats() == {}
+    active = resilience.configure(max_attempts=2, base_delay=0.001)
+    assert resilience.ACTIVE is active
+    assert resilience.call(Flaky(http_error(503)), URL) == "ok"
@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import json
+
+import pytest
+
+from mwaqa.stream import JSONArrayStream, batches
+
+
+SELECT = {"errors": {},
+          "rows": [[1065880128, "G0009", 2.5e3, -1.25e-2, None, True, u"caf\u00e9"],
+                   [1065880248, "", 0, -7, 1E5, False, "a \"quoted\", [bracketed] value"]],
+          "success": True,
+          "rowcount": 2e0}
+
+
+def chunked(document, size):
+    data = document.encode("utf-8")
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def split_everywhere(document):
+    """
+    Yield the document split into two chunks at every possible point.
+    """
+    data = document.encode("utf-8")
+    for i in range(len(data) + 1):
+        yield [data[:i], data[i:]]
+
+
+@pytest.mark.parametrize("chunks", [[b"[1", b"2e", b"5]"],
+                                    [b"[1", b"2e", b"+", b"5]"],
+                                    [b"[12", b".", b"5]"],
+                                    [b"[-", b"1", b"2]"],
+                                    [b"[12", b"]"]])
+def test_number_split_across_chunks(chunks):
+    assert list(JSONArrayStream(chunks)) == [json.loads(b"".join(chunks).decode("utf-8"))[0]]
+
+
+def test_one_byte_chunks_rows_and_meta():
+    document = json.dumps(SELECT)
+    stream = JSONArrayStream(chunked(document, 1), key="rows")
+    assert list(stream) == SELECT["rows"]
+    assert stream.meta == {"errors": {}, "success": True, "rowcount": 2.0}
+
+
+@pytest.mark.parametrize("document", ["[1, -2, 3.5, 6e2, 7E-1, 0, -0.0, 12345678901234567890]",
+                                      "[true, false, null, \"x\", \"\\u00e9\"]",
+                                      "[]",
+                                      " [ 1 ,2 ] ",
+                                      "[{\"a\": 1e3}, [2.5], 3]"])
+def test_one_byte_chunks_bare_scalars(document):
+    assert list(JSONArrayStream(chunked(document, 1))) == json.loads(document)
+
+
+def test_every_split_point():
+    document = json.dumps(SELECT)
+    for chunks in split_everywhere(document):
+        stream = JSONArrayStream(chunks, key="rows")
+        assert list(stream) == SELECT["rows"]
+        assert stream.meta["rowcount"] == 2.0
+
+
+def test_multibyte_character_split():
+    document = json.dumps([u"caf\u00e9"], ensure_ascii=False)
+    assert list(JSONArrayStream(chunked(document, 1))) == [u"caf\u00e9"]
+
+
+def test_missing_key_yields_nothing():
+    stream = JSONArrayStream(chunked(json.dumps({"success": False, "errors": {"0": "bad"}}), 3), key="rows")
+    assert list(stream) == []
+    assert stream.meta == {"success": False, "errors": {"0": "bad"}}
+
+
+@pytest.mark.parametrize("document", ["[1, 2", "[1 2]", "[1, 2] 3", "{\"rows\": [1]"])
+def test_malformed(document):
+    with pytest.raises(ValueError):
+        list(JSONArrayStream(chunked(document, 1), key="rows" if document.startswith("{") else None))
+
+
+def test_batches():
+    assert list(batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batches([], 2)) == []
@@ -0,0 +1,41 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+
+import logging
+
+import numpy as np
+
+from mwaqa.tables import typed_column, table_from_rows
+
+
+def test_integral_values_are_ints():
+    column = typed_column("eor_field", [1, 2.0, None], int)
+    assert column.dtype == np.int64
+    assert list(column.filled(-1)) == [1, 2, -1]
+
+
+def test_fractions_are_not_truncated(caplog):
+    with caplog.at_level(logging.WARNING, logger="quality"):
+        column = typed_column("eor_field", [1.7, 2.2], int)
+    assert column.dtype == np.float64
+    assert list(column) == [1.7, 2.2]
+    assert "eor_field" in caplog.text
+
+    t = table_from_rows([[1065880128, 3.5], [1065880248, None], [1065880368, 1]], ["obsid", "iono_qa"])
+    assert t["obsid"].dtype == np.int64
+    assert t["iono_qa"].dtype == np.float64
+    assert list(t["iono_qa"].filled(np.nan)[[0, 2]]) == [3.5, 1.0]
+    assert t["iono_qa"].mask[1]
+
+
+def test_types():
+    t = table_from_rows([[1065880128, "G0009", 0.5, "x"], [1065880248, None, None, 2]],
+                        ["obsid", "projectid", "iono_magnitude", "unknown"])
+    assert t["obsid"].dtype == np.int64
+    assert t["projectid"].dtype.kind == "U" and t["projectid"].mask[1]
+    assert t["iono_magnitude"].dtype == np.float64 and t["iono_magnitude"].mask[1]
+    assert t["unknown"].dtype.kind == "U"
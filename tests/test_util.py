@@ -0,0 +1,221 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import json
+import time
+import threading
+
+import pytest
+
+import server
+import mwaqa.util as u
+from mwaqa import cache, daemon, flight
+
+
+@pytest.fixture
+def writes(stand_in, monkeypatch):
+    """
+    Point the library at the stand-in server, and return a list which collects the parameters of each write it
+    receives; a row whose obsid is negative is refused.
+    """
+    received = []
+    respond = server.Server.respond
+
+    def recording(self, path, params):
+        if "insert" in path:
+            received.append(params)
+            rows = json.loads(params["rows"]) if "rows" in params else [json.loads(params["row"])]
+            errors = dict((str(i), "bad obsid") for i, row in enumerate(rows) if row["obsid"] < 0)
+            if errors:
+                return {"errors": errors, "success": False, "query": None}
+        return respond(self, path, params)
+
+    monkeypatch.setattr(server.Server, "respond", recording)
+    monkeypatch.setattr(u, "BASEURL", stand_in.baseurl + "mro/")
+    monkeypatch.setattr(u, "KEYS", {None: None, u.DEFAULTID: "test"})
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", flight.Group())
+    return received
+
+
+@pytest.fixture
+def gets(monkeypatch):
+    """
+    Return a list which collects the path of each GET request the stand-in server receives.
+    """
+    received = []
+    do_get = server.Handler.do_GET
+
+    def recording(self):
+        received.append(self.path)
+        return do_get(self)
+
+    monkeypatch.setattr(server.Handler, "do_GET", recording)
+    return received
+
+
+def test_insert_many_one_row_per_request(writes, gets):
+    rows = [{"obsid": 1000 + i, "iono_qa": i % 3} for i in range(20)]
+    rows[5]["obsid"] = -1
+    # A tiny max_bytes makes no difference to rows sent one at a time.
+    result = u.insert_many(rows, max_workers=4, max_bytes=10, max_rows=3)
+    assert result["errors"] == {5: "bad obsid"}
+    assert (result["inserted"], result["batches"], result["success"]) == (19, 20, False)
+    assert all("row" in params and "rows" not in params for params in writes)
+    assert sorted(json.loads(params["row"])["obsid"] for params in writes) == sorted(row["obsid"] for row in rows)
+    # Every row is sent in a POST body, not a query string.
+    assert gets == []
+
+
+def test_insert_many_one_row_per_request_from_table(writes):
+    from astropy.table import Table, MaskedColumn
+
+    table = Table([[1000, 1001, -1], MaskedColumn([0.5, 1.5, 2.5], mask=[False, True, False])],
+                  names=["obsid", "iono_magnitude"])
+    result = u.insert_many(table)
+    assert result["errors"] == {2: "bad obsid"}
+    assert sorted((row["obsid"], row["iono_magnitude"]) for row in (json.loads(params["row"]) for params in writes)) \
+        == [(-1, 2.5), (1000, 0.5), (1001, None)]
+
+
+def test_insert_many_batched(writes, gets):
+    rows = [{"obsid": 1000 + i, "iono_qa": 1} for i in range(25)]
+    rows[12]["obsid"] = -1
+    result = u.insert_many(rows, batched=True, max_rows=10)
+    assert result["errors"] == {12: "bad obsid"}
+    assert (result["inserted"], result["batches"]) == (24, 3)
+    assert [len(json.loads(params["rows"])) for params in writes] == [10, 10, 5]
+    assert gets == []
+
+
+def test_insert_many_batched_by_size(writes):
+    rows = [{"obsid": 1000 + i, "sourcelist": "x" * 100} for i in range(10)]
+    result = u.insert_many(rows, batched=True, max_bytes=500)
+    assert result["success"] and result["batches"] == len(writes) > 1
+    assert all(len(params["rows"]) <= 500 for params in writes)
+    assert sum(len(json.loads(params["rows"])) for params in writes) == 10
+
+
+def test_upsert_many_updates_refused_rows(writes):
+    result = u.upsert_many([{"obsid": 1000, "iono_qa": 1}, {"obsid": -1, "iono_qa": 2}])
+    assert (result["inserted"], result["updated"], result["errors"]) == (1, 1, {})
+
+
+def test_insert_many_from_the_calling_thread(writes, monkeypatch):
+
+    threads = set()
+    getmeta = u.getmeta
+
+    def recording(*args, **kwargs):
+        threads.add(threading.current_thread())
+        return getmeta(*args, **kwargs)
+
+    monkeypatch.setattr(u, "getmeta", recording)
+    result = u.insert_many([{"obsid": 1000 + i} for i in range(5)], max_workers=0)
+    assert (result["inserted"], result["batches"]) == (5, 5)
+    assert threads == {threading.current_thread()}
+
+
+@pytest.mark.parametrize("desc", [False, True])
+def test_select_obsids_order(stand_in, monkeypatch, desc):
+    received = []
+    respond = server.Server.respond
+
+    def recording(self, path, params):
+        if "select" in path:
+            received.append(params.get("desc"))
+        return respond(self, path, params)
+
+    monkeypatch.setattr(server.Server, "respond", recording)
+    monkeypatch.setattr(u, "BASEURL", stand_in.baseurl)
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", None)
+    obsids = [int(o) for o in stand_in.data["obsid"][::3]]
+    result = u.select_obsids(obsids, column_list=["obsid", "iono_qa"], pagesize=5, desc=desc)
+    # Full pages are split, so every obsid is returned, in the order asked for.
+    assert [row[0] for row in result["rows"]] == sorted(obsids, reverse=desc)
+    assert len(received) > 1
+    assert all(bool(value) == desc for value in received)
+
+
+@pytest.fixture
+def observations(stand_in, monkeypatch):
+    """
+    Point the library at the stand-in server, which takes 50 ms to answer each metadata/obs request and refuses
+    odd obsids. Return a dictionary holding the obs_id of every such request it receives, and the most it answered
+    at once.
+    """
+    state = {"received": [], "running": 0, "most": 0}
+    lock = threading.Lock()
+    respond = server.Server.respond
+
+    def recording(self, path, params):
+        if "metadata/obs" in path:
+            with lock:
+                state["received"].append(int(params["obs_id"]))
+                state["running"] += 1
+                state["most"] = max(state["most"], state["running"])
+            time.sleep(0.05)
+            with lock:
+                state["running"] -= 1
+            if int(params["obs_id"]) % 2:
+                return None
+        return respond(self, path, params)
+
+    monkeypatch.setattr(server.Server, "respond", recording)
+    monkeypatch.setattr(u, "BASEURL", stand_in.baseurl)
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", None)
+    u.clear_obs_memo()
+    yield state
+    u.clear_obs_memo()
+
+
+def test_get_obs_many(observations):
+    obsids = [1000, 1002, 1004, 1000, 1006, 1002]
+    results = u.get_obs_many(obsids, max_workers=4)
+    assert [r["starttime"] for r in results] == obsids
+    # Repeated obsids are requested once, several at a time.
+    assert sorted(observations["received"]) == [1000, 1002, 1004, 1006]
+    assert 1 < observations["most"] <= 4
+
+
+def test_get_obs_many_memo(observations):
+    u.get_obs_many([1000, 1002])
+    results = u.get_obs_many(["1002", 1004, 1000])
+    assert [r["starttime"] for r in results] == [1002, 1004, 1000]
+    assert observations["received"].count(1000) == 1
+    assert observations["received"].count(1004) == 1
+    u.get_obs_many([1000], memo=False)
+    assert observations["received"].count(1000) == 2
+    u.clear_obs_memo()
+    u.get_obs_many([1002])
+    assert observations["received"].count(1002) == 2
+
+
+def test_get_obs_many_memo_size(observations, monkeypatch):
+    monkeypatch.setattr(u, "OBSMEMOSIZE", 2)
+    u.get_obs_many([1000, 1002, 1004])
+    del observations["received"][:]
+    u.get_obs_many([1000, 1002, 1004])
+    # The oldest result was forgotten.
+    assert observations["received"] == [1000]
+
+
+def test_get_obs_many_failures(observations):
+    results = u.get_obs_many([1000, 1001, 1002])
+    assert results[0]["starttime"] == 1000
+    assert results[1] is None
+    assert results[2]["starttime"] == 1002
+    # Failures aren't remembered, so are asked for again.
+    del observations["received"][:]
+    u.get_obs_many([1000, 1001, 1002])
+    assert observations["received"] == [1001]
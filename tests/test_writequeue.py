@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Python 2 and 3 compatibility
+from __future__ import print_function, division
+from future.builtins import range
+
+import os
+import gc
+import sys
+import json
+import subprocess
+import weakref
+
+import pytest
+
+import server
+import mwaqa.util as u
+from mwaqa import cache, daemon, flight, writequeue
+
+
+@pytest.fixture
+def updates(stand_in, monkeypatch):
+    """
+    Point the library at the stand-in server, and return a dictionary holding a list of the (data, number of obsids)
+    of each update it receives, and a count of updates it should refuse.
+    """
+    state = {"received": [], "refuse": 0}
+    respond = server.Server.respond
+
+    def recording(self, path, params):
+        if "update" in path:
+            if state["refuse"]:
+                state["refuse"] -= 1
+                return None
+            state["received"].append((json.loads(params["data"]), params["constraints"].count('"obsid"')))
+        return respond(self, path, params)
+
+    monkeypatch.setattr(server.Server, "respond", recording)
+    monkeypatch.setattr(u, "BASEURL", stand_in.baseurl + "mro/")
+    monkeypatch.setattr(u, "KEYS", {None: None, u.DEFAULTID: "test"})
+    monkeypatch.setattr(cache, "ACTIVE", None)
+    monkeypatch.setattr(daemon, "ACTIVE", None)
+    monkeypatch.setattr(flight, "ACTIVE", flight.Group())
+    monkeypatch.setattr(writequeue, "BASEDELAY", 0.01)
+    return state
+
+
+def test_coalesces_and_groups(updates, tmpdir):
+    with writequeue.WriteQueue(str(tmpdir.join("q.sqlite")), interval=60) as queue:
+        for obsid in range(10):
+            queue.update(1000 + obsid, iono_qa=1)
+            queue.update(1000 + obsid, noise_qa=2)
+        queue.update(1003, iono_qa=5)
+        assert queue.pending() == 10
+        assert queue.flush() == {"sent": 10, "failed": 0, "pending": 0}
+    assert sorted(updates["received"], key=lambda r: r[1]) == [({"iono_qa": 5, "noise_qa": 2}, 1),
+                                                               ({"iono_qa": 1, "noise_qa": 2}, 9)]
+
+
+def test_failures_are_retried_then_given_up(updates, tmpdir):
+    updates["refuse"] = 2
+    with writequeue.WriteQueue(str(tmpdir.join("q.sqlite")), interval=60, max_attempts=2) as queue:
+        queue.update(1000, iono_qa=1)
+        assert queue.flush() == {"sent": 1, "failed": 1, "pending": 1}
+        assert queue.flush() == {"sent": 1, "failed": 1, "pending": 0}
+        assert [(obsid, columns) for obsid, columns, _ in queue.failed()] == [(1000, {"iono_qa": 1})]
+        queue.retry_failed()
+        assert queue.flush() == {"sent": 1, "failed": 0, "pending": 0}
+        assert queue.failed() == []
+    assert updates["received"] == [({"iono_qa": 1}, 1)]
+
+
+def test_unsent_changes_survive_reopening(updates, tmpdir):
+    path = str(tmpdir.join("q.sqlite"))
+    updates["refuse"] = 100
+    writequeue.WriteQueue(path, interval=60).close()
+    queue = writequeue.WriteQueue(path, interval=60)
+    queue.update(1000, iono_qa=1)
+    queue.close()
+    assert updates["received"] == []
+
+    updates["refuse"] = 0
+    with writequeue.WriteQueue(path, interval=60) as queue:
+        assert queue.pending() == 1
+    assert updates["received"] == [({"iono_qa": 1}, 1)]
+
+
+def test_closed_queue_is_freed(updates, tmpdir):
+    queue = writequeue.WriteQueue(str(tmpdir.join("q.sqlite")), interval=60)
+    queue.close()
+    ref = weakref.ref(queue)
+    del queue
+    gc.collect()
+    assert ref() is None
+
+
+def test_invalid_columns(updates, tmpdir):
+    with writequeue.WriteQueue(str(tmpdir.join("q.sqlite")), interval=60) as queue:
+        with pytest.raises(ValueError):
+            queue.update(1000, not_a_column=1)
+    with pytest.raises(ValueError):
+        queue.update(1000, iono_qa=1)
+
+
+def test_upserts_are_sent_at_exit(updates, stand_in, tmpdir, monkeypatch):
+    inserted = []
+    respond = server.Server.respond
+
+    def recording(self, path, params):
+        if "insert" in path:
+            inserted.append(json.loads(params["row"])["obsid"])
+        return respond(self, path, params)
+
+    monkeypatch.setattr(server.Server, "respond", recording)
+    path = str(tmpdir.join("q.sqlite"))
+    # Queue two upserts and exit without closing the queue, so they are sent by the atexit hook, after the
+    # interpreter has stopped accepting new threads.
+    script = "\n".join(["import sys",
+                        "sys.path.insert(0, %r)" % os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "import mwaqa.util as u",
+                        "from mwaqa import writequeue",
+                        "u.BASEURL = %r" % (stand_in.baseurl + "mro/"),
+                        "u.KEYS = {None: None, u.DEFAULTID: 'test'}",
+                        "queue = writequeue.WriteQueue(%r, interval=60, upsert=True)" % path,
+                        "queue.update(1000, iono_qa=1)",
+                        "queue.update(1001, iono_qa=2)"])
+    process = subprocess.Popen([sys.executable, "-c", script], stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    assert sorted(inserted) == [1000, 1001]
+    queue = writequeue.WriteQueue(path, interval=60)
+    try:
+        assert queue.pending() == 0
+        assert queue.failed() == []
+    finally:
+        queue.close()